@@ -0,0 +1,86 @@
+"""
+Benchmark for training the models of a channel, its server and users on fetched history:
+appending every pair of every message to every model (as before)
+vs counting the pairs of a batch once and adding the counts to each model.
+
+Run from the project root: `python -m benchmarks.batch_training_benchmark [message_count] [batch_size]`
+"""
+import random
+import sys
+import time
+
+from benchmarks.corpus import make_chat_corpus
+from cheems.markov.markov import _break_into_words, canonical_form, count_word_pairs, train_model_groups
+from cheems.markov.model import Model, ModelData, ENDS, SENTENCE_START
+from cheems.util import pairwise
+
+
+def _legacy_train_models_on_sentence(models_data: list[ModelData], sentence: str):
+    """Training before this optimization"""
+    words = _break_into_words(sentence)
+    if len(words) == 0:
+        return
+    if words[-1] not in ENDS:
+        words.append(ENDS[0])
+    for w1, w2 in pairwise([ENDS[0]] + words):
+        w1 = canonical_form(w1)
+        if w1 in ENDS:
+            w2 = canonical_form(w2)
+            if w2 in ENDS:
+                continue
+            w1 = SENTENCE_START
+        for data in models_data:
+            # noinspection PyProtectedMember
+            Model._append_word_pair(data, w1, w2)
+
+
+def _make_history(message_count: int, user_count: int) -> list[tuple[int, str]]:
+    rng = random.Random(0)
+    return [(rng.randrange(user_count), text) for text in make_chat_corpus(message_count)]
+
+
+def _run_before(history: list[tuple[int, str]], user_count: int) -> list[ModelData]:
+    channel, server = ModelData(), ModelData()
+    users = [ModelData() for _ in range(user_count)]
+    # like the trainer, each model gets new pairs counted separately for the journal
+    unsaved = [ModelData() for _ in range(user_count + 2)]
+    for user, text in history:
+        _legacy_train_models_on_sentence([channel, server, users[user], unsaved[0], unsaved[1], unsaved[user + 2]],
+                                         text)
+    return [channel, server] + users
+
+
+def _run_after(history: list[tuple[int, str]], user_count: int, batch_size: int) -> list[ModelData]:
+    channel, server = ModelData(), ModelData()
+    users = [ModelData() for _ in range(user_count)]
+    unsaved = [ModelData() for _ in range(user_count + 2)]
+    for i in range(0, len(history), batch_size):
+        by_user: dict[int, list[str]] = {}
+        for user, text in history[i:i + batch_size]:
+            by_user.setdefault(user, []).append(text)
+        train_model_groups([
+            ([channel, server, users[user], unsaved[0], unsaved[1], unsaved[user + 2]], texts)
+            for user, texts in by_user.items()
+        ])
+    return [channel, server] + users
+
+
+def main(message_count: int = 50000, batch_size: int = 100, user_count: int = 20):
+    history = _make_history(message_count, user_count)
+    # warm up the cache of canonical forms for both
+    count_word_pairs(text for _, text in history)
+
+    start = time.perf_counter()
+    before = _run_before(history, user_count)
+    elapsed = time.perf_counter() - start
+    print(f'before: {message_count / elapsed:8.0f} msgs/s')
+
+    start = time.perf_counter()
+    after = _run_after(history, user_count, batch_size)
+    elapsed = time.perf_counter() - start
+    print(f'after:  {message_count / elapsed:8.0f} msgs/s (batches of {batch_size})')
+    print(f'Same models: {before == after}')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
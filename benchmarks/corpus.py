@@ -0,0 +1,66 @@
+"""
+Deterministic synthetic chat for benchmarks: words follow a Zipf distribution like in real speech,
+and messages have URLs, mentions, emoji, punctuation and code blocks at configurable rates.
+The same options and seed always give the same messages.
+"""
+import random
+from dataclasses import dataclass, asdict
+from itertools import accumulate
+
+
+@dataclass
+class CorpusOptions:
+    vocab_size: int = 5000
+    zipf_exponent: float = 1.0
+    '''Word i is picked with weight 1 / (i + 1) ** exponent'''
+    min_words: int = 1
+    max_words: int = 25
+    url_rate: float = 0.05
+    '''Fraction of messages with a URL'''
+    mention_rate: float = 0.1
+    '''Fraction of messages with a mention of a user or a channel'''
+    emoji_rate: float = 0.1
+    '''Fraction of messages with an emoji, unicode or custom'''
+    punctuation_rate: float = 0.2
+    '''Fraction of messages with loose punctuation, quotes or parentheses'''
+    code_rate: float = 0.02
+    '''Fraction of messages with a code block'''
+    end_rate: float = 0.5
+    '''Fraction of messages that end with punctuation'''
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+urls = ['https://example.com/some/path?q=1', 'https://tenor.com/view/cheems-12345', 'http://example.org']
+mentions = ['<@!123456789>', '<@987654321>', '<#987654321>', '<@&555555555>']
+emoji = ['😂', '🤔', '👍', '<:cheems:1140041467432271952>', '<a:dance:1140041467432271953>']
+loose_punctuation = ['...', '?!', ',', '(lol)', '"quote"', '—', '*wow*']
+
+
+def make_chat_corpus(message_count: int, seed: int = 0, options: CorpusOptions = None) -> list[str]:
+    """Returns synthetic chat messages"""
+    if options is None:
+        options = CorpusOptions()
+    rng = random.Random(seed)
+    words = [f'word{i}' for i in range(options.vocab_size)]
+    cum_weights = list(accumulate(1 / (i + 1) ** options.zipf_exponent for i in range(options.vocab_size)))
+    extras = [
+        (options.url_rate, urls),
+        (options.mention_rate, mentions),
+        (options.emoji_rate, emoji),
+        (options.punctuation_rate, loose_punctuation),
+    ]
+    corpus = []
+    for _ in range(message_count):
+        tokens = rng.choices(words, cum_weights=cum_weights, k=rng.randint(options.min_words, options.max_words))
+        for rate, choices in extras:
+            if rng.random() < rate:
+                tokens.insert(rng.randrange(len(tokens) + 1), rng.choice(choices))
+        message = ' '.join(tokens)
+        if rng.random() < options.code_rate:
+            message += '\n```python\nprint("hello")\n```'
+        if rng.random() < options.end_rate:
+            message += rng.choice(['.', '!', '?'])
+        corpus.append(message)
+    return corpus
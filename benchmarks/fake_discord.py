@@ -0,0 +1,224 @@
+"""
+Local stand-in for the parts of discord.py that the bot uses: guilds, text channels with `history()`,
+messages with attachments, mentions and references, and `send`/`reply`/`add_reaction`.
+It drives the real cogs and the trainer without a connection, for load tests.
+
+`FakeBot` dispatches a message like `commands.Bot` does: to the `on_message` listeners of its cogs,
+and to the command named after the prefix, with a `FakeContext`.
+Everything the bot sends is added to the channel's history, after an optional simulated network delay.
+"""
+import asyncio
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from itertools import count
+from typing import Optional, Callable
+
+from discord.ext.commands import Cog, Command
+
+_ids = count(1_000_000)
+
+
+def next_id() -> int:
+    return next(_ids)
+
+
+@dataclass(eq=False)
+class FakeUser:
+    id: int
+    name: str
+    discriminator: int = 0
+    bot: bool = False
+
+    @property
+    def mention(self) -> str:
+        return f'<@{self.id}>'
+
+
+@dataclass(eq=False)
+class FakeAttachment:
+    id: int
+    url: str
+    filename: str = 'image.png'
+    width: int = 640
+
+
+@dataclass(eq=False)
+class FakeReference:
+    resolved: 'FakeMessage'
+
+
+@dataclass(eq=False)
+class FakeMessage:
+    id: int
+    author: FakeUser
+    channel: 'FakeTextChannel'
+    system_content: str
+    created_at: datetime = field(default_factory=lambda: datetime.now(tz=timezone.utc))
+    attachments: list[FakeAttachment] = field(default_factory=list)
+    mentions: list[FakeUser] = field(default_factory=list)
+    channel_mentions: list['FakeTextChannel'] = field(default_factory=list)
+    reference: Optional[FakeReference] = None
+    reactions: list[str] = field(default_factory=list)
+
+    @property
+    def guild(self) -> 'FakeGuild':
+        return self.channel.guild
+
+    @property
+    def content(self) -> str:
+        return self.system_content
+
+    @property
+    def clean_content(self) -> str:
+        return self.system_content
+
+    def is_system(self) -> bool:
+        return False
+
+    async def reply(self, content: str) -> 'FakeMessage':
+        return await self.channel.send(content, reference=FakeReference(self))
+
+    async def add_reaction(self, emoji: str):
+        await self.channel.guild.client.simulate_latency()
+        self.reactions.append(emoji)
+        self.channel.guild.client.on_response(self.channel, emoji)
+
+
+@dataclass(eq=False)
+class FakeTextChannel:
+    id: int
+    name: str
+    guild: 'FakeGuild'
+    messages: list[FakeMessage] = field(default_factory=list)
+    '''Oldest first'''
+
+    async def history(self, limit: int = 100, after: datetime = None, oldest_first: bool = None):
+        """Like `TextChannel.history`, only supports paging forward from `after`"""
+        returned = 0
+        for msg in self.messages:
+            if returned >= limit:
+                break
+            if after is None or msg.created_at > after:
+                returned += 1
+                yield msg
+                # let other tasks run, like a page request would
+                if returned % 100 == 0:
+                    await asyncio.sleep(0)
+
+    async def send(self, content: str, reference: FakeReference = None) -> FakeMessage:
+        client = self.guild.client
+        await client.simulate_latency()
+        msg = FakeMessage(next_id(), client.user, self, content, reference=reference)
+        self.messages.append(msg)
+        client.on_response(self, content)
+        return msg
+
+
+@dataclass(eq=False)
+class FakeGuild:
+    id: int
+    name: str
+    client: 'FakeBot'
+    text_channels: list[FakeTextChannel] = field(default_factory=list)
+    members: list[FakeUser] = field(default_factory=list)
+
+    @property
+    def me(self) -> FakeUser:
+        return self.client.user
+
+    def create_text_channel(self, name: str) -> FakeTextChannel:
+        channel = FakeTextChannel(next_id(), name, self)
+        self.text_channels.append(channel)
+        return channel
+
+
+@dataclass(eq=False)
+class FakeCommand:
+    """The attributes of `commands.Command` that cogs read"""
+    name: str
+
+
+class FakeContext:
+    """Context of a command invocation, like `commands.Context`"""
+
+    def __init__(self, bot: 'FakeBot', message: FakeMessage, command: Command):
+        self.bot = bot
+        self.message = message
+        self.command = FakeCommand(command.name)
+        self.prefix = bot.command_prefix
+
+    @property
+    def guild(self) -> FakeGuild:
+        return self.message.guild
+
+    @property
+    def channel(self) -> FakeTextChannel:
+        return self.message.channel
+
+    @property
+    def author(self) -> FakeUser:
+        return self.message.author
+
+    @property
+    def me(self) -> FakeUser:
+        return self.bot.user
+
+    async def send(self, content: str) -> FakeMessage:
+        return await self.message.channel.send(content)
+
+
+class FakeBot:
+    """Holds the guilds and cogs, and dispatches messages to them"""
+    user: FakeUser
+    guilds: list[FakeGuild]
+    command_prefix: str
+    send_latency: float
+    '''Seconds to wait in every send, reply or reaction, like a request to Discord'''
+    on_response: Callable[[FakeTextChannel, str], None]
+    '''Called with everything the bot sends'''
+
+    def __init__(self, command_prefix: str = '.', send_latency: float = 0):
+        self.user = FakeUser(next_id(), 'cheems', 0, bot=True)
+        self.guilds = []
+        self.command_prefix = command_prefix
+        self.send_latency = send_latency
+        self.on_response = lambda channel, content: None
+        self._cogs: list[Cog] = []
+        self._commands: dict[str, tuple[Cog, Command]] = {}
+        self._listeners: list[Callable] = []
+
+    @property
+    def commands(self) -> set[Command]:
+        return {command for _, command in self._commands.values()}
+
+    def create_guild(self, name: str) -> FakeGuild:
+        guild = FakeGuild(next_id(), name, self)
+        self.guilds.append(guild)
+        return guild
+
+    def add_cog(self, cog: Cog):
+        self._cogs.append(cog)
+        for command in cog.get_commands():
+            self._commands[command.name] = (cog, command)
+        for name, listener in cog.get_listeners():
+            if name == 'on_message':
+                self._listeners.append(listener)
+
+    async def simulate_latency(self):
+        if self.send_latency > 0:
+            await asyncio.sleep(self.send_latency)
+        else:
+            await asyncio.sleep(0)
+
+    async def dispatch(self, msg: FakeMessage):
+        """Posts the message in its channel, and waits until all cogs have handled it"""
+        msg.channel.messages.append(msg)
+        handlers = [listener(msg) for listener in self._listeners]
+        text = msg.system_content
+        if text.startswith(self.command_prefix):
+            name = text[len(self.command_prefix):].split(' ', 1)[0]
+            cog_command = self._commands.get(name, None)
+            if cog_command is not None:
+                cog, command = cog_command
+                handlers.append(command.callback(cog, FakeContext(self, msg, command)))
+        await asyncio.gather(*handlers)
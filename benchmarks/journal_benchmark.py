@@ -0,0 +1,56 @@
+"""
+Benchmark for saving a large model repeatedly during training:
+rewriting the whole file on every save vs appending new pairs to the journal.
+
+Run from the project root: `python -m benchmarks.journal_benchmark [pair_count] [save_count] [pairs_per_save]`
+"""
+import os
+import random
+import sys
+import time
+from tempfile import TemporaryDirectory
+
+from benchmarks.markov_chain_benchmark import make_synthetic_data
+from cheems.markov.model_journal import get_journal_path
+from cheems.markov.models_xml import MarkovStorage
+from cheems.targets import Server
+
+
+def _run(root_dir: str, compact_ratio: float, save_count: int, pairs_per_save: int, vocab_size: int):
+    storage = MarkovStorage(root_dir)
+    storage.journal_compact_ratio = compact_ratio
+    storage.load_models()
+    m = storage.get_model(Server(1, 'Benchmark'))
+    rng = random.Random(0)
+    written = 0
+    start = time.perf_counter()
+    for _ in range(save_count):
+        for _ in range(pairs_per_save):
+            m.append_word_pair(f'w{rng.randrange(vocab_size)}', f'w{rng.randrange(vocab_size)}')
+        journal_path = get_journal_path(m.file_path)
+        journal_size = os.path.getsize(journal_path) if os.path.exists(journal_path) else 0
+        storage.save_model(m)
+        if os.path.exists(journal_path) and os.path.getsize(journal_path) > journal_size:
+            written += os.path.getsize(journal_path) - journal_size
+        else:
+            written += os.path.getsize(m.file_path)
+    return written, time.perf_counter() - start
+
+
+def main(vocab_size: int = 20000, save_count: int = 20, pairs_per_save: int = 50):
+    with TemporaryDirectory() as root_dir:
+        storage = MarkovStorage(root_dir)
+        m = storage.create_model(Server(1, 'Benchmark'))
+        m.data = make_synthetic_data(vocab_size=vocab_size, hub_count=10, hub_fanout=1000)
+        storage.save_model(m)
+        print(f'Model: {m.data.pair_count} pairs, {os.path.getsize(m.file_path) / 2**20:.1f} MiB, '
+              f'{save_count} saves of {pairs_per_save} pairs')
+
+        written, elapsed = _run(root_dir, 0, save_count, pairs_per_save, vocab_size)
+        print(f'before (full rewrite): {written / 2**20:9.2f} MiB written in {elapsed:.2f}s')
+        written, elapsed = _run(root_dir, 0.25, save_count, pairs_per_save, vocab_size)
+        print(f'after (journal):       {written / 2**20:9.2f} MiB written in {elapsed:.2f}s')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,272 @@
+"""
+End-to-end load test of the bot on a local stand-in for Discord (see benchmarks/fake_discord.py),
+with models, reactions and pictures stored in a temporary directory.
+
+First the trainer scrapes the history of a synthetic server (see benchmarks/corpus.py).
+Then messages arrive at a fixed rate, some of them commands, mentions and replies to the bot,
+and go through `MarkovCog`, `ProactiveMarkovCog`, `ProactiveReactCog` and `PicsCog`,
+while the trainer keeps scraping the new messages in the background.
+Latency is measured from the time a message was due to arrive until all cogs have handled it,
+so it includes waiting behind slower messages when the bot can't keep up with the rate.
+
+Run from the project root:
+    python -m benchmarks.load_test [--messages N] [--rate N] [--command-rate F] [--send-latency-ms N]
+Other options are listed by --help.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+from contextlib import ExitStack
+from datetime import datetime, timedelta, timezone
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from benchmarks.corpus import make_chat_corpus
+from benchmarks.fake_discord import FakeBot, FakeUser, FakeMessage, FakeAttachment, FakeReference, \
+    FakeTextChannel, next_id
+from cheems import pictures
+from cheems.config import config
+from cheems.discord_helper import map_channel, map_server
+from cheems.markov import models_xml
+from cheems.markov.models_xml import MarkovStorage
+from cheems.markov.response_pool import response_pool
+from cheems.markov_cog import MarkovCog
+from cheems.metrics import metrics
+from cheems.pics_cog import PicsCog
+from cheems.proactive_markov_cog import ProactiveMarkovCog
+from cheems.proactive_react_cog import ProactiveReactCog
+from cheems.reaction import reactions
+from cheems.reaction.reactions import ReactionStorage
+from cheems.trainer import CheemsTrainer
+
+server_name = 'Load test'
+command_kinds = ['che', 'cho', 'ask', 'pic', 'mention', 'reply']
+'''Messages the bot responds to, picked evenly'''
+emoji = ['👍', '😂', '🤔', '<:cheems:1140041467432271952>']
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def _use_local_storage(stack: ExitStack, root_dir: str):
+    """Points the global storages of the cogs and the trainer into the directory"""
+    stack.enter_context(mock.patch.object(
+        models_xml, 'markov_storage', MarkovStorage(os.path.join(root_dir, 'markov'))))
+    stack.enter_context(mock.patch.object(
+        reactions, 'reaction_storage', ReactionStorage(os.path.join(root_dir, 'reactions'))))
+    stack.enter_context(mock.patch.object(pictures, '_db_dir', root_dir))
+    stack.enter_context(mock.patch.object(pictures, '_filename', os.path.join(root_dir, 'pics.db')))
+    # noinspection PyProtectedMember
+    stack.enter_context(mock.patch.object(pictures, '_con', pictures._get_db_connection()))
+    stack.callback(lambda: pictures._con.close())
+
+
+class LoadTest:
+    def __init__(self, options: argparse.Namespace):
+        self.options = options
+        self.rng = random.Random(0)
+        self.bot = FakeBot(send_latency=options.send_latency_ms / 1000)
+        self.guild = self.bot.create_guild(server_name)
+        self.users = [FakeUser(next_id(), f'user{i}', i) for i in range(options.users)]
+        self.channels = [self.guild.create_text_channel(f'channel{i}') for i in range(options.channels)]
+        self.corpus = make_chat_corpus(options.history * options.channels + options.messages)
+        self.texts = iter(self.corpus)
+        self.latencies: dict[str, list[float]] = {kind: [] for kind in ['chat'] + command_kinds}
+        self.response_count = 0
+        self.bot.on_response = self._on_response
+
+    def _on_response(self, channel: FakeTextChannel, content: str):
+        self.response_count += 1
+
+    def _make_message(self, channel: FakeTextChannel, created_at: datetime) -> FakeMessage:
+        msg = FakeMessage(next_id(), self.rng.choice(self.users), channel, next(self.texts), created_at)
+        if self.rng.random() < self.options.pic_rate:
+            attachment_id = next_id()
+            msg.attachments.append(FakeAttachment(attachment_id, f'https://cdn.example.com/{attachment_id}.png'))
+        return msg
+
+    def make_history(self):
+        start = datetime.now(tz=timezone.utc) - timedelta(days=1)
+        for channel in self.channels:
+            for i in range(self.options.history):
+                channel.messages.append(self._make_message(channel, start + timedelta(seconds=i)))
+
+    def make_reaction_models(self):
+        server = map_server(self.guild)
+        for target in [server] + [map_channel(channel) for channel in self.channels]:
+            model = reactions.create_model(target)
+            model.data = {e: self.rng.randint(1, 50) for e in emoji}
+
+    def make_live_message(self) -> tuple[str, FakeMessage]:
+        channel = self.rng.choice(self.channels)
+        msg = self._make_message(channel, datetime.now(tz=timezone.utc))
+        if self.rng.random() >= self.options.command_rate:
+            return 'chat', msg
+        kind = self.rng.choice(command_kinds)
+        text = msg.system_content
+        first_word = text.split(' ', 1)[0]
+        if kind == 'che':
+            if self.rng.random() < 0.5:
+                user = self.rng.choice(self.users)
+                msg.mentions.append(user)
+                msg.system_content = f'.che {user.mention}'
+            else:
+                msg.system_content = '.che'
+        elif kind == 'pic':
+            msg.system_content = f'.pic {first_word}'
+        elif kind in ['cho', 'ask']:
+            msg.system_content = f'.{kind} {text}'
+        else:
+            bot_message = self._find_bot_message(channel) if kind == 'reply' else None
+            if bot_message is not None:
+                msg.reference = FakeReference(bot_message)
+            else:
+                kind = 'mention'
+                msg.mentions.append(self.bot.user)
+                msg.system_content = f'{self.bot.user.mention} {text}'
+        msg.attachments.clear()
+        return kind, msg
+
+    def _find_bot_message(self, channel: FakeTextChannel):
+        for msg in reversed(channel.messages[-50:]):
+            if msg.author is self.bot.user:
+                return msg
+        return None
+
+    async def train(self) -> tuple[CheemsTrainer, float]:
+        """Scrapes the history, returns the seconds it took"""
+        trainer = CheemsTrainer(self.bot)
+        # saves aren't delayed, so their cost is included
+        trainer.save_period = timedelta(seconds=0)
+        start = time.perf_counter()
+        trainer.begin_training()
+        await trainer.wait_for_completion()
+        return trainer, time.perf_counter() - start
+
+    async def _train_continuously(self, trainer: CheemsTrainer, stop: asyncio.Event):
+        while not stop.is_set():
+            trainer.begin_training()
+            await trainer.wait_for_completion()
+            try:
+                await asyncio.wait_for(stop.wait(), self.options.train_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _handle(self, kind: str, msg: FakeMessage, due: float):
+        await self.bot.dispatch(msg)
+        self.latencies[kind].append(time.perf_counter() - due)
+
+    async def run_live(self, trainer: CheemsTrainer) -> float:
+        """Sends messages at the rate, returns the seconds until all were handled"""
+        for cog in [MarkovCog(self.bot), ProactiveMarkovCog(self.bot), ProactiveReactCog(self.bot), PicsCog(self.bot)]:
+            self.bot.add_cog(cog)
+        stop = asyncio.Event()
+        training = asyncio.create_task(self._train_continuously(trainer, stop))
+        interval = 1 / self.options.rate
+        handlers = []
+        start = time.perf_counter()
+        for i in range(self.options.messages):
+            due = start + i * interval
+            await asyncio.sleep(max(0.0, due - time.perf_counter()))
+            kind, msg = self.make_live_message()
+            handlers.append(asyncio.create_task(self._handle(kind, msg, due)))
+        await asyncio.gather(*handlers)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await training
+        # scraping continues until a channel has no new messages
+        pending = [task for task in trainer.tasks if not task.done()]
+        while len(pending) > 0:
+            await asyncio.wait(pending)
+            pending = [task for task in trainer.tasks if not task.done()]
+        await models_xml.flush_async()
+        return elapsed
+
+    def print_latencies(self):
+        print(f'{"message":10} {"count":>7} {"p50 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+        all_latencies = []
+        for kind, latencies in self.latencies.items():
+            all_latencies.extend(latencies)
+            self._print_row(kind, latencies)
+        self._print_row('all', all_latencies)
+
+    @staticmethod
+    def _print_row(name: str, latencies: list[float]):
+        if len(latencies) == 0:
+            return
+        latencies = sorted(latencies)
+        print(f'{name:10} {len(latencies):7} {percentile(latencies, 0.5) * 1000:9.2f} '
+              f'{percentile(latencies, 0.99) * 1000:9.2f} {latencies[-1] * 1000:9.2f}')
+
+
+def _print_stages():
+    """Latency of the stages of commands, from the metrics. Quantiles are upper bounds of histogram buckets."""
+    histograms = metrics.histograms.get('command_seconds', {})
+    if len(histograms) == 0:
+        return
+    print(f'\n{"command":16} {"stage":9} {"count":>7} {"p50 ms <=":>10} {"p99 ms <=":>10}')
+    for labels, histogram in sorted(histograms.items()):
+        label_dict = dict(labels)
+        print(f'{label_dict["command"]:16} {label_dict["stage"]:9} {histogram.count:7} '
+              f'{histogram.get_quantile(0.5) * 1000:10.1f} {histogram.get_quantile(0.99) * 1000:10.1f}')
+
+
+async def run(options: argparse.Namespace):
+    test = LoadTest(options)
+    test.make_history()
+    history_count = options.history * options.channels
+    trainer, train_seconds = await test.train()
+    print(f'Trained on {history_count} messages in {train_seconds:.2f}s: '
+          f'{history_count / train_seconds:.0f} messages/s')
+
+    test.make_reaction_models()
+    metrics.enabled = True
+    live_seconds = await test.run_live(trainer)
+    print(f'Handled {options.messages} messages at {options.rate:.0f}/s in {live_seconds:.2f}s: '
+          f'{options.messages / live_seconds:.0f} messages/s, {test.response_count} responses')
+    test.print_latencies()
+    _print_stages()
+    if response_pool.is_enabled:
+        print(f'\nResponse pool hit rate: {response_pool.stats.hit_rate * 100:.0f}%')
+
+
+def main(args: list[str] = None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.load_test', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--channels', type=int, default=4, help='text channels of the server')
+    parser.add_argument('--users', type=int, default=50, help='users posting messages')
+    parser.add_argument('--history', type=int, default=5000, help='messages in each channel before the test')
+    parser.add_argument('--messages', type=int, default=5000, help='messages sent during the test')
+    parser.add_argument('--rate', type=float, default=200, help='messages per second during the test')
+    parser.add_argument('--command-rate', type=float, default=0.2,
+                        help=f'fraction of messages the bot responds to: {", ".join(command_kinds)}')
+    parser.add_argument('--pic-rate', type=float, default=0.05, help='fraction of messages with a picture')
+    parser.add_argument('--send-latency-ms', type=float, default=0, help='simulated latency of Discord requests')
+    parser.add_argument('--proactive-period', type=int, default=20,
+                        help='messages in a channel between proactive replies and reactions')
+    parser.add_argument('--train-interval', type=float, default=1, help='seconds between scraping new messages')
+    parser.add_argument('--response-pool', type=int, default=0, help='responses kept for each target, 0 disables')
+    options = parser.parse_args(args)
+
+    # each message and chain is logged
+    logging.getLogger().setLevel(logging.WARNING)
+    server_config = {server_name: {}}
+    config.read_dict({
+        'training': {'message_limit': 100, 'wait_sec': 0, 'servers': server_config},
+        'proactive_reply': {'period_msgs': options.proactive_period, 'servers': server_config},
+        'proactive_react': {'period_msgs': options.proactive_period, 'servers': server_config},
+    })
+    with TemporaryDirectory() as root_dir, ExitStack() as stack:
+        _use_local_storage(stack, root_dir)
+        stack.enter_context(mock.patch.object(response_pool, 'size', options.response_pool))
+        asyncio.run(run(options))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
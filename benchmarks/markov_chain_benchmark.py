@@ -0,0 +1,91 @@
+"""
+Micro-benchmark for generating Markov chains on a large synthetic model.
+Compares picking next words via cached sampling tables against
+rebuilding the list of weights on every step.
+
+Run from the project root: `python -m benchmarks.markov_chain_benchmark`
+"""
+import random
+import time
+from unittest import mock
+
+from cheems.markov import markov
+from cheems.markov.markov import markov_chain, canonical_form, ENDS, punctuation
+from cheems.markov.model import ModelData, SENTENCE_START
+
+
+def make_synthetic_data(
+        vocab_size: int = 50000,
+        hub_count: int = 50,
+        hub_fanout: int = 5000,
+        fanout: int = 20,
+        seed: int = 0,
+) -> ModelData:
+    """
+    Builds a model where a few 'hub' words (like 'и' or 'the') are followed
+    by thousands of words, and the rest are followed by a few.
+    """
+    rng = random.Random(seed)
+    words = [f'w{i}' for i in range(vocab_size)]
+    data = ModelData()
+    for i, w in enumerate(words):
+        k = hub_fanout if i < hub_count else fanout
+        for _ in range(k):
+            # chains lead back into hubs often, like real speech does
+            if rng.random() < 0.3:
+                next_word = words[rng.randrange(hub_count)]
+            else:
+                next_word = words[rng.randrange(vocab_size)]
+            data.append(w, next_word, rng.randint(1, 50))
+        data.append(w, ENDS[0], 1)
+        if rng.random() < 0.1:
+            data.append(SENTENCE_START, w, rng.randint(1, 50))
+    return data
+
+
+def _uncached_pick_next_word(data: ModelData, first_word: str) -> str:
+    """The previous implementation, which scans the whole row on every step."""
+    first_word = canonical_form(first_word)
+    next_words = data[first_word] if first_word in data else []
+    if len(next_words) == 0:
+        return ENDS[0]
+    words: list[str] = []
+    weights: list[int] = []
+    for next_word, count in next_words.items():
+        words.append(next_word)
+        weights.append(count)
+    next_word = random.choices(words, weights)[0]
+    if next_word in ENDS:
+        return next_word
+    elif next_word[0] in punctuation:
+        return next_word[0] + ' ' + next_word[1:]
+    else:
+        return ' ' + next_word
+
+
+def _time_chains(data: ModelData, prompts: list[str], limit: int) -> float:
+    random.seed(1)
+    start = time.perf_counter()
+    for prompt in prompts:
+        markov_chain(data, prompt, limit=limit)
+    return time.perf_counter() - start
+
+
+def main(chain_count: int = 2000, limit: int = 50):
+    data = make_synthetic_data()
+    prompts = [f'w{i % 100}' for i in range(chain_count)]
+    print(f'Model: {len(data)} words, {sum(len(v) for v in data.values())} pairs')
+
+    with mock.patch.object(markov, '_pick_next_word', _uncached_pick_next_word):
+        before = _time_chains(data, prompts, limit)
+    print(f'before (rebuild weights): {before:.3f}s, {chain_count / before:.0f} chains/s')
+
+    cold = _time_chains(data, prompts, limit)
+    print(f'after (cold tables):      {cold:.3f}s, {chain_count / cold:.0f} chains/s')
+    warm = _time_chains(data, prompts, limit)
+    print(f'after (warm tables):      {warm:.3f}s, {chain_count / warm:.0f} chains/s')
+    print(f'speedup: {before / warm:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+Benchmark for loading the data of a large model:
+parsing the XML payload vs memory-mapping the '.bin' file.
+
+Run from the project root: `python -m benchmarks.model_load_benchmark`
+"""
+import os
+import time
+from datetime import datetime, timezone
+from tempfile import TemporaryDirectory
+
+from benchmarks.markov_chain_benchmark import make_synthetic_data
+from cheems.markov.markov import markov_chain
+from cheems.markov.model_bin import write_model_bin, get_bin_path
+from cheems.markov.model_xml import XmlModel
+from cheems.targets import Server
+
+
+def main():
+    now = datetime.now(tz=timezone.utc)
+    model = XmlModel(now, now, now, Server(1, 'Benchmark'), 'Benchmark', data=make_synthetic_data())
+    with TemporaryDirectory() as temp_dir:
+        xml_path = os.path.join(temp_dir, 'model.xml')
+        with open(xml_path, 'w', encoding='utf-8') as f:
+            f.write(model.to_xml())
+        print(f'XML file: {os.path.getsize(xml_path) / 2**20:.1f} MiB')
+
+        start = time.perf_counter()
+        loaded = XmlModel.from_xml_file(xml_path)
+        markov_chain(loaded.data)
+        print(f'xml: loaded and generated in {time.perf_counter() - start:.3f}s')
+
+        write_model_bin(model.data, get_bin_path(xml_path))
+        with open(xml_path, 'w', encoding='utf-8') as f:
+            f.write(model.to_xml(include_data=False))
+        print(f'bin file: {os.path.getsize(get_bin_path(xml_path)) / 2**20:.1f} MiB')
+
+        start = time.perf_counter()
+        loaded = XmlModel.from_xml_file(xml_path)
+        markov_chain(loaded.data)
+        print(f'bin: loaded and generated in {time.perf_counter() - start:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
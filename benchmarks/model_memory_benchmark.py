@@ -0,0 +1,39 @@
+"""
+Memory benchmark comparing the dict-based ModelData with CompactModelData
+on a realistic-size model, parsed from the same serialized payload.
+
+Run from the project root: `python -m benchmarks.model_memory_benchmark`
+"""
+import gc
+import time
+import tracemalloc
+
+from benchmarks.markov_chain_benchmark import make_synthetic_data
+from cheems.markov.compact_model_data import CompactModelData, Vocabulary
+from cheems.markov.model import Model, ModelData
+
+
+def _measure(name: str, parse, text: str, pair_count: int):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    data = parse(text)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:8} {current / 2**20:8.1f} MiB resident, {peak / 2**20:8.1f} MiB peak, '
+          f'{current / pair_count:6.1f} bytes/pair, parsed in {elapsed:.2f}s')
+    return data
+
+
+def main():
+    # a big server model: 50k words, ~1.2M pairs
+    text = Model._serialize_data(make_synthetic_data())
+    pair_count = text.count('\n') + 1
+    print(f'Model: {pair_count} pairs, payload {len(text) / 2**20:.1f} MiB')
+    _measure('dict', lambda t: ModelData.parse(t, 9999), text, pair_count)
+    _measure('compact', lambda t: CompactModelData.parse(t, 9999, Vocabulary()), text, pair_count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark for higher-order Markov models: memory and generation latency of orders 1 to 3,
+trained on the same synthetic chat corpus. N-grams are stored in the trie of `NGramData`,
+and for comparison also in a plain dict of context tuples, as a straightforward implementation would.
+
+Run from the project root: `python -m benchmarks.ngram_benchmark [message_count]`
+"""
+import gc
+import random
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+from benchmarks.corpus import make_chat_corpus
+from cheems.markov.compact_model_data import Vocabulary
+from cheems.markov.markov import count_word_pairs, count_word_ngrams, markov_chain
+from cheems.markov.model import ModelData
+from cheems.markov.ngram_data import NGramData
+
+
+def _dict_of_contexts(counts: Counter) -> dict[tuple[str, ...], dict[str, int]]:
+    """The straightforward storage: next word counts by context tuple"""
+    contexts: dict[tuple[str, ...], dict[str, int]] = {}
+    for ngram, count in counts.items():
+        next_words = contexts.setdefault(ngram[:-1], {})
+        next_words[ngram[-1]] = next_words.get(ngram[-1], 0) + count
+    return contexts
+
+
+def _measure_memory(build) -> tuple[object, int]:
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current
+
+
+def _time_chains(data: ModelData, ngrams: NGramData, chain_count: int) -> float:
+    random.seed(1)
+    start = time.perf_counter()
+    for _ in range(chain_count):
+        markov_chain(data, ngrams=ngrams)
+    return time.perf_counter() - start
+
+
+def main(message_count: int = 50000, chain_count: int = 2000):
+    corpus = make_chat_corpus(message_count)
+
+    def build_pairs() -> ModelData:
+        result = ModelData()
+        result.append_pairs(count_word_pairs(corpus))
+        return result
+
+    data, pairs_bytes = _measure_memory(build_pairs)
+    print(f'Corpus: {message_count} messages, {data.pair_count} pairs, '
+          f'{pairs_bytes / 2**20:.1f} MiB as dict')
+
+    for order in (1, 2, 3):
+        if order == 1:
+            ngrams, ngram_count, trie_bytes, dict_bytes = None, 0, 0, 0
+        else:
+            counts = count_word_ngrams(corpus, order)
+            ngram_count = len(counts)
+
+            def build() -> NGramData:
+                result = NGramData(order, Vocabulary())
+                result.append_ngrams(counts)
+                result.compact()
+                return result
+
+            ngrams, trie_bytes = _measure_memory(build)
+            _, dict_bytes = _measure_memory(lambda: _dict_of_contexts(counts))
+        elapsed = _time_chains(data, ngrams, chain_count)
+        per_ngram = f'{trie_bytes / ngram_count:5.1f} B/ngram trie, ' \
+                    f'{dict_bytes / ngram_count:5.1f} B/ngram dict' if ngram_count > 0 else ''
+        print(f'order {order}: {ngram_count:8} n-grams, {trie_bytes / 2**20:6.1f} MiB trie, '
+              f'{dict_bytes / 2**20:6.1f} MiB dict, {per_ngram:37} '
+              f'{elapsed / chain_count * 1e6:6.0f} µs/chain')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
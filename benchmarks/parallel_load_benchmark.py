@@ -0,0 +1,54 @@
+"""
+Startup benchmark for loading a directory of models with data, as training does,
+with a varying number of loader processes.
+
+Run from the project root: `python -m benchmarks.parallel_load_benchmark [model_count] [pairs_per_model]`
+By default creates 40 models of 100k word pairs each.
+"""
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from tempfile import TemporaryDirectory
+
+from cheems.base_xml_data_model import BaseXmlDataModel
+from cheems.markov.models_xml import MarkovStorage
+from cheems.targets import Server, User
+
+
+def _random_payload(pair_count: int, rng: random.Random) -> str:
+    lines = set()
+    while len(lines) < pair_count:
+        lines.add(f'w{rng.randrange(50000)} w{rng.randrange(50000)} {rng.randint(1, 50)}')
+    return '\n'.join(sorted(lines))
+
+
+def make_model_dir(root_dir: str, model_count: int, pairs_per_model: int):
+    rng = random.Random(0)
+    now = datetime.now(tz=timezone.utc)
+    server = Server(1, 'Benchmark')
+    storage = MarkovStorage(root_dir)
+    for i in range(model_count):
+        target = server if i == 0 else User(i, f'user{i}', 1000, server)
+        m = storage.create_model(target)
+        base = BaseXmlDataModel(now, now, now, target, str(target), file_path=m.file_path,
+                                raw_data=_random_payload(pairs_per_model, rng))
+        with open(m.file_path, 'w', encoding='utf-8') as f:
+            f.write(base.to_xml())
+
+
+def main(model_count: int = 40, pairs_per_model: int = 100000):
+    with TemporaryDirectory() as root_dir:
+        make_model_dir(root_dir, model_count, pairs_per_model)
+        print(f'{model_count} models of {pairs_per_model} pairs, {os.cpu_count()} CPUs')
+        worker_counts = sorted({1, 2, 4, os.cpu_count() or 1})
+        for workers in worker_counts:
+            start = time.perf_counter()
+            storage = MarkovStorage(root_dir)
+            storage.load_models(workers=workers)
+            print(f'{workers} workers: {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
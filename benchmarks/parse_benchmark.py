@@ -0,0 +1,56 @@
+"""
+Throughput benchmark for parsing the serialized data of a large model:
+the line-by-line parser (as before) vs splitting the text in chunks and slicing sorted rows.
+
+Run from the project root: `python -m benchmarks.parse_benchmark`
+"""
+import gc
+import time
+import tracemalloc
+from typing import Callable
+
+from benchmarks.markov_chain_benchmark import make_synthetic_data
+from cheems.markov.compact_model_data import CompactModelData, Vocabulary
+from cheems.markov.model import Model
+from cheems.markov.model_data import ModelData
+
+
+def _parse_line_by_line(text: str, max_weight: int) -> ModelData:
+    """The parser before this optimization"""
+    data = ModelData()
+    for line in text.strip().splitlines():
+        (first_word, next_word, count) = line.strip().split(' ')
+        weight = min(int(count), max_weight)  # limit word count
+        data.setdefault(first_word, {})
+        next_words = data[first_word]
+        next_words.setdefault(next_word, 0)
+        next_words[next_word] += weight
+    return data
+
+
+def _measure(name: str, parse: Callable[[], object], line_count: int, repeat: int = 3):
+    best = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        parse()
+        best = min(best, time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    parse()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:14} {line_count / best / 1e6:5.2f}M lines/s, {peak / 2**20:7.1f} MiB peak')
+
+
+def main():
+    text = Model._serialize_data(make_synthetic_data())
+    line_count = text.count('\n') + 1
+    print(f'Model: {line_count} lines, payload {len(text) / 2**20:.1f} MiB')
+    _measure('line by line', lambda: _parse_line_by_line(text, 9999), line_count)
+    _measure('dict', lambda: ModelData.parse(text, 9999), line_count)
+    _measure('compact', lambda: CompactModelData.parse(text, 9999, Vocabulary()), line_count)
+
+
+if __name__ == '__main__':
+    main()
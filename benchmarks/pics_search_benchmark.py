@@ -0,0 +1,110 @@
+"""
+Benchmark for `.pic` prompts on a large pictures database: `get_pics_where(word=...)` as `.pic` calls it,
+in a random order with a limit of 1, before (`lower(msg) like "%word%"`, scanning the table)
+and after the FTS5 trigram index of captions. Also measures indexing an existing database.
+
+Captions come from a synthetic chat, with its words 'word0', 'word1'... replaced by random letters,
+because words that share substrings would match each other's trigrams, unlike real words.
+Prompts are the words of another part of the chat, so the most common ones match a large share
+of the captions, where the index is no faster than a scan. Rare and missing words are reported separately.
+
+Run from the project root: `python -m benchmarks.pics_search_benchmark [row_count] [query_count]`
+"""
+import os
+import random
+import re
+import sqlite3
+import string
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from benchmarks.corpus import make_chat_corpus
+from cheems import pictures
+
+
+def _make_words(vocab_size: int = 5000) -> dict[str, str]:
+    rng = random.Random(0)
+    return {f'word{i}': ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9))) for i in range(vocab_size)}
+
+
+def _replace_words(text: str, words: dict[str, str]) -> str:
+    return re.sub(r'word\d+', lambda m: words[m.group(0)], text)
+
+
+def _make_db(filename: str, row_count: int, words: dict[str, str]):
+    """Database without the full-text index, as before"""
+    captions = [_replace_words(message, words) for message in make_chat_corpus(min(row_count, 100000))]
+    rng = random.Random(0)
+    time_0 = datetime(2022, 1, 1, tzinfo=timezone.utc)
+    con = sqlite3.connect(filename)
+    # noinspection PyProtectedMember
+    con.executescript(pictures._create_tables)
+    con.executemany('INSERT INTO pics values (?, ?, ?, ?, ?, ?, ?, ?)', (
+        (
+            i, f'https://cdn.example.com/{i}.png',
+            # noinspection PyProtectedMember
+            pictures._sanitize_str_for_db(rng.choice(captions)) if rng.random() < 0.5 else '',
+            time_0 + timedelta(seconds=i), rng.randrange(1000), rng.randrange(100), rng.randrange(10), True
+        )
+        for i in range(row_count)
+    ))
+    con.commit()
+    con.close()
+
+
+def _measure(name: str, prompt_groups: dict[str, list[str]]):
+    random.seed(1)
+    results = []
+    for group, prompts in prompt_groups.items():
+        found = 0
+        start = time.perf_counter()
+        for i, prompt in enumerate(prompts):
+            pics = pictures.get_pics_where(server_id=i % 10, word=prompt, random=True, limit=1)
+            found += len(pics)
+        elapsed = time.perf_counter() - start
+        results.append(f'{group} {elapsed / len(prompts) * 1000:7.2f} ms ({found}/{len(prompts)} found)')
+    print(f'{name:8} ' + ', '.join(results))
+
+
+def _get_prompt_groups(query_count: int, words: dict[str, str]) -> dict[str, list[str]]:
+    """Prompts from another part of the chat, by how many captions contain them"""
+    rng = random.Random(2)
+    prompts = [rng.choice(message.split(' ')) for message in make_chat_corpus(query_count, seed=1)]
+    prompts = [_replace_words(prompt, words) for prompt in prompts if re.fullmatch(r'word\d+', prompt)]
+    # words are ranked by frequency, like 'word0' > 'word1'
+    ranks = {word: int(key[4:]) for key, word in words.items()}
+    return {
+        'common': [p for p in prompts if ranks[p] < 100],
+        'rare': [p for p in prompts if ranks[p] >= 100],
+        'missing': [f'missing{i}' for i in range(max(1, query_count // 10))],
+    }
+
+
+def main(row_count: int = 1000000, query_count: int = 200):
+    words = _make_words()
+    prompt_groups = _get_prompt_groups(query_count, words)
+    with TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, 'pics.db')
+        start = time.perf_counter()
+        _make_db(filename, row_count, words)
+        print(f'Created {row_count} pictures in {time.perf_counter() - start:.1f}s, '
+              f'{os.path.getsize(filename) / 2 ** 20:.0f} MiB')
+
+        with mock.patch.object(pictures, '_filename', filename), mock.patch.object(pictures, '_db_dir', temp_dir):
+            # the database is indexed on opening
+            start = time.perf_counter()
+            # noinspection PyProtectedMember
+            con = pictures._get_db_connection()
+            print(f'Indexed in {time.perf_counter() - start:.1f}s, {os.path.getsize(filename) / 2 ** 20:.0f} MiB')
+            with mock.patch.object(pictures, '_con', con):
+                with mock.patch.object(pictures, '_has_fts', False):
+                    _measure('before', prompt_groups)
+                _measure('after', prompt_groups)
+            con.close()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,72 @@
+"""
+Startup benchmark for preloading a directory of models, i.e. reading their headers:
+parsing whole files vs stream-parsing only up to <data>.
+
+Run from the project root: `python -m benchmarks.preload_benchmark [model_count] [big_count] [big_mib]`
+By default creates 2000 small models and 20 models of 20 MiB each.
+"""
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from tempfile import TemporaryDirectory
+
+from cheems.base_xml_data_model import BaseXmlDataModel
+from cheems.markov.models_xml import MarkovStorage
+from cheems.targets import Server, User
+
+
+def _random_payload(size_bytes: int, rng: random.Random) -> str:
+    lines = []
+    size = 0
+    while size < size_bytes:
+        line = f'w{rng.randrange(50000)} w{rng.randrange(50000)} {rng.randint(1, 50)}'
+        lines.append(line)
+        size += len(line) + 1
+    return '\n'.join(sorted(lines))
+
+
+def make_model_dir(root_dir: str, model_count: int, big_count: int, big_mib: float):
+    rng = random.Random(0)
+    now = datetime.now(tz=timezone.utc)
+    server = Server(1, 'Benchmark')
+    storage = MarkovStorage(root_dir)
+    big_payload = _random_payload(int(big_mib * 2**20), rng)
+    small_payload = _random_payload(2000, rng)
+    for i in range(model_count):
+        target = server if i == 0 else User(i, f'user{i}', 1000, server)
+        m = storage.create_model(target)
+        base = BaseXmlDataModel(now, now, now, target, str(target), file_path=m.file_path,
+                                raw_data=big_payload if i < big_count else small_payload)
+        with open(m.file_path, 'w', encoding='utf-8') as f:
+            f.write(base.to_xml())
+
+
+def _full_parse_preload(root_dir: str) -> int:
+    """The previous implementation: read and parse whole files, then drop the data"""
+    count = 0
+    for subdir, _, files in os.walk(root_dir):
+        for file in files:
+            with open(os.path.join(subdir, file), encoding='utf-8') as f:
+                BaseXmlDataModel.from_xml(f.read(), load_data=False)
+            count += 1
+    return count
+
+
+def main(model_count: int = 2000, big_count: int = 20, big_mib: float = 20):
+    with TemporaryDirectory() as root_dir:
+        make_model_dir(root_dir, model_count, big_count, big_mib)
+        print(f'{model_count} models, {big_count} of them {big_mib} MiB')
+
+        start = time.perf_counter()
+        _full_parse_preload(root_dir)
+        print(f'before (full parse): {time.perf_counter() - start:.2f}s')
+
+        start = time.perf_counter()
+        MarkovStorage(root_dir).preload_models()
+        print(f'after (header only): {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    main(*[float(arg) if '.' in arg else int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,73 @@
+"""
+Benchmark for continuing prompts, like `.ask` and replies do: how often `_markov_chain_with_retry`
+has to rerun the chain, before (retrying whenever the chain ends right after the prompt)
+and after dead-end-aware generation (continuing past ENDS, and skipping retries for dead-end prompts).
+
+Prompts are words of a synthetic chat, weighted like in chat, with some words the model hasn't seen.
+
+Run from the project root: `python -m benchmarks.retry_benchmark [prompt_count]`
+"""
+import logging
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from unittest import mock
+
+from benchmarks.corpus import make_chat_corpus
+from cheems import markov_cog
+from cheems.markov import markov
+from cheems.markov.markov import count_word_pairs, get_last_word
+from cheems.markov.model import Model, ModelData
+from cheems.targets import Server
+
+
+def _legacy_pick_continuation(data: ModelData, word: str):
+    """Picking the next word as before, when the chain could end right after the prompt"""
+    return data.get_random_next_word(word)
+
+
+def _measure(name: str, model: Model, prompts: list[str]):
+    chain_count = 0
+    markov_chain = markov_cog.markov_chain
+
+    def counting_markov_chain(*args, **kwargs) -> str:
+        nonlocal chain_count
+        chain_count += 1
+        return markov_chain(*args, **kwargs)
+
+    random.seed(1)
+    retried = 0
+    with mock.patch.object(markov_cog, 'markov_chain', counting_markov_chain):
+        start = time.perf_counter()
+        for prompt in prompts:
+            before = chain_count
+            markov_cog._markov_chain_with_retry(model, prompt)
+            if chain_count - before > 1:
+                retried += 1
+        elapsed = time.perf_counter() - start
+    print(f'{name:8} {retried / len(prompts) * 100:5.1f}% prompts retried, '
+          f'{chain_count / len(prompts):5.2f} chains/prompt, {elapsed / len(prompts) * 1e6:6.0f} µs/prompt')
+
+
+def main(prompt_count: int = 5000):
+    # each chain is logged
+    logging.getLogger(markov_cog.__name__).setLevel(logging.WARNING)
+    corpus = make_chat_corpus(20000)
+    data = ModelData()
+    data.append_pairs(count_word_pairs(corpus))
+    time_0 = datetime(2022, 1, 1, tzinfo=timezone.utc)
+    model = Model(time_0, time_0, time_0, Server(1, 'benchmark'), '', data)
+    # prompts from another part of the chat, so some words are unknown
+    prompts = [get_last_word(message) for message in make_chat_corpus(prompt_count, seed=1)]
+    prompts = [prompt for prompt in prompts if len(prompt) > 0]
+    print(f'Model: {data.pair_count} pairs, {len(prompts)} prompts')
+
+    with mock.patch.object(markov, '_pick_continuation', _legacy_pick_continuation), \
+            mock.patch.object(ModelData, 'is_non_terminal', lambda self, word: True):
+        _measure('before', model, prompts)
+    _measure('after', model, prompts)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
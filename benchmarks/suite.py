@@ -0,0 +1,249 @@
+"""
+Benchmark suite for each stage of the bot's work on a synthetic chat (see benchmarks/corpus.py):
+tokenizing messages, training models, generating chains, parsing and serializing model data,
+and saving and loading a directory of models. It runs offline, without Discord.
+
+Each scenario reports the best time of a few runs. Results can be saved as JSON,
+and compared against a baseline from an earlier run, failing if a scenario got slower than the threshold.
+
+Run from the project root:
+    python -m benchmarks.suite [--messages N] [--repeat N] [--only tokenize,train,...]
+        [--output results.json] [--baseline baseline.json] [--threshold 0.2]
+Options of the synthetic chat, like --vocab-size or --url-rate, are listed by --help.
+To update the baseline, save the results of a run on the same machine with `--output`.
+"""
+import argparse
+import dataclasses
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
+from tempfile import TemporaryDirectory
+from typing import Callable, Optional
+
+from benchmarks.corpus import make_chat_corpus, CorpusOptions
+from cheems.markov.markov import _break_into_words, canonical_form, count_word_pairs, markov_chain, \
+    train_model_groups
+from cheems.markov.model import Model, ModelData
+from cheems.markov.model_xml import XmlModel
+from cheems.markov.models_xml import MarkovStorage
+from cheems.targets import Server, User
+
+server = Server(1, 'Benchmark')
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    seconds: float
+    '''Best time of the runs'''
+    items: int
+    unit: str
+    '''What the items are, e.g. messages or pairs'''
+
+    @property
+    def items_per_second(self) -> float:
+        return self.items / self.seconds if self.seconds > 0 else 0.0
+
+
+class Workload:
+    """Inputs of the scenarios, built once from the corpus"""
+    corpus: list[str]
+    data: ModelData
+    '''Model trained on the whole corpus'''
+    serialized: str
+    user_messages: list[list[str]]
+    '''Messages split between users, for the storage'''
+
+    def __init__(self, message_count: int, user_count: int, options: CorpusOptions):
+        self.corpus = make_chat_corpus(message_count, options=options)
+        self.data = ModelData()
+        self.data.append_pairs(count_word_pairs(self.corpus))
+        self.serialized = Model._serialize_data(self.data)
+        rng = random.Random(0)
+        self.user_messages = [[] for _ in range(user_count)]
+        for message in self.corpus:
+            self.user_messages[rng.randrange(user_count)].append(message)
+        self._temp_dir = TemporaryDirectory()
+        self.saved_dir = os.path.join(self._temp_dir.name, 'saved')
+        save_models(self.saved_dir, self.user_messages)
+
+    def cleanup(self):
+        self._temp_dir.cleanup()
+
+
+def save_models(root_dir: str, user_messages: list[list[str]]):
+    """Trains and saves a server model and a model for each user"""
+    storage = MarkovStorage(root_dir)
+    server_model = storage.create_model(server)
+    models = []
+    for i, messages in enumerate(user_messages):
+        models.append(storage.create_model(User(i + 1, f'user{i + 1}', 1000, server)))
+    train_model_groups([([server_model.data, m.data], messages) for m, messages in zip(models, user_messages)])
+    for m in [server_model] + models:
+        storage.save_model(m)
+
+
+Scenario = Callable[[Workload], tuple[Callable[[], None], int, str]]
+'''Prepares a run of the scenario on the workload, and returns it with the number of items it processes'''
+
+
+def tokenize(w: Workload):
+    def run():
+        for message in w.corpus:
+            for word in _break_into_words(message):
+                canonical_form(word)
+
+    return run, len(w.corpus), 'messages'
+
+
+def train(w: Workload):
+    def run():
+        data = ModelData()
+        data.append_pairs(count_word_pairs(w.corpus))
+
+    return run, len(w.corpus), 'messages'
+
+
+def generate(w: Workload):
+    chain_count = 2000
+
+    def run():
+        random.seed(1)
+        for _ in range(chain_count):
+            markov_chain(w.data)
+
+    return run, chain_count, 'chains'
+
+
+def parse(w: Workload):
+    return lambda: Model.parse_data(w.serialized), w.data.pair_count, 'pairs'
+
+
+def serialize(w: Workload):
+    now = datetime.now(tz=timezone.utc)
+    model = XmlModel(now, now, now, server, 'Benchmark', data=w.data)
+    return lambda: model.to_xml(), w.data.pair_count, 'pairs'
+
+
+def storage_save(w: Workload):
+    def run():
+        with TemporaryDirectory() as root_dir:
+            save_models(root_dir, w.user_messages)
+
+    return run, len(w.user_messages) + 1, 'models'
+
+
+def storage_load(w: Workload):
+    return lambda: MarkovStorage(w.saved_dir).load_models(workers=1), len(w.user_messages) + 1, 'models'
+
+
+scenarios: dict[str, Scenario] = {
+    'tokenize': tokenize,
+    'train': train,
+    'generate': generate,
+    'parse': parse,
+    'serialize': serialize,
+    'storage_save': storage_save,
+    'storage_load': storage_load,
+}
+
+
+def run_scenario(name: str, workload: Workload, repeat: int) -> ScenarioResult:
+    run, items, unit = scenarios[name](workload)
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return ScenarioResult(name, min(times), items, unit)
+
+
+def compare(results: list[ScenarioResult], baseline: dict, threshold: float) -> list[str]:
+    """
+    Returns descriptions of the scenarios that are slower than in the baseline by more than the threshold,
+    e.g. 0.2 allows 20% slower. Scenarios missing in the baseline are skipped.
+    """
+    regressions = []
+    baseline_seconds = {r['name']: r['seconds'] for r in baseline.get('scenarios', [])}
+    for result in results:
+        before = baseline_seconds.get(result.name, None)
+        if before is None or before <= 0:
+            continue
+        ratio = result.seconds / before
+        if ratio > 1 + threshold:
+            regressions.append(f'{result.name}: {before:.3f}s -> {result.seconds:.3f}s ({(ratio - 1) * 100:+.0f}%)')
+    return regressions
+
+
+def main(args: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.suite', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--messages', type=int, default=20000, help='size of the synthetic chat')
+    parser.add_argument('--users', type=int, default=50, help='models of users in the storage scenarios')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each scenario, the best is reported')
+    parser.add_argument('--only', help=f'comma-separated scenarios, of: {", ".join(scenarios.keys())}')
+    parser.add_argument('--output', help='save results as JSON into this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='fraction by which a scenario can be slower than the baseline, default 0.2')
+    for corpus_field in dataclasses.fields(CorpusOptions):
+        parser.add_argument(f'--{corpus_field.name.replace("_", "-")}', type=corpus_field.type,
+                            default=corpus_field.default, help='synthetic chat option, see benchmarks/corpus.py')
+    options = parser.parse_args(args)
+
+    names = list(scenarios.keys()) if options.only is None else options.only.split(',')
+    for name in names:
+        if name not in scenarios:
+            parser.error(f'Unknown scenario: {name}')
+    corpus_options = CorpusOptions(**{f.name: getattr(options, f.name) for f in dataclasses.fields(CorpusOptions)})
+    baseline: Optional[dict] = None
+    if options.baseline is not None:
+        with open(options.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    # models are created and loaded many times
+    logging.getLogger('cheems').setLevel(logging.WARNING)
+    workload = Workload(options.messages, options.users, corpus_options)
+    try:
+        print(f'{options.messages} messages, {workload.data.pair_count} pairs, best of {options.repeat} runs')
+        results = []
+        for name in names:
+            result = run_scenario(name, workload, options.repeat)
+            results.append(result)
+            print(f'{name:14} {result.seconds:8.3f}s {result.items_per_second:12.0f} {result.unit}/s')
+    finally:
+        workload.cleanup()
+
+    if options.output is not None:
+        with open(options.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'created_at': datetime.now(tz=timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'messages': options.messages,
+                'users': options.users,
+                'repeat': options.repeat,
+                'corpus': corpus_options.to_dict(),
+                'scenarios': [{**asdict(r), 'items_per_second': r.items_per_second} for r in results],
+            }, f, indent=2)
+    if baseline is not None:
+        if baseline.get('messages') != options.messages or baseline.get('corpus') != corpus_options.to_dict():
+            print('Warning: the baseline was run on a different corpus')
+        regressions = compare(results, baseline, options.threshold)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if len(regressions) > 0:
+            return 1
+        print(f'No regressions above {options.threshold * 100:.0f}%')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
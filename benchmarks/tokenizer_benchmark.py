@@ -0,0 +1,70 @@
+"""
+Benchmark for breaking chat messages into words and training on them:
+the tokenizer with a regex pass per step and callbacks (as before) vs precompiled templates,
+with and without the cache of canonical forms.
+
+Run from the project root: `python -m benchmarks.tokenizer_benchmark [message_count]`
+"""
+import re
+import sys
+import time
+
+from benchmarks.corpus import make_chat_corpus
+from cheems.markov import markov
+from cheems.markov.markov import re_bad_punctuation, re_punctuation, re_ENDS, re_punctuation_except_END, \
+    url_pattern, _break_into_words, canonical_form
+
+
+def _legacy_break_into_words(sentence: str) -> list[str]:
+    """The tokenizer before this optimization"""
+    sentence = re.sub(r'```.*```', '', sentence, flags=re.DOTALL)
+    sentence = sentence.strip()
+    sentence = url_pattern.sub('', sentence)
+    sentence = sentence.replace('\n', ' ')
+    sentence = re.sub(r'[ᅟ\s]+', ' ', sentence)
+    sentence = re.sub(rf'[{re_bad_punctuation}]+', ' ', sentence)
+    sentence = sentence.replace('\u200b', '')
+    sentence = re.sub(rf'([{re_punctuation}]+)', lambda m: m.group(0)[0], sentence)
+    sentence = re.sub(rf'(\S)([{re_ENDS}]) ', lambda m: f'{m.group(1)} {m.group(2)} ', sentence)
+    sentence = re.sub(rf'\s?([{re_punctuation_except_END}]+)\s', lambda m: f' {m.group(1)}', sentence)
+    return [w for w in sentence.split(' ') if len(w) > 0]
+
+
+def _measure(name: str, corpus: list[str], tokenize, canonical):
+    start = time.perf_counter()
+    for message in corpus:
+        for word in tokenize(message):
+            canonical(word)
+    elapsed = time.perf_counter() - start
+    print(f'{name:20} {len(corpus) / elapsed:9.0f} msgs/s')
+
+
+def main(message_count: int = 100000):
+    corpus = make_chat_corpus(message_count)
+    mismatches = sum(1 for m in corpus if _break_into_words(m) != _legacy_break_into_words(m))
+    print(f'{message_count} messages, {mismatches} tokenized differently')
+    uncached_canonical_form = canonical_form.__wrapped__
+
+    # the legacy canonical form, with its regex passes:
+    def legacy_strip_punctuation(text: str) -> str:
+        if markov.re_command.match(text) is not None:
+            return text
+        text = re.sub(rf'^[{re_punctuation}]+', '', text).strip()
+        return re.sub(rf'[{re_punctuation}]+$', '', text).strip()
+
+    def legacy_canonical_form(word: str) -> str:
+        word = word.lower().strip()
+        if word in markov.ENDS:
+            return word
+        word = legacy_strip_punctuation(word)
+        return word if len(word) > 0 else markov.ENDS[0]
+
+    _measure('before', corpus, _legacy_break_into_words, legacy_canonical_form)
+    _measure('after, no cache', corpus, _break_into_words, uncached_canonical_form)
+    canonical_form.cache_clear()
+    _measure('after', corpus, _break_into_words, canonical_form)
+    print(canonical_form.cache_info())
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
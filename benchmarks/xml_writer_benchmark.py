@@ -0,0 +1,72 @@
+"""
+Benchmark for saving a large model into an XML file:
+building the string and pretty-printing it via minidom (as before) vs streaming it into the file.
+
+Run from the project root: `python -m benchmarks.xml_writer_benchmark`
+"""
+import gc
+import os
+import time
+import tracemalloc
+import xml.dom.minidom
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from tempfile import TemporaryDirectory
+from typing import Callable
+from xml.sax.saxutils import unescape
+
+from benchmarks.markov_chain_benchmark import make_synthetic_data
+from cheems.markov.model_xml import XmlModel
+from cheems.model_writer import write_file_atomically
+from cheems.targets import Server
+
+
+def _legacy_to_xml(model: XmlModel) -> str:
+    """The serializer before streaming, with its minidom round-trip"""
+    root = model.header_to_xml()
+    lines = []
+    for first_word, next_words in model.data.items():
+        for next_word, count in next_words.items():
+            lines.append(f'{first_word} {next_word} {count}')
+    raw_data = '\n'.join(sorted(lines))
+    ET.SubElement(root, 'data').text = f'<![CDATA[\n{raw_data}\n]]>'
+    raw_str = unescape(ET.tostring(root, 'utf-8', xml_declaration=True).decode())
+    dom = xml.dom.minidom.parseString(raw_str)
+    return dom.toprettyxml(encoding='utf-8').decode()
+
+
+def _measure(name: str, save: Callable[[], None]):
+    gc.collect()
+    start = time.perf_counter()
+    save()
+    elapsed = time.perf_counter() - start
+    # tracing slows down the save, so it's timed separately
+    gc.collect()
+    tracemalloc.start()
+    save()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:8} {peak / 2**20:8.1f} MiB peak, saved in {elapsed:.2f}s')
+
+
+def main():
+    now = datetime.now(tz=timezone.utc)
+    model = XmlModel(now, now, now, Server(1, 'Benchmark'), 'Benchmark', data=make_synthetic_data())
+    with TemporaryDirectory() as temp_dir:
+        legacy_path = os.path.join(temp_dir, 'legacy.xml')
+        xml_path = os.path.join(temp_dir, 'model.xml')
+
+        def save_legacy():
+            with open(legacy_path, 'w', encoding='utf-8') as f:
+                f.write(_legacy_to_xml(model))
+
+        print(f'Model: {model.data.pair_count} pairs')
+        _measure('before', save_legacy)
+        print(f'XML file: {os.path.getsize(legacy_path) / 2**20:.1f} MiB')
+        _measure('after', lambda: write_file_atomically(xml_path, model.write_xml))
+        with open(legacy_path, 'rb') as f1, open(xml_path, 'rb') as f2:
+            print(f'Identical output: {f1.read() == f2.read()}')
+
+
+if __name__ == '__main__':
+    main()
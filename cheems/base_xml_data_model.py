@@ -1,10 +1,10 @@
+import io
 import logging
-import xml.dom.minidom
 import xml.etree.ElementTree as ET
-from dataclasses import dataclass
+import dataclasses
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
-from typing import Optional
-from xml.sax.saxutils import unescape
+from typing import Optional, BinaryIO, Iterable, Iterator, TextIO
 
 from cheems.targets import Target, User, Server, Channel, Topic
 
@@ -32,6 +32,9 @@ class BaseXmlDataModel:
     is_data_loaded: bool = True
     '''If False, data needs to be loaded from file'''
 
+    has_unsaved_changes: bool = field(default=False, compare=False)
+    '''If True, data can't be unloaded until the model is saved'''
+
     @property
     def server_id(self) -> int:
         return self.target.server_id
@@ -39,17 +42,33 @@ class BaseXmlDataModel:
     @classmethod
     def from_xml_file(cls, file_path: str, load_data: bool = True) -> 'BaseXmlDataModel':
         try:
+            return cls._read_xml_file(file_path, load_data)
+        except Exception:
+            logger.exception(f'parsing XML model: {file_path}')
+
+    @classmethod
+    def _read_xml_file(cls, file_path: str, load_data: bool = True) -> 'BaseXmlDataModel':
+        """
+        :param load_data: if false, only the header is parsed,
+            and the file is read only up to the <data> tag.
+        """
+        if load_data:
             with open(file_path, encoding='utf-8') as f:
                 xml_str = f.read()
             m = cls.from_xml(xml_str, load_data)
-            m.file_path = file_path
-            return m
-        except Exception:
-            logger.exception(f'parsing XML model: {file_path}')
+        else:
+            with open(file_path, 'rb') as f:
+                xml = _read_xml_header(f)
+            m = cls._from_xml_element(xml, load_data)
+        m.file_path = file_path
+        return m
 
     @classmethod
     def from_xml(cls, xml_str: str, load_data: bool = True) -> 'BaseXmlDataModel':
-        xml = ET.fromstring(xml_str)
+        return cls._from_xml_element(ET.fromstring(xml_str), load_data)
+
+    @classmethod
+    def _from_xml_element(cls, xml: ET.Element, load_data: bool) -> 'BaseXmlDataModel':
         format_version = int(xml.attrib['format_version'])
         if format_version >= 1:
             from_time = datetime.fromisoformat(xml.attrib['from_time']).replace(tzinfo=timezone.utc)
@@ -68,8 +87,9 @@ class BaseXmlDataModel:
         return BaseXmlDataModel(from_time, to_time, updated_time, target, description, raw_data,
                                 is_data_loaded=is_data_loaded)
 
-    def to_xml(self, pretty_print: bool = True) -> str:
-        root = ET.Element('model', {
+    def header_to_xml(self, tag: str = 'model') -> ET.Element:
+        """Returns the XML element with everything except data"""
+        root = ET.Element(tag, {
             'format_version': str(XML_FORMAT_VERSION),
             'from_time': self.from_time.isoformat(' '),
             'to_time': self.to_time.isoformat(' '),
@@ -77,14 +97,60 @@ class BaseXmlDataModel:
         })
         _target_to_xml(root, self.target)
         ET.SubElement(root, 'description').text = self.description
-        ET.SubElement(root, 'data').text = f'<![CDATA[\n{self.raw_data}\n]]>'
-        raw_bytes = ET.tostring(root, 'utf-8', xml_declaration=True)
-        raw_str = unescape(raw_bytes.decode())
+        return root
+
+    def to_xml(self, pretty_print: bool = True, include_data: bool = True) -> str:
+        f = io.StringIO()
+        self.write_xml(f, pretty_print, include_data)
+        return f.getvalue()
+
+    def write_xml(self, f: TextIO, pretty_print: bool = True, include_data: bool = True,
+                  lines: Iterable[str] = None):
+        """
+        Writes the header, and then streams data lines into the CDATA section,
+        so that the whole payload is never built as one string.
+
+        :param include_data: if false, the data section is left empty.
+        :param lines: data lines to write instead of `iter_data_lines`, e.g. merged from files.
+        """
+        if lines is None:
+            lines = self.iter_data_lines()
+        root = self.header_to_xml()
+        ET.SubElement(root, 'data').text = _data_placeholder
         if pretty_print:
-            dom = xml.dom.minidom.parseString(raw_str)
-            return dom.toprettyxml(encoding='utf-8').decode()
-        else:
-            return raw_str
+            ET.indent(root, '\t')
+        # <data> is the last tag, so the placeholder is the last occurrence
+        before_data, _, after_data = ET.tostring(root, encoding='unicode').rpartition(_data_placeholder)
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        f.write(before_data)
+        f.write(_cdata_start)
+        f.write('\n')
+        line_count = 0
+        batch: list[str] = []
+        for line in lines if include_data else ():
+            batch.append(line)
+            if len(batch) >= _lines_per_write:
+                line_count += len(batch)
+                f.write('\n'.join(batch))
+                f.write('\n')
+                batch.clear()
+        line_count += len(batch)
+        f.write('\n'.join(batch))
+        f.write('\n' if line_count > 0 else '\n\n')
+        f.write(_cdata_end)
+        f.write(after_data)
+        f.write('\n')
+
+    def snapshot(self) -> 'BaseXmlDataModel':
+        """
+        Returns a copy that can be read by another thread, e.g. for saving, while this model keeps changing.
+        Subclasses copy their parsed data here.
+        """
+        return dataclasses.replace(self)
+
+    def iter_data_lines(self) -> Iterable[str]:
+        """Returns lines of the data to be saved. Subclasses serialize their parsed data here."""
+        return self.raw_data.splitlines()
 
     def load_data(self):
         """Load data from the file"""
@@ -93,6 +159,72 @@ class BaseXmlDataModel:
             self.__dict__ = reloaded.__dict__.copy()
             logger.info(f'Loaded model from file: {self.file_path}')
 
+    def unload_data(self):
+        """Drops data from memory. It can be loaded again from the file."""
+        self.raw_data = ''
+        self.is_data_loaded = False
+
+    def get_data_size(self) -> tuple[int, int]:
+        """Returns the approximate number of entries in data, and the bytes they take in memory"""
+        return len(self.raw_data.splitlines()), len(self.raw_data)
+
+
+_header_chunk_size = 16 * 1024
+
+_data_placeholder = '__data__'
+'''Marks where data lines are inserted into the serialized header'''
+
+_lines_per_write = 4096
+
+_cdata_start = '<![CDATA['
+_cdata_end = ']]>'
+
+
+def iter_xml_data_lines(file_path: str) -> Iterator[str]:
+    """
+    Streams the lines of the <data> section of a model file, so that the file is never read entirely.
+    """
+    with open(file_path, encoding='utf-8') as f:
+        for line in f:
+            start = line.find(_cdata_start)
+            if start >= 0:
+                line = line[start + len(_cdata_start):]
+                break
+        else:
+            # written without CDATA, e.g. by hand
+            yield from BaseXmlDataModel.from_xml_file(file_path).raw_data.splitlines()
+            return
+        while line:
+            end = line.find(_cdata_end)
+            if end >= 0:
+                line = line[:end]
+            line = line.strip()
+            if len(line) > 0:
+                yield line
+            if end >= 0:
+                return
+            line = f.readline()
+
+
+def _read_xml_header(f: BinaryIO) -> ET.Element:
+    """
+    Stream-parses the file until the <data> tag, so that the rest of the file isn't read.
+    Returns the root element with all tags before <data>.
+    """
+    parser = ET.XMLPullParser(events=('start',))
+    root: Optional[ET.Element] = None
+    while True:
+        chunk = f.read(_header_chunk_size)
+        if not chunk:
+            break
+        parser.feed(chunk)
+        for _, element in parser.read_events():
+            if root is None:
+                root = element
+            elif element.tag == 'data':
+                return root
+    return parser.close()
+
 
 def _target_from_xml(tag: ET.Element) -> Target:
     """Parses target from XML format. Throws if the format is invalid"""
@@ -108,10 +108,10 @@ class CheemsConfig:
 
     def get(self, key: str, default: any = None, target: Target = None) -> any:
         """Returns the value for key, given the current target"""
-        return self.inner_dict[key]
+        return self.inner_dict.get(key, default)
 
     def __getitem__(self, item) -> any:
-        return self.get(item)
+        return self.inner_dict[item]
 
 
 config: CheemsConfig = CheemsConfig()
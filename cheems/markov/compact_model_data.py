@@ -0,0 +1,349 @@
+import random
+from array import array
+from bisect import bisect, bisect_left
+from collections.abc import Mapping
+from itertools import accumulate
+from typing import Iterator, Optional
+
+from cheems.markov.model_data import ENDS, SENTENCE_START, SamplingTable, parse_rows, get_start_share
+
+
+class Vocabulary:
+    """
+    Maps words to integer ids and back.
+    A single instance is shared by all compact models, so that every word is stored once.
+    """
+
+    def __init__(self):
+        self.ids: dict[str, int] = {}
+        self.words: list[str] = []
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def get_id(self, word: str) -> Optional[int]:
+        return self.ids.get(word, None)
+
+    def intern(self, word: str) -> int:
+        """Returns the id of the word, adding it to the vocabulary if needed."""
+        word_id = self.ids.get(word, None)
+        if word_id is None:
+            word_id = len(self.words)
+            self.ids[word] = word_id
+            self.words.append(word)
+        return word_id
+
+
+shared_vocabulary = Vocabulary()
+'''Global vocabulary instance'''
+
+
+class CompactModelData(Mapping[str, dict[str, int]]):
+    """
+    Drop-in replacement for ModelData, which stores word ids in CSR form:
+    a sorted array of first words, each pointing to a slice of next words
+    and their counts. This takes a few bytes per word pair instead of hundreds.
+
+    Fresh training goes into a small mutable overflow buffer,
+    which is compacted into the arrays once it grows large enough.
+    Rows are returned as new dicts, so they must be updated via `append`.
+    """
+
+    approx_bytes_per_pair = 14
+    '''Memory taken by a word pair, as measured by benchmarks/model_memory_benchmark.py'''
+
+    compact_min_pairs = 1024
+    '''Overflow is compacted when it exceeds this many pairs, or 1/8 of the arrays'''
+
+    def __init__(self, data: Mapping[str, Mapping[str, int]] = None, vocab: Vocabulary = None):
+        self.vocab = vocab if vocab is not None else shared_vocabulary
+        self._row_ids = array('I')
+        '''Ids of first words, sorted'''
+        self._offsets = array('I', [0])
+        '''Row i spans [offsets[i], offsets[i + 1]) in the arrays below'''
+        self._next_ids = array('I')
+        self._cum_counts = array('I')
+        '''Counts in the form of running sums within each row, for sampling with bisect'''
+        self._overflow: dict[int, dict[int, int]] = {}
+        self._overflow_pairs = 0
+        self._non_terminal_ids: list[int] = []
+        '''Words that can be followed by something other than END, see `build_indexes`'''
+        self._non_terminal_set: set[int] = set()
+        self._end_count = 0
+        '''Total count of pairs that end a sentence'''
+        if data:
+            for first_word, next_words in data.items():
+                for next_word, count in next_words.items():
+                    self.append(first_word, next_word, count)
+            self.compact()
+
+    @classmethod
+    def parse(cls, text: str, max_weight: int, vocab: Vocabulary = None) -> 'CompactModelData':
+        """
+        Parses lines of 'first_word next_word count' straight into arrays.
+        See `parse_rows`.
+        """
+        data = cls(vocab=vocab)
+        intern = data.vocab.intern
+        next_ids = array('I')
+        cum_counts = array('I')
+        rows: list[tuple[int, int, int]] = []
+        '''(first word id, start, end) in the order of the text'''
+        seen_ids: set[int] = set()
+
+        for first_word, next_counts in parse_rows(text, max_weight):
+            word_id = intern(first_word)
+            if word_id in seen_ids:
+                # the row was split, so the rest goes through overflow
+                for next_word, count in next_counts.items():
+                    data._append_ids(word_id, intern(next_word), count)
+                continue
+            seen_ids.add(word_id)
+            start = len(next_ids)
+            next_ids.extend(map(intern, next_counts.keys()))
+            cum_counts.extend(accumulate(next_counts.values()))
+            rows.append((word_id, start, len(next_ids)))
+
+        data._extend_rows(rows, next_ids, cum_counts)
+        data.compact()
+        data.build_indexes()
+        return data
+
+    def _extend_rows(self, rows: list[tuple[int, int, int]], next_ids: array, cum_counts: array):
+        """
+        Appends rows given as (first word id, start, end) slices of next_ids and cum_counts.
+        Must be called on empty arrays.
+        """
+        # rows must be sorted by id for lookup
+        rows.sort()
+        for word_id, start, end in rows:
+            self._row_ids.append(word_id)
+            self._next_ids.extend(next_ids[start:end])
+            self._cum_counts.extend(cum_counts[start:end])
+            self._offsets.append(len(self._next_ids))
+
+    def __reduce__(self):
+        """
+        Pickles the arrays with words instead of ids, e.g. to send the data from a loader process.
+        Unpickling interns them into the shared vocabulary of the receiving process.
+        """
+        self.compact()
+        words = self.vocab.words
+        return _unpickle_compact_model_data, (
+            [words[word_id] for word_id in self._row_ids],
+            array('I', self._offsets),
+            [words[next_id] for next_id in self._next_ids],
+            array('I', self._cum_counts),
+        )
+
+    def _find_row(self, word_id: int) -> int:
+        """Returns the index of the row in the arrays, or -1"""
+        i = bisect_left(self._row_ids, word_id)
+        if i < len(self._row_ids) and self._row_ids[i] == word_id:
+            return i
+        return -1
+
+    def _get_next_counts(self, word_id: int) -> dict[int, int]:
+        """Returns next word ids and their counts, from both the arrays and overflow"""
+        next_counts: dict[int, int] = {}
+        row = self._find_row(word_id)
+        if row >= 0:
+            prev = 0
+            for i in range(self._offsets[row], self._offsets[row + 1]):
+                cum = self._cum_counts[i]
+                next_counts[self._next_ids[i]] = cum - prev
+                prev = cum
+        for next_id, count in self._overflow.get(word_id, {}).items():
+            next_counts[next_id] = next_counts.get(next_id, 0) + count
+        return next_counts
+
+    def __getitem__(self, word: str) -> dict[str, int]:
+        word_id = self.vocab.get_id(word)
+        next_counts = {} if word_id is None else self._get_next_counts(word_id)
+        if len(next_counts) == 0:
+            raise KeyError(word)
+        words = self.vocab.words
+        return {words[next_id]: count for next_id, count in next_counts.items()}
+
+    def __contains__(self, word: object) -> bool:
+        word_id = self.vocab.get_id(word) if isinstance(word, str) else None
+        if word_id is None:
+            return False
+        return word_id in self._overflow or self._find_row(word_id) >= 0
+
+    def __iter__(self) -> Iterator[str]:
+        words = self.vocab.words
+        for word_id in self._row_ids:
+            yield words[word_id]
+        for word_id in self._overflow.keys():
+            if self._find_row(word_id) < 0:
+                yield words[word_id]
+
+    def __len__(self) -> int:
+        new_rows = sum(1 for word_id in self._overflow.keys() if self._find_row(word_id) < 0)
+        return len(self._row_ids) + new_rows
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({dict(self.items())})'
+
+    @property
+    def pair_count(self) -> int:
+        return len(self._next_ids) + self._overflow_pairs
+
+    def snapshot(self) -> 'CompactModelData':
+        """
+        Returns a copy that can be read by another thread, e.g. for saving.
+        The arrays are shared, because after compaction they are replaced, never modified.
+        """
+        self.compact()
+        data = CompactModelData(vocab=self.vocab)
+        data._row_ids = self._row_ids
+        data._offsets = self._offsets
+        data._next_ids = self._next_ids
+        data._cum_counts = self._cum_counts
+        return data
+
+    def append(self, w1: str, w2: str, count: int = 1):
+        """Update data with this new word pair"""
+        self._append_ids(self.vocab.intern(w1), self.vocab.intern(w2), count)
+        if self._overflow_pairs > max(self.compact_min_pairs, len(self._next_ids) // 8):
+            self.compact()
+
+    def append_pairs(self, counts: Mapping[tuple[str, str], int]):
+        """Same as `append` for each pair and its count"""
+        intern = self.vocab.intern
+        for (w1, w2), count in counts.items():
+            self._append_ids(intern(w1), intern(w2), count)
+        if self._overflow_pairs > max(self.compact_min_pairs, len(self._next_ids) // 8):
+            self.compact()
+
+    def _append_ids(self, w1_id: int, w2_id: int, count: int):
+        next_counts = self._overflow.setdefault(w1_id, {})
+        if w2_id not in next_counts:
+            next_counts[w2_id] = 0
+            self._overflow_pairs += 1
+        next_counts[w2_id] += count
+        words = self.vocab.words
+        if words[w1_id] == SENTENCE_START:
+            return
+        if words[w2_id] in ENDS:
+            self._end_count += count
+        elif w1_id not in self._non_terminal_set:
+            self._non_terminal_set.add(w1_id)
+            self._non_terminal_ids.append(w1_id)
+
+    def compact(self):
+        """Merges the overflow buffer into the arrays."""
+        if len(self._overflow) == 0:
+            return
+        row_ids = array('I', sorted(set(self._row_ids).union(self._overflow.keys())))
+        offsets = array('I', [0])
+        next_ids = array('I')
+        cum_counts = array('I')
+        for word_id in row_ids:
+            next_counts = self._get_next_counts(word_id)
+            next_ids.extend(next_counts.keys())
+            cum_counts.extend(accumulate(next_counts.values()))
+            offsets.append(len(next_ids))
+        self._row_ids = row_ids
+        self._offsets = offsets
+        self._next_ids = next_ids
+        self._cum_counts = cum_counts
+        self._overflow = {}
+        self._overflow_pairs = 0
+
+    def get_sampling_table(self, word: str) -> Optional[SamplingTable]:
+        """Returns the table of next words, or None if there are none."""
+        word_id = self.vocab.get_id(word)
+        next_counts = {} if word_id is None else self._get_next_counts(word_id)
+        if len(next_counts) == 0:
+            return None
+        words = self.vocab.words
+        return [words[next_id] for next_id in next_counts.keys()], list(accumulate(next_counts.values()))
+
+    def get_random_next_word(self, word: str) -> Optional[str]:
+        """Weighted according to data. Returns None if there are no next words."""
+        word_id = self.vocab.get_id(word)
+        if word_id is None:
+            return None
+        if word_id in self._overflow:
+            # this row has fresh training, so it needs to be merged first
+            words, cum_weights = self.get_sampling_table(word)
+            return random.choices(words, cum_weights=cum_weights)[0]
+        row = self._find_row(word_id)
+        if row < 0:
+            return None
+        # same as random.choices, but searching only within the row
+        start = self._offsets[row]
+        end = self._offsets[row + 1]
+        total = self._cum_counts[end - 1]
+        i = bisect(self._cum_counts, random.random() * total, start, end - 1)
+        return self.vocab.words[self._next_ids[i]]
+
+    def build_indexes(self):
+        """
+        See `ModelData.build_indexes`. Only the ids of END words are looked up,
+        so the words of a mapped file aren't decoded.
+        """
+        self.compact()
+        end_ids = {word_id for word_id in map(self.vocab.get_id, ENDS) if word_id is not None}
+        start_id = self.vocab.get_id(SENTENCE_START)
+        row_ids, offsets, cum_counts = self._row_ids, self._offsets, self._cum_counts
+        end_pairs_by_row: dict[int, int] = {}
+        end_count = 0
+        for i in [i for i, next_id in enumerate(self._next_ids) if next_id in end_ids]:
+            row = bisect(offsets, i) - 1
+            if row_ids[row] == start_id:
+                continue
+            end_pairs_by_row[row] = end_pairs_by_row.get(row, 0) + 1
+            end_count += cum_counts[i] - (cum_counts[i - 1] if i > offsets[row] else 0)
+        # a row that has more next words than END pairs can continue
+        self._non_terminal_ids = [
+            word_id for row, word_id in enumerate(row_ids)
+            if word_id != start_id and offsets[row + 1] - offsets[row] > end_pairs_by_row.get(row, 0)
+        ]
+        self._non_terminal_set = set(self._non_terminal_ids)
+        self._end_count = end_count
+
+    def is_non_terminal(self, word: str) -> bool:
+        """See `ModelData.is_non_terminal`"""
+        word_id = self.vocab.get_id(word)
+        return word_id is not None and word_id in self._non_terminal_set
+
+    def _get_row_total(self, word: str) -> int:
+        """Sum of the counts of next words"""
+        word_id = self.vocab.get_id(word)
+        if word_id is None:
+            return 0
+        if word_id in self._overflow:
+            return sum(self._get_next_counts(word_id).values())
+        row = self._find_row(word_id)
+        if row < 0:
+            return 0
+        return self._cum_counts[self._offsets[row + 1] - 1]
+
+    def get_random_first_word(self) -> Optional[str]:
+        """
+        Picks a word that starts a sentence, weighted by how often it did.
+        See `ModelData.get_random_first_word`.
+        """
+        start_count = self._get_row_total(SENTENCE_START)
+        if start_count > 0 and random.random() < get_start_share(start_count, self._end_count):
+            return self.get_random_next_word(SENTENCE_START)
+        if len(self._non_terminal_ids) > 0:
+            return self.vocab.words[random.choice(self._non_terminal_ids)]
+        if len(self) == 0:
+            return None
+        return random.choice(list(self))
+
+
+def _unpickle_compact_model_data(
+        row_words: list[str], offsets: array, next_words: list[str], cum_counts: array,
+) -> CompactModelData:
+    data = CompactModelData()
+    intern = data.vocab.intern
+    next_ids = array('I', map(intern, next_words))
+    rows = [(intern(word), offsets[i], offsets[i + 1]) for i, word in enumerate(row_words)]
+    data._extend_rows(rows, next_ids, cum_counts)
+    data.build_indexes()
+    return data
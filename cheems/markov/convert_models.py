@@ -0,0 +1,63 @@
+"""
+Converts Markov model directories between the XML and binary formats.
+Run from the project root:
+    python -m cheems.markov.convert_models to-bin <dir or file>
+    python -m cheems.markov.convert_models to-xml <dir or file>
+    python -m cheems.markov.convert_models dump <file.bin>
+"""
+import logging
+import os
+import sys
+
+from cheems.markov.model import Model
+from cheems.markov.model_bin import MmapModelData, write_model_bin, get_bin_path
+from cheems.markov.model_journal import remove_journal
+from cheems.markov.model_xml import XmlModel
+from cheems.model_writer import write_file_atomically
+
+logger = logging.getLogger(__name__)
+
+
+def _find_files(path: str, extension: str) -> list[str]:
+    if not os.path.isdir(path):
+        return [path]
+    found = []
+    for subdir, _, files in os.walk(path):
+        for file in files:
+            if file.endswith(extension):
+                found.append(os.path.join(subdir, file))
+    return found
+
+
+def convert_to_bin(path: str):
+    """Moves the data of XML models into '.bin' files, leaving only headers in XML."""
+    for xml_path in _find_files(path, '.xml'):
+        m = XmlModel.from_xml_file(xml_path)
+        write_model_bin(m.data, get_bin_path(xml_path))
+        write_file_atomically(xml_path, lambda f: m.write_xml(f, include_data=False))
+        remove_journal(xml_path)
+        logger.info(f'Converted to binary: {xml_path}')
+
+
+def convert_to_xml(path: str):
+    """Moves the data of '.bin' files back into their XML models."""
+    for bin_path in _find_files(path, '.bin'):
+        xml_path = os.path.splitext(bin_path)[0] + '.xml'
+        m = XmlModel.from_xml_file(xml_path)
+        write_file_atomically(xml_path, m.write_xml)
+        os.remove(bin_path)
+        remove_journal(xml_path)
+        logger.info(f'Converted to XML: {xml_path}')
+
+
+def dump(bin_path: str):
+    """Prints the data in the same format as the XML payload"""
+    print(Model._serialize_data(MmapModelData.open(bin_path)))
+
+
+if __name__ == '__main__':
+    commands = {'to-bin': convert_to_bin, 'to-xml': convert_to_xml, 'dump': dump}
+    if len(sys.argv) != 3 or sys.argv[1] not in commands:
+        print(f'Usage: python -m cheems.markov.convert_models {"|".join(commands.keys())} <path>')
+        sys.exit(1)
+    commands[sys.argv[1]](sys.argv[2])
@@ -0,0 +1,60 @@
+"""
+Training on more data than fits in memory.
+Pairs are counted in memory until a threshold, and then spilled into temporary files
+as sorted runs of 'first_word next_word count' lines, like the serialized data,
+and n-grams the same way, as lines of 'context... next_word count'.
+When the model is written, its runs are merged into one sorted stream of lines,
+so the whole model is never in memory.
+"""
+import logging
+import os
+from typing import Iterable, Iterator
+
+from cheems.markov.model import Model
+from cheems.markov.model_data import ModelData
+from cheems.util import merge_sorted_lines
+
+logger = logging.getLogger(__name__)
+
+
+def _iter_run_file(path: str) -> Iterator[str]:
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+
+class SortedRuns:
+    """Sorted runs of a model's pairs or n-grams, spilled into files in a temporary directory"""
+    temp_dir: str
+    name: str
+    paths: list[str]
+
+    def __init__(self, temp_dir: str, name: str):
+        """
+        :param name: prefix of the run files, must be unique in the directory.
+        """
+        self.temp_dir = temp_dir
+        self.name = name
+        self.paths = []
+
+    def spill(self, data: ModelData):
+        """Writes the data as a new run. The caller can then clear it."""
+        self.spill_lines(Model._iter_serialized_lines(data))
+
+    def spill_lines(self, lines: Iterable[str]):
+        """Writes sorted lines of words and a count as a new run, e.g. of n-grams"""
+        path = os.path.join(self.temp_dir, f'{self.name}.{len(self.paths)}.run')
+        with open(path, 'w', encoding='utf-8') as f:
+            for line in lines:
+                f.write(line)
+                f.write('\n')
+        self.paths.append(path)
+
+    def iter_merged_lines(self, *other_runs: Iterable[str]) -> Iterator[str]:
+        """Merges the spilled runs, and other sorted runs, e.g. of data still in memory"""
+        return merge_sorted_lines([_iter_run_file(path) for path in self.paths] + list(other_runs))
+
+    def remove(self):
+        for path in self.paths:
+            os.remove(path)
+        self.paths = []
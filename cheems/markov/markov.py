@@ -1,12 +1,16 @@
 import random
 import re
+from collections import Counter
+from functools import lru_cache
+from typing import Iterable, Optional
 
-from cheems.markov.model import Model, ModelData
+from cheems.markov.model import Model, ModelData, ENDS, SENTENCE_START
+from cheems.markov.ngram_data import NGramData, NGram
 from cheems.util import pairwise
 
-# these characters indicate end of a sentence
-ENDS = '.?!'
 omitted_ends = '.'  # characters that are too boring and should be trimmed
+continuation_attempts = 4
+'''Random picks of the next word that may be END, before the row is filtered, see `_pick_continuation`'''
 punctuation = '.,;:!?'
 punctuation_except_ENDS = ',;:'
 bad_punctuation = '`~^*(){}[]=+•“”"…—«»'  # keeping $/ for discord commands and <@#&> for mentions.
@@ -17,16 +21,28 @@ re_punctuation_except_END = re.escape(punctuation_except_ENDS)
 re_bad_punctuation = re.escape(bad_punctuation)
 url_pattern = re.compile(r'(http|ftp|https)://([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:/~+#\-()!]*[\w@?^=%&/~+#-])')
 
+# patterns for _break_into_words, in the order they are applied:
+code_pattern = re.compile(r'```.*```', flags=re.DOTALL)
+whitespace_pattern = re.compile(r'[ᅟ\s]+')
+bad_punctuation_pattern = re.compile(rf'[{re_bad_punctuation}]+')
+punctuation_run_pattern = re.compile(rf'([{re_punctuation}])[{re_punctuation}]+')
+end_pattern = re.compile(rf'(\S)([{re_ENDS}]) ')
+punctuation_except_END_pattern = re.compile(rf'\s?([{re_punctuation_except_END}]+)\s')
+
+canonical_form_cache_size = 65536
+'''Canonical forms of this many recent words are cached, which covers most of the words in chat'''
+
 
 def strip_punctuation(text: str) -> str:
     """Strips punctuation from both ends, except command characters at the start."""
     if re_command.match(text) is not None:
         return text  # don't strip command
-    text = re.sub(rf'^[{re_punctuation}]+', '', text).strip()
-    text = re.sub(rf'[{re_punctuation}]+$', '', text).strip()
+    text = text.lstrip(punctuation).strip()
+    text = text.rstrip(punctuation).strip()
     return text
 
 
+@lru_cache(maxsize=canonical_form_cache_size)
 def canonical_form(word: str) -> str:
     """
     Returns the canonical form of the word: lowercase, no whitespace, no punctuation.
@@ -60,27 +76,25 @@ def _break_into_words(sentence: str) -> list[str]:
     Extracts a sequence of words from the sentence.
     Punctuation is stripped or formatted for the model.
     """
+    # Patterns are precompiled, and substitute templates rather than call back into Python.
+    # Some passes can't be merged, e.g. spaces left by bad punctuation affect the passes after it.
     # Remove code:
-    sentence = re.sub(r'```.*```', '', sentence, flags=re.DOTALL)
+    if '```' in sentence:
+        sentence = code_pattern.sub('', sentence)
     sentence = sentence.strip()
     # Remove urls:
-    sentence = url_pattern.sub('', sentence)
-    # Line breaks are considered spaces:
-    sentence = sentence.replace('\n', ' ')
-    # Clean whitespaces:
-    sentence = re.sub(r'[ᅟ\s]+', ' ', sentence)
+    if '://' in sentence:
+        sentence = url_pattern.sub('', sentence)
+    # Clean whitespaces, including line breaks:
+    sentence = whitespace_pattern.sub(' ', sentence)
     # Remove bad punctuation:
-    sentence = re.sub(rf'[{re_bad_punctuation}]+', ' ', sentence)
+    sentence = bad_punctuation_pattern.sub(' ', sentence)
     # Remove other bad characters such as zero-width whitespace:
     sentence = sentence.replace('\u200b', '')
     # Convert long strings of punctuation into a short one, e.g. ...->. ?!->?
-    sentence = re.sub(rf'([{re_punctuation}]+)', lambda m: m.group(0)[0], sentence)
+    sentence = punctuation_run_pattern.sub(r'\1', sentence)
     # Ensure every end character is a separate word, except in discord mentions like <@!123>:
-    sentence = re.sub(
-        rf'(\S)([{re_ENDS}]) ',
-        lambda m: f'{m.group(1)} {m.group(2)} ',
-        sentence
-    )
+    sentence = end_pattern.sub(r'\1 \2 ', sentence)
     # Allow using commands as words, e.g. '.roll'
     # sentence = re.sub(
     #     rf' ([{re_ENDS}])(\S)',
@@ -89,12 +103,8 @@ def _break_into_words(sentence: str) -> list[str]:
     # )
 
     # Ensure punctuation sticks to the NEXT word, e.g. 'hello ,world'
-    sentence = re.sub(
-        rf'\s?([{re_punctuation_except_END}]+)\s',
-        lambda m: f' {m.group(1)}',
-        sentence
-    )
-    words = [w for w in sentence.split(' ') if len(w) > 0]
+    sentence = punctuation_except_END_pattern.sub(r' \1', sentence)
+    words = [w for w in sentence.split(' ') if w]
     return words
 
 
@@ -109,56 +119,170 @@ def train_models_on_sentence(models_data: list[ModelData], sentence: str):
     """
     Updates the given models with word sequences from the given sentence.
     """
-    words = _break_into_words(sentence)
-    if len(words) == 0:
-        return
-    # ensure there is an END character at the end:
-    if words[-1] not in ENDS:
-        words.append(ENDS[0])
-    for w1, w2 in pairwise(words):
-        w1 = canonical_form(w1)
-        if w1 in ENDS:
+    train_models_on_messages(models_data, [sentence])
+
+
+def train_models_on_messages(models_data: list[ModelData], sentences: Iterable[str]):
+    """
+    Updates the given models with word sequences from all the sentences,
+    e.g. a batch of chat history. Pairs are counted first, so that each model
+    is updated once per distinct pair rather than once per occurrence.
+    """
+    add_pair_counts(models_data, count_word_pairs(sentences))
+
+
+def count_word_pairs(sentences: Iterable[str], counts: Counter = None) -> Counter[tuple[str, str]]:
+    """
+    Counts word pairs in the sentences, in the form they are stored in models.
+    :param counts: if given, pairs are added to it.
+    """
+    if counts is None:
+        counts = Counter()
+    for sentence in sentences:
+        words = _break_into_words(sentence)
+        if len(words) == 0:
             continue
+        # ensure there is an END character at the end:
+        if words[-1] not in ENDS:
+            words.append(ENDS[0])
+        # the sentence starts right after an END character:
+        for w1, w2 in pairwise([ENDS[0]] + words):
+            w1 = canonical_form(w1)
+            if w1 in ENDS:
+                # record the start of the next sentence
+                w2 = canonical_form(w2)
+                if w2 in ENDS:
+                    continue
+                w1 = SENTENCE_START
+            # same as Model._append_word_pair
+            counts[(w1, w2.lower())] += 1
+    return counts
+
+
+def train_model_groups(groups: list[tuple[list[ModelData], Iterable[str]]]):
+    """
+    Trains groups of models on their sentences, e.g. a batch of channel history,
+    where each user's messages go into the models of the channel, the server and the user.
+    Pairs of each group are counted once, and a model that is in several groups
+    is updated once with the sum of their counts.
+    """
+    group_counts = [count_word_pairs(sentences) for _, sentences in groups]
+    groups_by_data: dict[int, tuple[ModelData, list[int]]] = {}
+    for i, (models_data, _) in enumerate(groups):
         for data in models_data:
-            # noinspection PyProtectedMember
-            Model._append_word_pair(data, w1, w2)
+            groups_by_data.setdefault(id(data), (data, []))[1].append(i)
+    # e.g. the channel and server models get the same sum
+    summed_counts: dict[tuple[int, ...], Counter[tuple[str, str]]] = {}
+    for data, group_ids in groups_by_data.values():
+        key = tuple(group_ids)
+        counts = summed_counts.get(key, None)
+        if counts is None:
+            counts = Counter(group_counts[key[0]])
+            for i in key[1:]:
+                counts.update(group_counts[i])
+            summed_counts[key] = counts
+        data.append_pairs(counts)
+
+
+def add_pair_counts(models_data: list[ModelData], counts: Counter[tuple[str, str]]):
+    """Updates the given models with counted word pairs, see `count_word_pairs`"""
+    for data in models_data:
+        data.append_pairs(counts)
+
+
+def count_word_ngrams(sentences: Iterable[str], order: int, counts: Counter = None) -> Counter[NGram]:
+    """
+    Counts next words after 2 to `order` previous words in the sentences,
+    in the form they are stored in `NGramData`: contexts of canonical forms, like the first words of pairs.
+    Contexts don't cross the ends of sentences. Word pairs are counted by `count_word_pairs`.
+    :param counts: if given, n-grams are added to it.
+    """
+    if counts is None:
+        counts = Counter()
+    for sentence in sentences:
+        words = _break_into_words(sentence)
+        if len(words) == 0:
+            continue
+        if words[-1] not in ENDS:
+            words.append(ENDS[0])
+        context = [SENTENCE_START]
+        for word in words:
+            next_word = word.lower()
+            for n in range(2, min(order, len(context)) + 1):
+                counts[(*context[-n:], next_word)] += 1
+            key = canonical_form(word)
+            if key in ENDS:
+                context = [SENTENCE_START]
+            else:
+                context.append(key)
+                if len(context) > order:
+                    del context[0]
+    return counts
+
+
+def train_ngram_groups(groups: list[tuple[list[NGramData], Iterable[str]]]):
+    """
+    Same as `train_model_groups` for the n-grams of models.
+    Each group is counted up to the highest order of its models.
+    """
+    for ngrams_data, sentences in groups:
+        if len(ngrams_data) == 0:
+            continue
+        counts = count_word_ngrams(sentences, max(ngrams.order for ngrams in ngrams_data))
+        for ngrams in ngrams_data:
+            ngrams.append_ngrams(counts)
 
 
 def _pick_first_word(data: ModelData) -> str:
     """
-    Pick a random word that doesn't immediately end the chain.
+    Pick a random word that starts a sentence, weighted by how often it did.
     """
-    # try multiple times until we run through the length of data.
-    # if all words immediately end the phrase, pick any one
-    if len(data) == 0:
+    first_word = data.get_random_first_word()
+    if first_word is None:
         return ENDS[0]
-    for x in range(len(data)):
-        first, next_words = random.choice(list(data.items()))
-        for y in next_words.keys():
-            if y not in ENDS:
-                return first
-    return random.choice(list(data.keys()))
+    return first_word
+
+
+def _pick_continuation(data: ModelData, word: str) -> Optional[str]:
+    """
+    Picks a next word that isn't END, weighted according to data.
+    Returns None if the word is a dead end, i.e. it's unknown or only ends sentences.
+    """
+    if not data.is_non_terminal(word):
+        return None
+    # usually most next words aren't ENDS, so a few random picks are cheaper than filtering the row
+    for _ in range(continuation_attempts):
+        next_word = data.get_random_next_word(word)
+        if next_word not in ENDS:
+            return next_word
+    words, cum_weights = data.get_sampling_table(word)
+    weights = [cum - prev for prev, cum in zip([0] + cum_weights[:-1], cum_weights)]
+    continuations = [(w, weight) for w, weight in zip(words, weights) if w not in ENDS]
+    return random.choices([w for w, _ in continuations], [weight for _, weight in continuations])[0]
 
 
-def _pick_next_word(data: ModelData, first_word: str) -> str:
+def _pick_next_word(data: ModelData, first_word: str,
+                    ngrams: Optional[NGramData] = None, history: list[str] = None,
+                    must_continue: bool = False) -> str:
     """
     :param first_word: can include punctuation, which will be stripped.
+    :param ngrams: if given, the next word is picked after the longest known context in history,
+        backing off to the word pair after first_word.
+    :param history: canonical forms of the previous words, ending with first_word.
+    :param must_continue: avoid ENDS if first_word can be followed by anything else.
     :return: Word including space and punctuation, e.g. ' word' or ', word'.
     """
-    # drop punctuation from first_word:
-    first_word = canonical_form(first_word)
-
-    next_words = data[first_word] if first_word in data else []
-    if len(next_words) == 0:
+    next_word = None
+    if ngrams is not None and history:
+        next_word = ngrams.get_random_next_word(history)
+    if must_continue and (next_word is None or next_word in ENDS):
+        next_word = _pick_continuation(data, canonical_form(first_word))
+    if next_word is None:
+        # drop punctuation from first_word:
+        next_word = data.get_random_next_word(canonical_form(first_word))
+    if next_word is None:
         return ENDS[0]
 
-    words: list[str] = []
-    weights: list[int] = []
-    for next_word, count in next_words.items():
-        words.append(next_word)
-        weights.append(count)
-    next_word = random.choices(words, weights)[0]
-
     if next_word in ENDS:
         return next_word
     # format punctuation like so: ', '
@@ -168,7 +292,19 @@ def _pick_next_word(data: ModelData, first_word: str) -> str:
         return ' ' + next_word
 
 
-def markov_chain(data: ModelData, start: str = '', limit: int = 50) -> str:
+def _get_history(words: list[str], order: int) -> list[str]:
+    """Returns canonical forms of the last words of the sentence, up to `order`, for `NGramData`"""
+    history = [SENTENCE_START]
+    for word in words:
+        key = canonical_form(word)
+        if key in ENDS:
+            history = [SENTENCE_START]
+        else:
+            history.append(key)
+    return history[-order:]
+
+
+def markov_chain(data: ModelData, start: str = '', limit: int = 50, ngrams: Optional[NGramData] = None) -> str:
     """
     Runs the given model as a Markov Chain.
 
@@ -176,24 +312,30 @@ def markov_chain(data: ModelData, start: str = '', limit: int = 50) -> str:
     :param start: start of the sentence.
     If empty, the start will be picked randomly from the model.
     :param limit: maximum number of words.
+    :param ngrams: if given, next words depend on several previous words where possible.
     :return:
     """
     result = strip_punctuation(start)
 
     # pick the first word to begin the chain
     first_word = start.strip().split(' ')[-1]
-    if len(first_word) <= 0:
+    is_prompted = len(first_word) > 0
+    if not is_prompted:
         first_word = _pick_first_word(data)
         if first_word in ENDS:
             return ''
         else:
             result = first_word
+        history = [SENTENCE_START, canonical_form(first_word)] if ngrams is not None else None
+    else:
+        history = _get_history(_break_into_words(start), ngrams.order) if ngrams is not None else None
 
     # start the chain
     last_word = first_word
     count = 1
     while count < limit:
-        next_word = _pick_next_word(data, last_word)
+        # the chain must add something to the prompt, so it doesn't end right away unless it's a dead end
+        next_word = _pick_next_word(data, last_word, ngrams, history, must_continue=is_prompted and count == 1)
         if next_word in omitted_ends:
             break  # '.' is too boring, so skip it
         result += next_word
@@ -201,4 +343,8 @@ def markov_chain(data: ModelData, start: str = '', limit: int = 50) -> str:
         last_word = next_word
         if last_word in ENDS:
             break
+        if history is not None:
+            history.append(canonical_form(next_word))
+            if len(history) > ngrams.order:
+                del history[0]
     return result
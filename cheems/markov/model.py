@@ -1,13 +1,29 @@
 import logging
 from dataclasses import dataclass, field
 from datetime import datetime
+from typing import Iterator, Mapping, Optional
 
 from cheems.config import config
+from cheems.markov.compact_model_data import CompactModelData
+from cheems.markov.model_data import ModelData, ENDS, SENTENCE_START
+from cheems.markov.ngram_data import NGramData
 from cheems.targets import Target
 
 logger = logging.getLogger(__name__)
 
-ModelData = dict[str, dict[str, int]]
+
+def _is_compact_backend() -> bool:
+    return config.get('markov_model_backend', 'dict') == 'compact'
+
+
+def new_model_data(data: Mapping[str, Mapping[str, int]] = None) -> ModelData:
+    """
+    Creates data using the backend from the config:
+    'dict' for ModelData, or 'compact' for CompactModelData.
+    """
+    if _is_compact_backend():
+        return CompactModelData(data)
+    return ModelData(data or {})
 
 
 @dataclass
@@ -21,9 +37,13 @@ class Model:
     updated_time: datetime
     target: Target
     description: str
-    # E.g. { first_word: {next_word: 1}}
-    # next_word includes punctuation attached to the preceding world, e.g. 'hello' - ',my'
-    data: ModelData = field(default_factory=dict)
+    data: ModelData = field(default_factory=new_model_data)
+    ngrams: Optional[NGramData] = field(default=None, compare=False, repr=False)
+    '''Chains of 3+ words, if enabled by 'markov_ngram_order' for this kind of target'''
+
+    def __post_init__(self):
+        if not isinstance(self.data, (ModelData, CompactModelData)):
+            self.data = new_model_data(self.data)
 
     @property
     def server_id(self) -> int:
@@ -31,24 +51,25 @@ class Model:
 
     @classmethod
     def parse_data(cls, text: str) -> ModelData:
-        data: ModelData = {}
         max_weight = config.get('markov_model_max_weight', 9999)
-        for line in text.strip().splitlines():
-            (first_word, next_word, count) = line.strip().split(' ')
-            weight = min(int(count), max_weight)  # limit word count
-            data.setdefault(first_word, {})
-            next_words = data[first_word]
-            next_words.setdefault(next_word, 0)
-            next_words[next_word] += weight
-        return data
+        if _is_compact_backend():
+            return CompactModelData.parse(text, max_weight)
+        return ModelData.parse(text, max_weight)
 
     @classmethod
     def _serialize_data(cls, data: ModelData) -> str:
-        lines: list[str] = []
-        for first_word, next_words in data.items():
-            for next_word, count in next_words.items():
-                lines.append(f'{first_word} {next_word} {count}')
-        return '\n'.join(sorted(lines))
+        return '\n'.join(cls._iter_serialized_lines(data))
+
+    @classmethod
+    def _iter_serialized_lines(cls, data: ModelData) -> Iterator[str]:
+        """
+        Yields lines of 'first_word next_word count', sorted.
+        Words never contain spaces, so sorting by words sorts the lines.
+        """
+        for first_word in sorted(data.keys()):
+            next_words = data[first_word]
+            for next_word in sorted(next_words.keys()):
+                yield f'{first_word} {next_word} {next_words[next_word]}'
 
     def serialize_data(self) -> str:
         return self._serialize_data(self.data)
@@ -56,12 +77,7 @@ class Model:
     @classmethod
     def _append_word_pair(cls, data: ModelData, w1: str, w2: str, count: int = 1):
         """Update data with this new word pair"""
-        w1 = w1.lower()
-        w2 = w2.lower()
-        data.setdefault(w1, {})
-        next_words = data[w1]
-        next_words.setdefault(w2, 0)
-        next_words[w2] += count
+        data.append(w1.lower(), w2.lower(), count)
 
     def append_word_pair(self, w1: str, w2: str, count: int = 1):
         """Update this Model's data with this new word pair"""
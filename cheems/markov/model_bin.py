@@ -0,0 +1,198 @@
+"""
+Binary format for Markov model data, stored in a '.bin' file next to the model's '.xml' file.
+The file is memory-mapped and queried in place, so loading it is near-instant,
+and the page cache is shared between processes that use the same model.
+
+Layout, all numbers are little-endian uint32 on any machine:
+    header: magic, version, vocabulary size, row count, pair count
+    vocabulary offsets: (vocabulary size + 1) offsets into the word table
+    row ids: ids of first words, sorted
+    row offsets: (row count + 1) offsets into next ids and counts
+    next ids
+    cumulative counts: running sums within each row
+    word table: UTF-8 words, sorted, so that ids can be found with binary search
+
+See `convert_models.py` for converting model directories between formats.
+"""
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections.abc import Mapping
+from itertools import accumulate
+from typing import Optional, Union
+
+from cheems.markov.compact_model_data import CompactModelData, Vocabulary
+
+BIN_MAGIC = b'CHMB'
+BIN_FORMAT_VERSION = 1
+_header = struct.Struct('<4sIIII')
+
+
+class _MmapWordTable:
+    """List-like access to words by id, decoded from the file on demand"""
+
+    def __init__(self, vocab: 'MmapVocabulary'):
+        self.vocab = vocab
+
+    def __getitem__(self, word_id: int) -> str:
+        return self.vocab.get_word(word_id)
+
+    def __len__(self) -> int:
+        return len(self.vocab)
+
+
+class MmapVocabulary(Vocabulary):
+    """
+    Sorted vocabulary from the binary file.
+    Words added later are stored in memory, with ids after the ones in the file.
+    """
+
+    def __init__(self, buffer: mmap.mmap, offsets: memoryview, table_start: int):
+        super().__init__()
+        self._buffer = buffer
+        self._offsets = offsets
+        self._table_start = table_start
+        self._file_size = len(offsets) - 1
+        self.words = _MmapWordTable(self)
+        self._new_words: list[str] = []
+
+    def __len__(self) -> int:
+        return self._file_size + len(self._new_words)
+
+    def _get_bytes(self, word_id: int) -> bytes:
+        start = self._table_start + self._offsets[word_id]
+        end = self._table_start + self._offsets[word_id + 1]
+        return self._buffer[start:end]
+
+    def get_word(self, word_id: int) -> str:
+        if word_id < self._file_size:
+            return self._get_bytes(word_id).decode('utf-8')
+        return self._new_words[word_id - self._file_size]
+
+    def get_id(self, word: str) -> Optional[int]:
+        target = word.encode('utf-8')
+        lo = 0
+        hi = self._file_size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get_bytes(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._file_size and self._get_bytes(lo) == target:
+            return lo
+        return self.ids.get(word, None)
+
+    def intern(self, word: str) -> int:
+        word_id = self.get_id(word)
+        if word_id is None:
+            word_id = len(self)
+            self.ids[word] = word_id
+            self._new_words.append(word)
+        return word_id
+
+
+class MmapModelData(CompactModelData):
+    """
+    CompactModelData whose arrays are read in place from a memory-mapped '.bin' file.
+    Fresh training goes into the overflow buffer, and compaction moves the data into memory.
+    """
+
+    path: str
+
+    approx_bytes_per_pair = 0
+    '''Mapped pages are backed by the file, so the OS can reclaim them'''
+
+    _file_next_ids: Union[memoryview, array, None] = None
+    '''Next ids as read from the file, until compaction replaces them'''
+
+    def __reduce__(self):
+        if len(self._overflow) == 0 and self._next_ids is self._file_next_ids:
+            # the file is unchanged, so the receiving process can map it again
+            return MmapModelData.open, (self.path,)
+        return super().__reduce__()
+
+    @classmethod
+    def open(cls, path: str) -> 'MmapModelData':
+        """
+        On big-endian machines, the arrays are byteswapped into memory,
+        and only the word table is read in place.
+        The indexes of `build_indexes` are built here, on the thread that loads the model.
+        """
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, vocab_size, row_count, pair_count = _header.unpack_from(buffer, 0)
+        if magic != BIN_MAGIC or version != BIN_FORMAT_VERSION:
+            raise ValueError(f'Unsupported binary model format: {path}')
+        view = memoryview(buffer)
+        pos = _header.size
+
+        def read_array(length: int) -> Union[memoryview, array]:
+            nonlocal pos
+            arr = view[pos:pos + 4 * length].cast('I')
+            pos += 4 * length
+            if sys.byteorder != 'little':
+                arr = array('I', arr)
+                arr.byteswap()
+            return arr
+
+        vocab_offsets = read_array(vocab_size + 1)
+        row_ids = read_array(row_count)
+        offsets = read_array(row_count + 1)
+        next_ids = read_array(pair_count)
+        cum_counts = read_array(pair_count)
+        data = cls(vocab=MmapVocabulary(buffer, vocab_offsets, pos))
+        data.path = path
+        data._row_ids = row_ids
+        data._offsets = offsets
+        data._next_ids = next_ids
+        data._file_next_ids = next_ids
+        data._cum_counts = cum_counts
+        data.build_indexes()
+        return data
+
+
+def write_model_bin(data: Mapping[str, Mapping[str, int]], path: str):
+    """Writes the data into a binary file, replacing it atomically."""
+    words: set[str] = set()
+    for first_word, next_words in data.items():
+        words.add(first_word)
+        words.update(next_words.keys())
+    # code point order is the same as UTF-8 byte order
+    vocab = sorted(words)
+    ids = {w: i for i, w in enumerate(vocab)}
+    encoded = [w.encode('utf-8') for w in vocab]
+
+    vocab_offsets = array('I', [0])
+    vocab_offsets.extend(accumulate(len(b) for b in encoded))
+    row_ids = array('I')
+    offsets = array('I', [0])
+    next_ids = array('I')
+    cum_counts = array('I')
+    for first_word in sorted(data.keys()):
+        next_words = data[first_word]
+        row_ids.append(ids[first_word])
+        next_ids.extend(ids[w] for w in next_words.keys())
+        cum_counts.extend(accumulate(next_words.values()))
+        offsets.append(len(next_ids))
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_header.pack(BIN_MAGIC, BIN_FORMAT_VERSION, len(vocab), len(row_ids), len(next_ids)))
+        for arr in (vocab_offsets, row_ids, offsets, next_ids, cum_counts):
+            if sys.byteorder != 'little':
+                arr.byteswap()
+            f.write(arr.tobytes())
+        for b in encoded:
+            f.write(b)
+        f.flush()
+        os.fsync(f.fileno())
+    # replacing keeps the old file intact for processes that still have it mapped
+    os.replace(tmp_path, path)
+
+
+def get_bin_path(xml_path: str) -> str:
+    """Returns the path of the '.bin' file next to the model's '.xml' file"""
+    return os.path.splitext(xml_path)[0] + '.bin'
@@ -0,0 +1,236 @@
+import random
+from itertools import accumulate, groupby
+from typing import Iterator, Mapping, Optional
+
+# these characters indicate end of a sentence
+ENDS = '.?!'
+
+SENTENCE_START = ENDS[0]
+'''
+Words that start a sentence are stored as next words of this key,
+i.e. as if they followed the end of a previous sentence.
+'''
+
+SamplingTable = tuple[list[str], list[int]]
+'''Next words and their cumulative weights, for use with `random.choices`'''
+
+
+class ModelData(dict[str, dict[str, int]]):
+    """
+    E.g. { first_word: {next_word: 1}}
+    next_word includes punctuation attached to the preceding world, e.g. 'hello' - ',my'
+
+    Sampling tables for picking the next word are built lazily on first use,
+    so that each step of a Markov chain costs O(log k) instead of O(k).
+    Rows must be updated via `append`, so that their tables are invalidated
+    and the indexes of `build_indexes` are kept up to date.
+    """
+
+    approx_bytes_per_pair = 80
+    '''Memory taken by a word pair, as measured by benchmarks/model_memory_benchmark.py'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sampling_tables: dict[str, SamplingTable] = {}
+        self._non_terminal_words: list[str] = []
+        '''Words that can be followed by something other than END'''
+        self._non_terminal_set: set[str] = set()
+        self._end_count = 0
+        '''Total count of pairs that end a sentence'''
+        self._own_rows: Optional[set[str]] = None
+        '''Rows that aren't shared with the last `snapshot`, or None if there was none'''
+        if len(self) > 0:
+            self.build_indexes()
+
+    @property
+    def pair_count(self) -> int:
+        return sum(len(next_words) for next_words in self.values())
+
+    @classmethod
+    def parse(cls, text: str, max_weight: int) -> 'ModelData':
+        """Parses lines of 'first_word next_word count'"""
+        data = cls()
+        for first_word, row in parse_rows(text, max_weight):
+            next_words = data.get(first_word, None)
+            if next_words is None:
+                data[first_word] = row
+            else:
+                _merge_row(next_words, row)
+        data.build_indexes()
+        return data
+
+    def snapshot(self) -> 'ModelData':
+        """
+        Returns a copy of the rows that can be read by another thread, e.g. for saving.
+        Rows are shared with the copy, and copied on write by `append`, so only the outer dict is copied now.
+        The copy doesn't sample words, so its indexes are left empty.
+        """
+        data = ModelData()
+        dict.update(data, self)
+        self._own_rows = set()
+        return data
+
+    def _get_own_row(self, w1: str) -> dict[str, int]:
+        """Returns the row to be updated, after creating it, or copying it if it's shared with a snapshot"""
+        next_words = self.get(w1, None)
+        if next_words is None:
+            next_words = self[w1] = {}
+        elif self._own_rows is None or w1 in self._own_rows:
+            return next_words
+        else:
+            next_words = self[w1] = next_words.copy()
+        if self._own_rows is not None:
+            self._own_rows.add(w1)
+        return next_words
+
+    def append(self, w1: str, w2: str, count: int = 1):
+        """Update data with this new word pair"""
+        next_words = self._get_own_row(w1)
+        next_words[w2] = next_words.get(w2, 0) + count
+        self._sampling_tables.pop(w1, None)
+        self._update_indexes(w1, w2, count)
+
+    def append_pairs(self, counts: Mapping[tuple[str, str], int]):
+        """Same as `append` for each pair and its count, but faster for many pairs"""
+        tables = self._sampling_tables
+        for (w1, w2), count in counts.items():
+            next_words = self._get_own_row(w1)
+            next_words[w2] = next_words.get(w2, 0) + count
+            if tables:
+                tables.pop(w1, None)
+            self._update_indexes(w1, w2, count)
+
+    def _update_indexes(self, w1: str, w2: str, count: int):
+        if w1 == SENTENCE_START:
+            return
+        if w2 in ENDS:
+            self._end_count += count
+        elif w1 not in self._non_terminal_set:
+            self._non_terminal_set.add(w1)
+            self._non_terminal_words.append(w1)
+
+    def build_indexes(self):
+        """
+        Goes through all the words to find the ones that `is_non_terminal` and `get_random_first_word` use,
+        which training then keeps up to date. Runs where the data is loaded, e.g. on a loader thread,
+        so that the first chain doesn't wait for it.
+        """
+        self._non_terminal_words = [
+            w for w, next_words in self.items()
+            if w != SENTENCE_START and any(y not in ENDS for y in next_words.keys())
+        ]
+        self._non_terminal_set = set(self._non_terminal_words)
+        self._end_count = sum(
+            count for w, next_words in self.items() if w != SENTENCE_START
+            for y, count in next_words.items() if y in ENDS
+        )
+
+    def get_sampling_table(self, word: str) -> Optional[SamplingTable]:
+        """Returns the cached table of next words, or None if there are none."""
+        table = self._sampling_tables.get(word, None)
+        if table is None:
+            next_words = self.get(word, None)
+            if not next_words:
+                return None
+            table = (list(next_words.keys()), list(accumulate(next_words.values())))
+            self._sampling_tables[word] = table
+        return table
+
+    def get_random_next_word(self, word: str) -> Optional[str]:
+        """Weighted according to data. Returns None if there are no next words."""
+        table = self.get_sampling_table(word)
+        if table is None:
+            return None
+        words, cum_weights = table
+        return random.choices(words, cum_weights=cum_weights)[0]
+
+    def is_non_terminal(self, word: str) -> bool:
+        """True if the word can be followed by something other than END, i.e. a chain can continue from it"""
+        return word in self._non_terminal_set
+
+    def get_random_first_word(self) -> Optional[str]:
+        """
+        Picks a word that starts a sentence, weighted by how often it did.
+        Older models were trained without sentence starts, so for the share of sentences
+        whose start isn't known it falls back to any word that doesn't immediately end the chain,
+        or finally to any word at all. See `get_start_share`.
+        Returns None if the model is empty.
+        """
+        table = self.get_sampling_table(SENTENCE_START)
+        if table is not None and random.random() < get_start_share(table[1][-1], self._end_count):
+            return random.choices(table[0], cum_weights=table[1])[0]
+        if len(self._non_terminal_words) > 0:
+            return random.choice(self._non_terminal_words)
+        if len(self) == 0:
+            return None
+        return random.choice(list(self.keys()))
+
+
+def get_start_share(start_count: int, end_count: int) -> float:
+    """
+    Fraction of the sentences in a model whose start was recorded: models trained before sentence starts
+    were stored only have a few starts from training since, but all the ends.
+    """
+    if end_count <= start_count:
+        return 1.0
+    return start_count / end_count
+
+
+_parse_chunk_size = 4 * 1024 * 1024
+'''Characters of text that are split into words at once, which limits the memory it takes'''
+
+
+def parse_rows(text: str, max_weight: int) -> Iterator[tuple[str, dict[str, int]]]:
+    """
+    Parses lines of 'first_word next_word count' into rows of next words and their counts,
+    limited by max_weight. Repeated pairs within a row are summed.
+    The same first word is yielded again only if its lines aren't contiguous.
+
+    Words never contain whitespace, so text is split in large chunks rather than line by line.
+    Saved models are sorted by first word, so each row is a contiguous run of lines.
+    """
+    weights_by_str: dict[str, int] = {}
+    last_row: Optional[tuple[str, dict[str, int]]] = None
+    '''The last row of a chunk is held back, because it can continue in the next chunk'''
+    pos = 0
+    while pos < len(text):
+        chunk_end = text.find('\n', pos + _parse_chunk_size)
+        if chunk_end < 0:
+            chunk_end = len(text)
+        tokens = text[pos:chunk_end].split()
+        pos = chunk_end + 1
+        if len(tokens) % 3 != 0:
+            raise ValueError("Expected lines of 'first_word next_word count'")
+        first_words = tokens[0::3]
+        next_words = tokens[1::3]
+        count_strs = tokens[2::3]
+        del tokens
+        # there are few distinct counts, so each is parsed once
+        for count in set(count_strs).difference(weights_by_str.keys()):
+            weights_by_str[count] = min(int(count), max_weight)
+        weights = list(map(weights_by_str.__getitem__, count_strs))
+        del count_strs
+
+        start = 0
+        for first_word, group in groupby(first_words):
+            end = start + len(list(group))
+            row = dict(zip(next_words[start:end], weights[start:end]))
+            if len(row) < end - start:
+                # some next words are repeated, so they are summed
+                row = {}
+                for i in range(start, end):
+                    row[next_words[i]] = row.get(next_words[i], 0) + weights[i]
+            start = end
+            if last_row is not None:
+                if last_row[0] == first_word:
+                    _merge_row(last_row[1], row)
+                    continue
+                yield last_row
+            last_row = (first_word, row)
+    if last_row is not None:
+        yield last_row
+
+
+def _merge_row(row: dict[str, int], other: dict[str, int]):
+    for next_word, count in other.items():
+        row[next_word] = row.get(next_word, 0) + count
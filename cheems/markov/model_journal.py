@@ -0,0 +1,114 @@
+"""
+Append-only journal of training since the model file was last written in full.
+Saving a few new word pairs then costs a small append instead of rewriting the whole model.
+
+The journal is a text file next to the model's '.xml' file:
+
+    # base <size> <mtime_ns> [<bin_size> <bin_mtime_ns>]
+    + first_word next_word count
+    + first_word next_word count
+    * context... next_word count
+    @ <from_time> <to_time> <updated_time>
+    ...
+
+The first line identifies the model file the journal applies to, and its '.bin' file if it exists,
+so that a journal left over from a crash during compaction isn't applied twice,
+even if only the '.bin' file was written.
+Each save appends the pair increments and n-gram increments (see `NGramData`),
+followed by the model's times, which also mark the end of the save.
+Incomplete saves at the end are ignored on replay.
+"""
+import logging
+import os
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Iterator, Mapping, Optional
+
+from cheems.markov.model_bin import get_bin_path
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class JournalRecord:
+    """Training saved at once"""
+    from_time: datetime
+    to_time: datetime
+    updated_time: datetime
+    pairs: list[tuple[str, str, int]] = field(default_factory=list)
+    ngrams: list[tuple[tuple[str, ...], int]] = field(default_factory=list)
+
+
+def get_journal_path(xml_path: str) -> str:
+    """Returns the path of the '.journal' file next to the model's '.xml' file"""
+    return os.path.splitext(xml_path)[0] + '.journal'
+
+
+def _get_base_line(xml_path: str) -> str:
+    stat = os.stat(xml_path)
+    line = f'# base {stat.st_size} {stat.st_mtime_ns}'
+    bin_path = get_bin_path(xml_path)
+    if os.path.exists(bin_path):
+        bin_stat = os.stat(bin_path)
+        line += f' {bin_stat.st_size} {bin_stat.st_mtime_ns}'
+    return line + '\n'
+
+
+def append_journal(
+        xml_path: str,
+        pairs: Mapping[str, Mapping[str, int]],
+        from_time: datetime,
+        to_time: datetime,
+        updated_time: datetime,
+        ngrams: Mapping[tuple[str, ...], int] = None,
+) -> int:
+    """
+    Appends the pair increments, n-gram increments and the model's times.
+    :return: size of the journal file after the append
+    """
+    lines = []
+    journal_path = get_journal_path(xml_path)
+    if not os.path.exists(journal_path) or os.path.getsize(journal_path) == 0:
+        lines.append(_get_base_line(xml_path))
+    for first_word, next_words in pairs.items():
+        for next_word, count in next_words.items():
+            lines.append(f'+ {first_word} {next_word} {count}\n')
+    for ngram, count in (ngrams or {}).items():
+        lines.append(f'* {" ".join(ngram)} {count}\n')
+    lines.append(f'@ {from_time.isoformat()} {to_time.isoformat()} {updated_time.isoformat()}\n')
+    with open(journal_path, 'a', encoding='utf-8') as f:
+        f.write(''.join(lines))
+    return os.path.getsize(journal_path)
+
+
+def read_journal(xml_path: str) -> Iterator[JournalRecord]:
+    """Reads complete records from the journal, if it exists and applies to the current model file"""
+    journal_path = get_journal_path(xml_path)
+    if not os.path.exists(journal_path):
+        return
+    with open(journal_path, encoding='utf-8') as f:
+        base_line = f.readline()
+        if base_line != _get_base_line(xml_path):
+            logger.warning(f'Ignoring journal for a different model file: {journal_path}')
+            return
+        pairs: list[tuple[str, str, int]] = []
+        ngrams: list[tuple[tuple[str, ...], int]] = []
+        for line in f:
+            if not line.endswith('\n'):
+                break  # the last save was interrupted
+            tag, *values = line.rstrip('\n').split(' ')
+            if tag == '+':
+                first_word, next_word, count = values
+                pairs.append((first_word, next_word, int(count)))
+            elif tag == '*':
+                ngrams.append((tuple(values[:-1]), int(values[-1])))
+            elif tag == '@':
+                from_time, to_time, updated_time = (datetime.fromisoformat(v) for v in values)
+                yield JournalRecord(from_time, to_time, updated_time, pairs, ngrams)
+                pairs = []
+                ngrams = []
+
+
+def remove_journal(xml_path: Optional[str]):
+    if xml_path is not None and os.path.exists(get_journal_path(xml_path)):
+        os.remove(get_journal_path(xml_path))
@@ -1,9 +1,14 @@
+import dataclasses
 import logging
-from dataclasses import dataclass
-from typing import Optional
+import os
+from dataclasses import dataclass, field
+from typing import Iterable, Optional
 
 from cheems.base_xml_data_model import BaseXmlDataModel
-from cheems.markov.model import Model
+from cheems.markov.model import Model, ModelData
+from cheems.markov.model_bin import MmapModelData, get_bin_path
+from cheems.markov.model_journal import read_journal
+from cheems.markov.ngram_data import NGramData, get_ngram_order, get_ngrams_path, read_ngrams_file
 
 logger = logging.getLogger(__name__)
 
@@ -12,42 +17,116 @@ logger = logging.getLogger(__name__)
 class XmlModel(Model, BaseXmlDataModel):
     """
     Markov chain model which is serialized specifically to a XML file.
+    If there is a '.bin' file next to it, the data is memory-mapped from that file instead.
+    Training saved since the file was last written in full is replayed from the '.journal' file.
+    N-grams, if enabled for this kind of target, are read from the '.ngrams' file.
     """
     file_path: Optional[str] = None
+    unsaved_pairs: ModelData = field(default_factory=ModelData, compare=False, repr=False)
+    '''Pairs appended since the last save, which go into the journal'''
+    unsaved_ngrams: Optional[NGramData] = field(default=None, compare=False, repr=False)
+    '''N-grams appended since the last save, which go into the journal'''
+    has_base_file: bool = field(default=False, compare=False, repr=False)
+    '''True if the file holds this model's data, so that the journal can be appended to it'''
 
     def __hash__(self) -> int:
         return hash(self.target)
 
+    @property
+    def bin_file_path(self) -> Optional[str]:
+        return None if self.file_path is None else get_bin_path(self.file_path)
+
     @classmethod
     def from_model(cls, model: Model, file_path: str = None) -> 'XmlModel':
         return cls(**model.__dict__, file_path=file_path)
 
     @classmethod
     def from_base_model(cls, xml_model: BaseXmlDataModel) -> 'XmlModel':
-        data = Model.parse_data(xml_model.raw_data)
+        if xml_model.is_data_loaded:
+            data = _load_model_data(xml_model.file_path, xml_model.raw_data)
+        else:
+            data = Model.parse_data('')
         fields = xml_model.__dict__.copy()
         fields['raw_data'] = ''  # delete the raw string to save memory
-        return cls(**fields, data=data)
+        m = cls(**fields, data=data)
+        if m.is_data_loaded:
+            m._load_ngrams()
+        if m.is_data_loaded and not m.has_unsaved_changes:
+            # the data was read from the file
+            m._replay_journal()
+        return m
 
     @classmethod
     def from_xml_file(cls, file_path: str, load_data: bool = True) -> 'XmlModel':
-        with open(file_path, encoding='utf-8') as f:
-            xml_str = f.read()
-        m = cls.from_xml(xml_str, load_data)
-        m.file_path = file_path
-        return m
+        xml_model = BaseXmlDataModel._read_xml_file(file_path, load_data)
+        return cls.from_base_model(xml_model)
 
     @classmethod
     def from_xml(cls, xml_str: str, load_data: bool = True) -> 'XmlModel':
         xml_model = BaseXmlDataModel.from_xml(xml_str, load_data)
         return XmlModel.from_base_model(xml_model)
 
-    def to_xml(self, pretty_print: bool = True) -> str:
-        self.raw_data = self.serialize_data()
-        output = super().to_xml(pretty_print)
-        self.raw_data = ''  # delete the raw string to save memory
-        return output
+    def iter_data_lines(self) -> Iterable[str]:
+        return self._iter_serialized_lines(self.data)
 
     def load_data(self):
         super().load_data()
-        self.data = Model.parse_data(self.raw_data)
+        self.data = _load_model_data(self.file_path, self.raw_data)
+        self.unsaved_pairs = ModelData()
+        self._load_ngrams()
+        self._replay_journal()
+
+    def _load_ngrams(self):
+        order = get_ngram_order(self.target)
+        if order < 2:
+            self.ngrams = self.unsaved_ngrams = None
+            return
+        if self.file_path is None:
+            self.ngrams = NGramData(order)
+        else:
+            self.ngrams = read_ngrams_file(get_ngrams_path(self.file_path), order)
+        self.unsaved_ngrams = NGramData(order)
+
+    def _replay_journal(self):
+        if self.file_path is None:
+            return
+        self.has_base_file = True
+        for record in read_journal(self.file_path):
+            for first_word, next_word, count in record.pairs:
+                self.data.append(first_word, next_word, count)
+            if self.ngrams is not None:
+                self.ngrams.append_ngrams(dict(record.ngrams))
+            self.from_time = record.from_time
+            self.to_time = record.to_time
+            self.updated_time = record.updated_time
+
+    def append_word_pair(self, w1: str, w2: str, count: int = 1):
+        super().append_word_pair(w1, w2, count)
+        self._append_word_pair(self.unsaved_pairs, w1, w2, count)
+
+    def snapshot(self) -> 'XmlModel':
+        """The data is shared with the copy until either is changed, and the unsaved journal stays here"""
+        ngrams = self.ngrams.snapshot() if self.ngrams is not None else None
+        return dataclasses.replace(self, data=self.data.snapshot(), ngrams=ngrams,
+                                   unsaved_pairs=ModelData(), unsaved_ngrams=None)
+
+    def unload_data(self):
+        super().unload_data()
+        self.data = Model.parse_data('')
+        self.ngrams = self.unsaved_ngrams = None
+
+    def get_data_size(self) -> tuple[int, int]:
+        pair_count = self.data.pair_count
+        size = pair_count * self.data.approx_bytes_per_pair
+        if self.ngrams is not None:
+            size += self.ngrams.ngram_count * NGramData.approx_bytes_per_ngram
+        return pair_count, size
+
+
+def _load_model_data(file_path: Optional[str], raw_data: str) -> ModelData:
+    """Maps the '.bin' file if it exists, otherwise parses the XML payload"""
+    if file_path is not None:
+        bin_path = get_bin_path(file_path)
+        if os.path.exists(bin_path):
+            return MmapModelData.open(bin_path)
+    return Model.parse_data(raw_data)
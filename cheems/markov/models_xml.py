@@ -1,10 +1,21 @@
+import dataclasses
 import logging
-from typing import Optional
+import os
+from collections import Counter
+from datetime import datetime
+from typing import Iterable, Optional
 
 from cheems.base_xml_data_model import BaseXmlDataModel
 from cheems.config import config
-from cheems.markov.model import Model
+from cheems.discord_helper import EPOCH
+from cheems.markov.model import Model, ModelData
+from cheems.markov.model_bin import write_model_bin, MmapModelData, get_bin_path
+from cheems.markov.model_journal import append_journal, remove_journal, get_journal_path, read_journal
 from cheems.markov.model_xml import XmlModel
+from cheems.markov.ngram_data import NGramData, get_ngrams_path, get_ngram_order, write_ngrams_file, \
+    iter_ngrams_file_lines, merge_ngrams_file, serialize_ngram_counts
+from cheems.metrics import metrics
+from cheems.model_writer import WriteJob, ChainedJob
 from cheems.targets import Target
 from cheems.xml_data_model_storage import XmlDataModelStorage
 
@@ -12,12 +23,202 @@ logger = logging.getLogger(__name__)
 
 
 class MarkovStorage(XmlDataModelStorage[XmlModel]):
-    def ensure_type(self, base: BaseXmlDataModel) -> XmlModel:
+    max_weight_key = 'markov_model_max_weight'
+    metrics_name = 'markov'
+    journal_compact_ratio: float
+    '''The journal is compacted into the model file when it reaches this fraction of its size'''
+
+    def __init__(self, root_dir):
+        super().__init__(root_dir)
+        self.journal_compact_ratio = float(config.get('markov_journal_compact_ratio', 0.25))
+
+    @classmethod
+    def ensure_type(cls, base: BaseXmlDataModel) -> XmlModel:
         return XmlModel.from_base_model(base)
 
+    def save_model(self, xml_model: XmlModel, compact: bool = False):
+        """
+        New word pairs and times are appended to the model's journal,
+        until it grows large enough to be compacted, i.e. the whole model is rewritten.
+
+        With 'markov_model_format: bin' the data is saved into a '.bin' file,
+        and the xml file only keeps the header.
+
+        :param compact: rewrite the whole model, e.g. when its data was changed
+            other than via `append_word_pair` or training.
+        If the data was unloaded, e.g. evicted, only the times and unsaved pairs are appended to the journal,
+        because rewriting the model would lose its data.
+        """
+        self._ensure_file_path(xml_model)
+        if not xml_model.is_data_loaded:
+            if not os.path.exists(xml_model.file_path):
+                logger.warning(f'Not saving model "{xml_model.target}": its data is not loaded')
+                return
+            job = _JournalJob(xml_model)
+        elif not compact and self._can_append_journal(xml_model):
+            job = _JournalJob(xml_model)
+        else:
+            job = _FullSaveJob(self, xml_model, config.get('markov_model_format', 'xml') == 'bin')
+            xml_model.has_base_file = True
+        xml_model.unsaved_pairs = ModelData()
+        if xml_model.unsaved_ngrams is not None:
+            xml_model.unsaved_ngrams = NGramData(xml_model.unsaved_ngrams.order)
+        self._submit_write(xml_model, job)
+
+    def save_model_lines(self, xml_model: XmlModel, lines: Iterable[str]):
+        """
+        The lines are always saved into the xml file.
+        With 'markov_model_format: bin', the next full save converts it.
+        The n-grams in the journal are kept in the '.ngrams' file, and new ones are merged by `merge_model_lines`.
+        """
+        self._ensure_file_path(xml_model)
+        self.flush()
+        self._save_journal_ngrams(xml_model)
+        super().save_model_lines(xml_model, lines)
+        if os.path.exists(xml_model.bin_file_path):
+            os.remove(xml_model.bin_file_path)
+        remove_journal(xml_model.file_path)
+        xml_model.has_base_file = True
+        xml_model.unsaved_pairs = ModelData()
+
+    def merge_model_files(self, file_paths: list[str], target: Target = None) -> XmlModel:
+        """The n-grams of the files are merged into the model's '.ngrams' file as well"""
+        model = super().merge_model_files(file_paths, target)
+        if get_ngram_order(model.target) >= 2:
+            ngram_runs = [
+                run for path in file_paths if not os.path.samefile(model.file_path, path)
+                for run in self._open_ngram_runs(path)
+            ]
+            if len(ngram_runs) > 0:
+                merge_ngrams_file(get_ngrams_path(model.file_path), ngram_runs)
+        return model
+
+    def merge_model_lines(self, target: Target, runs: list[Iterable[str]],
+                          from_time: datetime = EPOCH, to_time: datetime = EPOCH,
+                          ngram_runs: list[Iterable[str]] = None) -> XmlModel:
+        """
+        :param ngram_runs: sorted runs of n-gram lines, which are merged into the model's '.ngrams' file.
+        """
+        model = super().merge_model_lines(target, runs, from_time, to_time)
+        if ngram_runs and get_ngram_order(target) >= 2:
+            merge_ngrams_file(get_ngrams_path(model.file_path), ngram_runs)
+        return model
+
+    @staticmethod
+    def _save_journal_ngrams(xml_model: XmlModel):
+        """Adds the n-grams from the journal to the '.ngrams' file, before the journal is removed"""
+        if get_ngram_order(xml_model.target) < 2:
+            return
+        journal_runs = MarkovStorage._open_ngram_runs(xml_model.file_path, include_file=False)
+        if len(journal_runs) > 0:
+            merge_ngrams_file(get_ngrams_path(xml_model.file_path), journal_runs)
+
+    @staticmethod
+    def _open_ngram_runs(file_path: str, include_file: bool = True) -> list[Iterable[str]]:
+        """Returns sorted runs of the n-gram lines of the model file, from its '.ngrams' file and its journal"""
+        runs: list[Iterable[str]] = []
+        ngrams_path = get_ngrams_path(file_path)
+        if include_file and os.path.exists(ngrams_path):
+            runs.append(iter_ngrams_file_lines(ngrams_path))
+        journal_ngrams: Counter[tuple[str, ...]] = Counter()
+        for record in read_journal(file_path):
+            journal_ngrams.update(dict(record.ngrams))
+        if len(journal_ngrams) > 0:
+            runs.append(serialize_ngram_counts(journal_ngrams.items()))
+        return runs
+
+    def _open_model_file(self, file_path: str) -> tuple[BaseXmlDataModel, list[Iterable[str]]]:
+        """The data is read from the '.bin' file if it exists, and the journal is a separate run"""
+        header, runs = super()._open_model_file(file_path)
+        bin_path = get_bin_path(file_path)
+        if os.path.exists(bin_path):
+            # mapped pages are backed by the file, so they don't take memory
+            # noinspection PyProtectedMember
+            runs = [Model._iter_serialized_lines(MmapModelData.open(bin_path))]
+        journal_pairs = ModelData()
+        for record in read_journal(file_path):
+            for first_word, next_word, count in record.pairs:
+                journal_pairs.append(first_word, next_word, count)
+            header.from_time = record.from_time
+            header.to_time = record.to_time
+        if len(journal_pairs) > 0:
+            # noinspection PyProtectedMember
+            runs.append(Model._iter_serialized_lines(journal_pairs))
+        return header, runs
+
+    def _can_append_journal(self, xml_model: XmlModel) -> bool:
+        if self.journal_compact_ratio <= 0 or not xml_model.is_data_loaded or not xml_model.has_base_file:
+            return False
+        is_bin = config.get('markov_model_format', 'xml') == 'bin'
+        if not os.path.exists(xml_model.file_path) or os.path.exists(xml_model.bin_file_path) != is_bin:
+            return False  # the format has changed
+        base_size = os.path.getsize(xml_model.file_path)
+        if os.path.exists(xml_model.bin_file_path):
+            base_size += os.path.getsize(xml_model.bin_file_path)
+        journal_path = get_journal_path(xml_model.file_path)
+        journal_size = os.path.getsize(journal_path) if os.path.exists(journal_path) else 0
+        return journal_size < base_size * self.journal_compact_ratio
+
+
+class _FullSaveJob(WriteJob):
+    """Rewrites the whole model and its n-grams from a snapshot, and removes its journal"""
+
+    def __init__(self, storage: MarkovStorage, xml_model: XmlModel, is_bin: bool):
+        self.storage = storage
+        # the writer thread needs a copy, because training continues meanwhile
+        if storage.writer is not None:
+            self.model = xml_model.snapshot()
+        else:
+            self.model = dataclasses.replace(xml_model, unsaved_pairs=ModelData(), unsaved_ngrams=None)
+        self.is_bin = is_bin
+
+    def run(self):
+        m = self.model
+        if self.is_bin:
+            write_model_bin(m.data, m.bin_file_path)
+        self.storage._write_model_file(m.file_path, m.header_to_xml(),
+                                       lambda f: m.write_xml(f, include_data=not self.is_bin))
+        if not self.is_bin and os.path.exists(m.bin_file_path):
+            os.remove(m.bin_file_path)
+        if m.ngrams is not None:
+            write_ngrams_file(get_ngrams_path(m.file_path), m.ngrams)
+        remove_journal(m.file_path)
+
+    def coalesce(self, newer: WriteJob) -> WriteJob:
+        if isinstance(newer, _JournalJob):
+            # the journal is appended to the new file
+            return ChainedJob(self, newer)
+        return newer
+
+
+class _JournalJob(WriteJob):
+    """Appends new pairs, n-grams and times to the model's journal"""
+
+    def __init__(self, xml_model: XmlModel):
+        self.file_path = xml_model.file_path
+        self.pairs = xml_model.unsaved_pairs
+        self.ngrams: Counter[tuple[str, ...]] = Counter(
+            dict(xml_model.unsaved_ngrams.items()) if xml_model.unsaved_ngrams is not None else {})
+        self.times: tuple[datetime, datetime, datetime] = \
+            (xml_model.from_time, xml_model.to_time, xml_model.updated_time)
+
+    def run(self):
+        append_journal(self.file_path, self.pairs, *self.times, ngrams=self.ngrams)
+
+    def coalesce(self, newer: WriteJob) -> WriteJob:
+        if isinstance(newer, _JournalJob):
+            for first_word, next_words in newer.pairs.items():
+                for next_word, count in next_words.items():
+                    self.pairs.append(first_word, next_word, count)
+            self.ngrams.update(newer.ngrams)
+            self.times = newer.times
+            return self
+        return newer
+
 
 # global storage instance
 markov_storage = MarkovStorage(config['markov_model_dir'])
+metrics.add_collector(markov_storage.collect_metrics)
 
 
 # methods that redirect to the global instance
@@ -26,8 +227,24 @@ def preload_models():
     markov_storage.preload_models()
 
 
-def load_models(load_data: bool = True):
-    markov_storage.load_models(load_data)
+def load_models(load_data: bool = True, workers: int = None):
+    markov_storage.load_models(load_data, workers)
+
+
+def save_manifest():
+    markov_storage.save_manifest()
+
+
+def start_writer():
+    markov_storage.start_writer()
+
+
+def stop_writer():
+    markov_storage.stop_writer()
+
+
+async def flush_async():
+    await markov_storage.flush_async()
 
 
 def save_model(model: Model):
@@ -45,3 +262,7 @@ def get_or_create_model(target: Target) -> XmlModel:
 
 def get_model(target: Target) -> Optional[XmlModel]:
     return markov_storage.get_model(target)
+
+
+async def get_model_async(target: Target) -> Optional[XmlModel]:
+    return await markov_storage.get_model_async(target)
@@ -0,0 +1,360 @@
+"""
+Higher-order Markov chains, where the next word depends on several previous words.
+Word pairs stay in `ModelData`, and chains of 3 or more words are stored in `NGramData`,
+which generation backs off from when it hasn't seen the longer context.
+
+Saved next to the model's '.xml' file as '.ngrams', in lines of 'context... next_word count', sorted.
+"""
+import os
+import random
+from array import array
+from bisect import bisect, bisect_left
+from itertools import accumulate
+from typing import Iterable, Iterator, Mapping, Optional, Sequence
+
+from cheems.config import config
+from cheems.markov.compact_model_data import Vocabulary, shared_vocabulary
+from cheems.model_writer import write_file_atomically
+from cheems.targets import Target
+from cheems.util import merge_sorted_lines
+
+NGram = tuple[str, ...]
+'''Context words followed by the next word, e.g. ('hello', 'my', 'world')'''
+
+
+def get_ngram_order(target: Target, orders: dict[str, int] = None) -> int:
+    """
+    Returns the number of previous words that pick the next word in models of this kind of target,
+    from config 'markov_ngram_order'. 1 means word pairs only.
+    :param orders: the config value, e.g. passed to a worker process.
+    """
+    if orders is None:
+        orders = config.get('markov_ngram_order', None) or {}
+    return int(orders.get(type(target).__name__.lower(), 1))
+
+
+def get_ngrams_path(xml_path: str) -> str:
+    """Returns the path of the '.ngrams' file next to the model's '.xml' file"""
+    return os.path.splitext(xml_path)[0] + '.ngrams'
+
+
+def read_ngrams_file(path: str, order: int) -> 'NGramData':
+    """Reads the '.ngrams' file, or returns empty n-grams if it doesn't exist"""
+    if not os.path.exists(path):
+        return NGramData(order)
+    with open(path, encoding='utf-8') as f:
+        return NGramData.from_lines(f, order, config.get('markov_model_max_weight', None))
+
+
+def iter_ngrams_file_lines(path: str) -> Iterator[str]:
+    """Yields the lines of the '.ngrams' file without reading it entirely"""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+
+def serialize_ngram_counts(counts: Iterable[tuple[NGram, int]]) -> Iterator[str]:
+    """Yields lines of 'context... next_word count', sorted by words"""
+    for ngram, count in sorted(counts):
+        yield f'{" ".join(ngram)} {count}'
+
+
+def merge_ngrams_file(path: str, runs: list[Iterable[str]]):
+    """
+    Merges sorted runs of n-gram lines, e.g. spilled from training, into the '.ngrams' file.
+    Like the data lines of models, they are streamed, so the n-grams are never all in memory.
+    """
+    if os.path.exists(path):
+        runs = [iter_ngrams_file_lines(path)] + list(runs)
+    lines = merge_sorted_lines(runs, config.get('markov_model_max_weight', None))
+
+    def write(f):
+        for line in lines:
+            f.write(line)
+            f.write('\n')
+
+    write_file_atomically(path, write)
+
+
+def write_ngrams_file(path: str, ngrams: 'NGramData'):
+    """Writes the '.ngrams' file, or removes it if there are no n-grams"""
+    if len(ngrams) == 0:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+    def write(f):
+        for line in ngrams.iter_serialized_lines():
+            f.write(line)
+            f.write('\n')
+
+    write_file_atomically(path, write)
+
+
+class NGramData:
+    """
+    Counts of next words after contexts of 2 to `order` words.
+
+    Contexts are stored in a trie of word ids, where the path from the root goes
+    from the most recent word backwards, so contexts with the same recent words share nodes,
+    and one walk down the trie finds the longest known context for backoff.
+    Like `CompactModelData`, each level of the trie is a sorted array of word ids, pointing to
+    slices of the next level, and every node of 2+ words points to a slice of next words
+    and their running counts. Fresh training goes into an overflow buffer, which is compacted
+    into the arrays once it grows large enough.
+    """
+
+    approx_bytes_per_ngram = 16
+    '''Memory taken by an n-gram, as measured by benchmarks/ngram_benchmark.py'''
+
+    compact_min_ngrams = 1024
+    '''Overflow is compacted when it exceeds this many n-grams, or 1/8 of the arrays'''
+
+    def __init__(self, order: int, vocab: Vocabulary = None):
+        """
+        :param order: maximum number of context words, at least 2.
+        """
+        if order < 2:
+            raise ValueError(f'N-grams need at least 2 context words, got {order}')
+        self.order = order
+        self.vocab = vocab if vocab is not None else shared_vocabulary
+        self._keys: list[array] = [array('I') for _ in range(order + 1)]
+        '''Word ids of the trie nodes at each depth, sorted within the children of each node. Depth 0 is unused.'''
+        self._child_offsets: list[array] = [array('I', [0]) for _ in range(order)]
+        '''Children of node i at depth d span [offsets[d][i], offsets[d][i + 1]) at depth d + 1'''
+        self._next_offsets: list[array] = [array('I', [0]) for _ in range(order + 1)]
+        '''Next words of node i at depth d >= 2 span [offsets[d][i], offsets[d][i + 1]) in the arrays below'''
+        self._next_ids = array('I')
+        self._cum_counts = array('I')
+        '''Counts in the form of running sums within each node, for sampling with bisect'''
+        self._overflow: dict[tuple[int, ...], dict[int, int]] = {}
+        '''Next word counts by reversed context ids'''
+        self._overflow_ngrams = 0
+
+    @classmethod
+    def parse(cls, text: str, order: int, max_weight: int, vocab: Vocabulary = None) -> 'NGramData':
+        """Parses lines of 'context... next_word count'. Contexts longer than `order` are skipped."""
+        return cls.from_lines(text.splitlines(), order, max_weight, vocab)
+
+    @classmethod
+    def from_lines(cls, lines: Iterable[str], order: int, max_weight: int = None,
+                   vocab: Vocabulary = None) -> 'NGramData':
+        data = cls(order, vocab)
+        intern = data.vocab.intern
+        for line in lines:
+            words = line.split()
+            if len(words) == 0:
+                continue
+            if len(words) < 4:
+                raise ValueError(f"Expected lines of 'context... next_word count': {line}")
+            if len(words) - 2 > order:
+                continue
+            count = int(words[-1])
+            if max_weight is not None:
+                count = min(count, max_weight)
+            context = tuple(intern(w) for w in reversed(words[:-2]))
+            data._append_ids(context, intern(words[-2]), count)
+        data.compact()
+        return data
+
+    def __reduce__(self):
+        """Pickles the n-grams as words, e.g. to send them from a loader process"""
+        return NGramData.from_lines, (list(self.iter_serialized_lines()), self.order)
+
+    def __len__(self) -> int:
+        return self.ngram_count
+
+    @property
+    def ngram_count(self) -> int:
+        return len(self._next_ids) + self._overflow_ngrams
+
+    def snapshot(self) -> 'NGramData':
+        """
+        Returns a copy that can be read by another thread, e.g. for saving.
+        The arrays are shared, because after compaction they are replaced, never modified.
+        """
+        self.compact()
+        data = NGramData(self.order, self.vocab)
+        data._keys = self._keys
+        data._child_offsets = self._child_offsets
+        data._next_offsets = self._next_offsets
+        data._next_ids = self._next_ids
+        data._cum_counts = self._cum_counts
+        return data
+
+    def append(self, ngram: NGram, count: int = 1):
+        """Adds the next word after the context, i.e. the last word after the ones before it"""
+        self.append_ngrams({ngram: count})
+
+    def append_ngrams(self, counts: Mapping[NGram, int]):
+        """Same as `append` for each n-gram and its count. Contexts longer than `order` are skipped."""
+        intern = self.vocab.intern
+        for ngram, count in counts.items():
+            if not 3 <= len(ngram) <= self.order + 1:
+                continue
+            context = tuple(intern(w) for w in reversed(ngram[:-1]))
+            self._append_ids(context, intern(ngram[-1]), count)
+        if self._overflow_ngrams > max(self.compact_min_ngrams, len(self._next_ids) // 8):
+            self.compact()
+
+    def _append_ids(self, context: tuple[int, ...], next_id: int, count: int):
+        next_counts = self._overflow.setdefault(context, {})
+        if next_id not in next_counts:
+            next_counts[next_id] = 0
+            self._overflow_ngrams += 1
+        next_counts[next_id] += count
+
+    def _find_path(self, context: Sequence[int]) -> list[int]:
+        """
+        Walks down the trie along the reversed context ids.
+        :return: indices of the nodes at depths 1, 2, ... as far as the context is found.
+        """
+        path = []
+        lo, hi = 0, len(self._keys[1])
+        for depth, word_id in enumerate(context, 1):
+            keys = self._keys[depth]
+            i = bisect_left(keys, word_id, lo, hi)
+            if i >= hi or keys[i] != word_id:
+                break
+            path.append(i)
+            if depth == self.order:
+                break
+            lo, hi = self._child_offsets[depth][i], self._child_offsets[depth][i + 1]
+        return path
+
+    def _get_next_counts(self, context: tuple[int, ...], node: int = None) -> dict[int, int]:
+        """Returns next word ids and their counts, from both the arrays and overflow"""
+        next_counts: dict[int, int] = {}
+        depth = len(context)
+        if node is None:
+            path = self._find_path(context)
+            node = path[-1] if len(path) == depth else None
+        if node is not None:
+            prev = 0
+            offsets = self._next_offsets[depth]
+            for i in range(offsets[node], offsets[node + 1]):
+                cum = self._cum_counts[i]
+                next_counts[self._next_ids[i]] = cum - prev
+                prev = cum
+        for next_id, count in self._overflow.get(context, {}).items():
+            next_counts[next_id] = next_counts.get(next_id, 0) + count
+        return next_counts
+
+    def get_random_next_word(self, history: Sequence[str]) -> Optional[str]:
+        """
+        Picks the next word after the longest context of 2 to `order` words at the end of history,
+        weighted according to data. Returns None if no such context is known,
+        so that the caller can back off to word pairs.
+        :param history: canonical forms of previous words, the most recent last.
+        """
+        context = []
+        for word in reversed(history[-self.order:]):
+            word_id = self.vocab.get_id(word)
+            if word_id is None:
+                break
+            context.append(word_id)
+        if len(context) < 2:
+            return None
+        path = self._find_path(context)
+        for depth in range(len(context), 1, -1):
+            node = path[depth - 1] if depth <= len(path) else None
+            key = tuple(context[:depth])
+            if key in self._overflow:
+                # this context has fresh training, so it needs to be merged first
+                next_counts = self._get_next_counts(key, node)
+                words = self.vocab.words
+                return words[random.choices(list(next_counts.keys()), list(next_counts.values()))[0]]
+            if node is None:
+                continue
+            # same as random.choices, but searching only within the node
+            start = self._next_offsets[depth][node]
+            end = self._next_offsets[depth][node + 1]
+            if start == end:
+                continue
+            total = self._cum_counts[end - 1]
+            i = bisect(self._cum_counts, random.random() * total, start, end - 1)
+            return self.vocab.words[self._next_ids[i]]
+        return None
+
+    def _iter_contexts(self) -> Iterator[tuple[int, ...]]:
+        """Yields reversed context ids of all nodes in the arrays with next words"""
+        def visit(depth: int, lo: int, hi: int, prefix: tuple[int, ...]):
+            for i in range(lo, hi):
+                context = prefix + (self._keys[depth][i],)
+                if depth >= 2 and self._next_offsets[depth][i] < self._next_offsets[depth][i + 1]:
+                    yield context, i
+                if depth < self.order:
+                    yield from visit(depth + 1, self._child_offsets[depth][i],
+                                     self._child_offsets[depth][i + 1], context)
+
+        return visit(1, 0, len(self._keys[1]), ())
+
+    def _get_all_counts(self) -> dict[tuple[int, ...], dict[int, int]]:
+        contexts = {context: self._get_next_counts(context, node) for context, node in self._iter_contexts()}
+        for context in self._overflow.keys():
+            if context not in contexts:
+                contexts[context] = self._get_next_counts(context)
+        return contexts
+
+    def compact(self):
+        """Merges the overflow buffer into the arrays."""
+        if len(self._overflow) == 0:
+            return
+        contexts = self._get_all_counts()
+        nodes: list[list[tuple[int, ...]]] = [[] for _ in range(self.order + 1)]
+        prefixes = set()
+        for context in contexts.keys():
+            for depth in range(1, len(context) + 1):
+                prefixes.add(context[:depth])
+        for prefix in sorted(prefixes):
+            nodes[len(prefix)].append(prefix)
+
+        keys = [array('I') for _ in range(self.order + 1)]
+        child_offsets = [array('I', [0]) for _ in range(self.order)]
+        next_offsets = [array('I', [0]) for _ in range(self.order + 1)]
+        next_ids = array('I')
+        cum_counts = array('I')
+        for depth in range(1, self.order + 1):
+            keys[depth].extend(node[-1] for node in nodes[depth])
+            if depth < self.order:
+                # children are sorted after their parents, so each parent's children are contiguous
+                children = nodes[depth + 1]
+                j = 0
+                for node in nodes[depth]:
+                    while j < len(children) and children[j][:depth] == node:
+                        j += 1
+                    child_offsets[depth].append(j)
+            if depth >= 2:
+                next_offsets[depth][0] = len(next_ids)
+                for node in nodes[depth]:
+                    next_counts = contexts.get(node, {})
+                    next_ids.extend(next_counts.keys())
+                    cum_counts.extend(accumulate(next_counts.values()))
+                    next_offsets[depth].append(len(next_ids))
+        self._keys = keys
+        self._child_offsets = child_offsets
+        self._next_offsets = next_offsets
+        self._next_ids = next_ids
+        self._cum_counts = cum_counts
+        self._overflow = {}
+        self._overflow_ngrams = 0
+
+    def items(self) -> Iterator[tuple[NGram, int]]:
+        """Yields n-grams of words and their counts"""
+        words = self.vocab.words
+        for context, next_counts in self._get_all_counts().items():
+            context_words = tuple(words[word_id] for word_id in reversed(context))
+            for next_id, count in next_counts.items():
+                yield context_words + (words[next_id],), count
+
+    def iter_serialized_lines(self) -> Iterator[str]:
+        """Yields lines of 'context... next_word count', sorted by words"""
+        return serialize_ngram_counts(self.items())
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, NGramData):
+            return NotImplemented
+        return self.order == other.order and dict(self.items()) == dict(other.items())
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({self.order}, {dict(self.items())})'
@@ -0,0 +1,166 @@
+"""
+Responses generated ahead of time for recently requested targets, so that `.che` pops a ready chain
+instead of running the model, and the pool is refilled in the background.
+Ready responses are dropped when the model is retrained or reloaded: the bot only sees training
+from the trainer process when it loads the model again, so the pool checks the model's version when popping.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Callable, Optional, Iterable
+
+from cheems.config import config
+from cheems.markov.markov import markov_chain, strip_punctuation
+from cheems.markov.model_xml import XmlModel
+from cheems.metrics import metrics
+from cheems.targets import Target
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ResponsePoolStats:
+    """Counters of popped responses and refills, for tuning the pool size"""
+    hits: int = 0
+    '''A ready response was popped'''
+    misses: int = 0
+    '''The target had no ready response, so it was generated on demand'''
+    invalidations: int = 0
+    '''Ready responses were dropped, because the model was retrained or reloaded'''
+    refills: int = 0
+    '''Refills that filled the pool'''
+    refill_seconds: float = 0
+    '''Total time of those refills'''
+
+    @property
+    def hit_rate(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests > 0 else 0.0
+
+    @property
+    def mean_refill_seconds(self) -> float:
+        return self.refill_seconds / self.refills if self.refills > 0 else 0.0
+
+
+def generate_response(model: XmlModel) -> str:
+    """Runs the model without a prompt until it gives a non-empty chain, up to 'markov_retry_limit' times"""
+    for _ in range(int(config.get('markov_retry_limit', 5))):
+        chain = markov_chain(model.data, ngrams=model.ngrams)
+        if len(strip_punctuation(chain)) > 0:
+            return chain
+    return ''
+
+
+def _get_key(target: Target) -> tuple:
+    """Same user has different models on different servers, like in the storage"""
+    return target.server_id, target.key
+
+
+def _get_version(model: XmlModel) -> tuple:
+    """Changes when the model's data is reloaded, or when it's trained in this process"""
+    return id(model.data), model.updated_time
+
+
+@dataclass
+class _TargetPool:
+    model: XmlModel
+    version: tuple
+    '''Version of the model the responses came from, see `_get_version`'''
+    responses: deque[str] = field(default_factory=deque)
+    refill_task: Optional[asyncio.Task] = None
+
+
+class ResponsePool:
+    """
+    Keeps up to `size` responses for each of the `max_targets` most recently requested targets.
+    Refills run on the event loop one chain at a time, so they never block it for long,
+    and they never touch a model while it's trained.
+    """
+    size: int
+    max_targets: int
+    stats: ResponsePoolStats
+    generate: Callable[[XmlModel], str]
+
+    def __init__(self, size: int = None, max_targets: int = None,
+                 generate: Callable[[XmlModel], str] = generate_response):
+        pool_config = config.get('markov_response_pool', None) or {}
+        self.size = int(pool_config.get('size', 0)) if size is None else size
+        self.max_targets = int(pool_config.get('max_targets', 20)) if max_targets is None else max_targets
+        self.stats = ResponsePoolStats()
+        self.generate = generate
+        self._pools: OrderedDict[tuple, _TargetPool] = OrderedDict()
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.size > 0 and self.max_targets > 0
+
+    def pop(self, model: XmlModel) -> Optional[str]:
+        """
+        Returns a ready response of the model, or None if there is none yet, and starts a refill.
+        Must be called on the event loop.
+        """
+        if not self.is_enabled:
+            return None
+        key = _get_key(model.target)
+        pool = self._pools.get(key, None)
+        if pool is not None and (pool.model is not model or pool.version != _get_version(model)):
+            # the model was reloaded or retrained
+            self._clear(pool)
+            pool.model = model
+            pool.version = _get_version(model)
+        if pool is None:
+            pool = _TargetPool(model, _get_version(model))
+            self._pools[key] = pool
+            while len(self._pools) > self.max_targets:
+                _, oldest = self._pools.popitem(last=False)
+                if oldest.refill_task is not None:
+                    oldest.refill_task.cancel()
+        self._pools.move_to_end(key)
+        if len(pool.responses) > 0:
+            self.stats.hits += 1
+            response = pool.responses.popleft()
+        else:
+            self.stats.misses += 1
+            response = None
+        self._start_refill(pool)
+        return response
+
+    def collect_metrics(self) -> Iterable[tuple[str, dict[str, object], float]]:
+        """Counters of the pool as gauges, see `Metrics.add_collector`"""
+        yield 'response_pool_hits', {}, self.stats.hits
+        yield 'response_pool_misses', {}, self.stats.misses
+        yield 'response_pool_invalidations', {}, self.stats.invalidations
+        yield 'response_pool_refills', {}, self.stats.refills
+        yield 'response_pool_refill_seconds', {}, self.stats.refill_seconds
+
+    def _clear(self, pool: _TargetPool):
+        if len(pool.responses) > 0:
+            self.stats.invalidations += 1
+            pool.responses.clear()
+
+    def _start_refill(self, pool: _TargetPool):
+        if pool.refill_task is None or pool.refill_task.done():
+            pool.refill_task = asyncio.get_running_loop().create_task(self._refill(pool))
+
+    async def _refill(self, pool: _TargetPool):
+        start = time.perf_counter()
+        while len(pool.responses) < self.size:
+            if not pool.model.is_data_loaded:
+                return  # evicted, so it's no longer hot
+            response = self.generate(pool.model)
+            if len(response) == 0:
+                return  # the model can't generate anything
+            pool.responses.append(response)
+            # let commands and training run between chains
+            await asyncio.sleep(0)
+        elapsed = time.perf_counter() - start
+        self.stats.refills += 1
+        self.stats.refill_seconds += elapsed
+        logger.debug(f'Refilled {self.size} responses of "{pool.model.target}" in {elapsed * 1000:.1f} ms')
+
+
+# global pool of '.che' responses
+response_pool = ResponsePool()
+metrics.add_collector(response_pool.collect_metrics)
@@ -11,6 +11,8 @@ from cheems.markov import models_xml
 from cheems.markov.markov import markov_chain, canonical_form, strip_punctuation,\
     get_last_word
 from cheems.markov.model import Model
+from cheems.markov.response_pool import response_pool
+from cheems.metrics import metrics
 from cheems.targets import Server, Target, User
 
 logger = logging.getLogger(__name__)
@@ -26,17 +28,23 @@ class MarkovCog(commands.Cog):
         """`.che @user/#channel` generate markov chain"""
         target = extract_target(ctx)
         logger.info(f'{ctx.author.name} requested .che: target: {target}')
-        model = models_xml.get_model(target)
-        if model is not None:
-            chain = _markov_chain_with_retry(model)
-            if isinstance(target, Server):
-                text = chain
-            elif hasattr(target, 'name'):
-                text = f'{target.name}: {chain}'
-            else:
-                text = chain
-            await ctx.send(text)
-            # await ctx.message.delete()
+        with metrics.timer('command_seconds', command='che', stage='total'):
+            with metrics.timer('command_seconds', command='che', stage='load'):
+                model = await models_xml.get_model_async(target)
+            if model is not None:
+                with metrics.timer('command_seconds', command='che', stage='generate'):
+                    chain = response_pool.pop(model)
+                    if chain is None:
+                        chain = _markov_chain_with_retry(model)
+                if isinstance(target, Server):
+                    text = chain
+                elif hasattr(target, 'name'):
+                    text = f'{target.name}: {chain}'
+                else:
+                    text = chain
+                with metrics.timer('command_seconds', command='che', stage='send'):
+                    await ctx.send(text)
+                # await ctx.message.delete()
 
     @commands.command()
     async def cho(self, ctx: Context):
@@ -49,12 +57,14 @@ class MarkovCog(commands.Cog):
         logger.info(f'{ctx.author.name} requested .cho: target: {target}, prompt: {prompt}')
         prompt = remove_mention(prompt, target)
 
-        response = _continue_prompt(target, prompt)
-        if len(response) > 0:
-            if isinstance(target, User):
-                response = f'{target.name}: {response}'
-            await ctx.send(response)
-            # await ctx.message.delete()
+        with metrics.timer('command_seconds', command='cho', stage='total'):
+            response = await _continue_prompt(target, prompt, 'cho')
+            if len(response) > 0:
+                if isinstance(target, User):
+                    response = f'{target.name}: {response}'
+                with metrics.timer('command_seconds', command='cho', stage='send'):
+                    await ctx.send(response)
+                # await ctx.message.delete()
 
     @commands.command()
     async def ask(self, ctx: Context):
@@ -66,7 +76,8 @@ class MarkovCog(commands.Cog):
         prompt = get_command_argument(ctx)
         logger.info(f'{ctx.author.name} requested .ask: target {target}, prompt: {prompt}')
         prompt = remove_mention(prompt, target)
-        await _ask(ctx, target, prompt)
+        with metrics.timer('command_seconds', command='ask', stage='total'):
+            await _ask(ctx, target, prompt)
 
     @commands.Cog.listener()
     async def on_message(self, msg: Message):
@@ -89,10 +100,12 @@ class MarkovCog(commands.Cog):
                 prompt = m.text.replace(f'<@{self.bot.user.id}>', '').strip()
                 last_word = get_last_word(prompt)
                 logger.info(f'{msg.author.name} mentioned bot: {m.text}')
-                response = _continue_prompt(m.server, last_word)
-                if len(response) > 0:
-                    await msg.channel.send(response)
-                    # await msg.delete()
+                with metrics.timer('command_seconds', command='mention', stage='total'):
+                    response = await _continue_prompt(m.server, last_word, 'mention')
+                    if len(response) > 0:
+                        with metrics.timer('command_seconds', command='mention', stage='send'):
+                            await msg.channel.send(response)
+                        # await msg.delete()
 
     def _message_contains_command(self, msg: Message) -> bool:
         text: str = msg.system_content or ''
@@ -102,16 +115,21 @@ class MarkovCog(commands.Cog):
         return False
 
 
-def _continue_prompt(target: Target, prompt: str) -> str:
-    """Returns empty string if could not continue."""
-    model = models_xml.get_model(target)
+async def _continue_prompt(target: Target, prompt: str, command: str) -> str:
+    """
+    Returns empty string if could not continue.
+    `command` labels the time spent in metrics.
+    """
+    with metrics.timer('command_seconds', command=command, stage='load'):
+        model = await models_xml.get_model_async(target)
     if model is None:
         logger.info(f'No model for target {target}')
         return ''
-    return _markov_chain_with_retry(model, prompt)
+    with metrics.timer('command_seconds', command=command, stage='generate'):
+        return _markov_chain_with_retry(model, prompt)
 
 
-async def reply_back(msg: Message, use_channel: bool = False):
+async def reply_back(msg: Message, use_channel: bool = False, command: str = 'reply'):
     """
     Reply to the message by continuing the Markov chain from the last word.
     If use_channel == True, will use the channel's model.
@@ -120,15 +138,17 @@ async def reply_back(msg: Message, use_channel: bool = False):
     m = map_message(msg)
     if m.server is None:
         return  # can't reply outside of server
-    last_word = get_last_word(m.text)
-    target = m.server
-    if use_channel:
-        channel_model = models_xml.get_model(m.channel)
-        if channel_model is not None:
-            target = m.channel
-    response = _continue_prompt(target, last_word)
-    if len(response) > 0:
-        await msg.reply(response)
+    with metrics.timer('command_seconds', command=command, stage='total'):
+        last_word = get_last_word(m.text)
+        target = m.server
+        if use_channel:
+            channel_model = await models_xml.get_model_async(m.channel)
+            if channel_model is not None:
+                target = m.channel
+        response = await _continue_prompt(target, last_word, command)
+        if len(response) > 0:
+            with metrics.timer('command_seconds', command=command, stage='send'):
+                await msg.reply(response)
 
 
 def _markov_chain_with_retry(model: Model, prompt: str = '') -> str:
@@ -136,6 +156,8 @@ def _markov_chain_with_retry(model: Model, prompt: str = '') -> str:
     Reruns markov chain multiple times if it fails to do attempts.
     Falls back to running without the prompt, and finally
     falls back to empty string.
+    Chains only fail to continue a prompt if its last word is a dead end, which is known beforehand,
+    so retries are rare.
     """
     if len(prompt) > 0:
         logger.info(f'Running model "{model.target}" for prompt "{prompt}"...')
@@ -144,37 +166,42 @@ def _markov_chain_with_retry(model: Model, prompt: str = '') -> str:
 
     attempt_count = 0
     limit = min(config.get('markov_retry_limit', markov_retry_hard_limit), markov_retry_hard_limit)
+    if len(prompt) > 0 and not model.data.is_non_terminal(canonical_form(prompt.strip().split(' ')[-1])):
+        logger.info('Prompt is a dead end')
+        limit = 0
 
     while attempt_count < limit:
-        chain = markov_chain(model.data, start=prompt)
+        chain = markov_chain(model.data, start=prompt, ngrams=model.ngrams)
         if strip_punctuation(chain) != strip_punctuation(prompt):
             logger.info(f'Result: {chain}')
+            metrics.increment('markov_retries_total', attempt_count)
             return chain
         attempt_count += 1
         logger.info(f'Retry {str(attempt_count)}')
+    metrics.increment('markov_retries_total', attempt_count)
 
     # failed with prompt!
 
     if len(prompt) > 0:
         # retry without prompt:
         logger.info('Retry without prompt')
-        chain = markov_chain(model.data)
+        metrics.increment('markov_fallbacks_total')
+        chain = markov_chain(model.data, ngrams=model.ngrams)
         if len(strip_punctuation(chain)) > 0:
             result = f'{prompt} {chain}'
             logger.info(f'Result: {result}')
             return result
 
     logger.info('No result')
+    metrics.increment('markov_empty_results_total')
     return ''
 
 
 async def _ask(ctx: Context, target: Target, prompt: str):
     last_word = get_last_word(prompt)
-    model = models_xml.get_model(target)
-    if model is None:
-        return
-    response = _markov_chain_with_retry(model, last_word)
+    response = await _continue_prompt(target, last_word, 'ask')
     if len(response) > 0:
         if isinstance(target, User):
             response = f'{target.name}: {response}'
-        await ctx.message.reply(response)
+        with metrics.timer('command_seconds', command='ask', stage='send'):
+            await ctx.message.reply(response)
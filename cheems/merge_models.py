@@ -0,0 +1,36 @@
+"""
+Merges model files into one model, e.g. duplicate models of a user, or models saved into 'lost'.
+The data is streamed from the files, so the models don't need to fit in memory.
+The files are merged into the model of the first file's target, in 'markov_model_dir' or 'reaction_model_dir',
+and are left as they are.
+Run from the project root:
+    python -m cheems.merge_models markov <model.xml>...
+    python -m cheems.merge_models reaction <model.xml>...
+"""
+import logging
+import sys
+
+from cheems.config import config
+from cheems.markov.models_xml import MarkovStorage
+from cheems.reaction.reactions import ReactionStorage
+from cheems.xml_data_model_storage import XmlDataModelStorage
+
+logger = logging.getLogger(__name__)
+
+
+def merge_models(storage: XmlDataModelStorage, file_paths: list[str]):
+    storage.load_models(load_data=False)
+    model = storage.merge_model_files(file_paths)
+    storage.save_manifest()
+    print(f'Merged into {model.file_path}')
+
+
+if __name__ == '__main__':
+    storages = {
+        'markov': lambda: MarkovStorage(config['markov_model_dir']),
+        'reaction': lambda: ReactionStorage(config['reaction_model_dir']),
+    }
+    if len(sys.argv) < 3 or sys.argv[1] not in storages:
+        print(f'Usage: python -m cheems.merge_models {"|".join(storages.keys())} <model.xml>...')
+        sys.exit(1)
+    merge_models(storages[sys.argv[1]](), sys.argv[2:])
@@ -0,0 +1,280 @@
+"""
+Latency histograms and counters of the bot's commands, in the Prometheus text format.
+Disabled by default: then timers and counters return right away, so instrumented code costs
+a method call. Enabled by config 'metrics', which also chooses how they are exposed:
+a local HTTP endpoint for Prometheus to scrape, and/or a file that is rewritten periodically.
+"""
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable, Optional
+
+from cheems.config import config
+from cheems.model_writer import write_file_atomically
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+'''Upper bounds of histogram buckets in seconds, from a fast cached chain to a slow model load'''
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    """Counts of observed values by bucket, like a Prometheus histogram"""
+    buckets: tuple[float, ...]
+    counts: list[int]
+    '''Per bucket, not cumulative, with the last one for values above all buckets'''
+    sum: float
+    count: int
+
+    def __init__(self, buckets: tuple[float, ...] = default_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_quantile(self, q: float) -> float:
+        """Upper bound of the bucket of the q-th quantile, e.g. 0.99 for p99"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+class _Timer:
+    """Observes the time spent in a `with` block"""
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self) -> '_Timer':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class _NullTimer:
+    def __enter__(self) -> '_NullTimer':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+def _to_labels(labels: dict[str, object]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: str = '') -> str:
+    parts = [f'{key}="{_escape(value)}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+Collector = Callable[[], Iterable[tuple[str, dict[str, object], float]]]
+'''Returns current values of gauges when metrics are exported, as (name, labels, value)'''
+
+
+class Metrics:
+    """
+    Registry of histograms and counters, labeled e.g. by command and stage.
+    Metric names are prefixed with 'cheems_' on export.
+    """
+    enabled: bool
+    histograms: dict[str, dict[Labels, Histogram]]
+    counters: dict[str, dict[Labels, float]]
+    collectors: list[Collector]
+    buckets: tuple[float, ...]
+    '''Buckets of new histograms'''
+
+    def __init__(self, enabled: bool = None, buckets: tuple[float, ...] = default_buckets):
+        if enabled is None:
+            enabled = bool((config.get('metrics', None) or {}).get('enabled', False))
+        self.enabled = enabled
+        self.buckets = buckets
+        self.histograms = {}
+        self.counters = {}
+        self.collectors = []
+
+    def timer(self, name: str, **labels):
+        """
+        Returns a context manager that observes the seconds spent in it, e.g.
+            with metrics.timer('command_seconds', command='che', stage='generate'):
+        """
+        if not self.enabled:
+            return _null_timer
+        return _Timer(self.get_histogram(name, **labels))
+
+    def observe(self, name: str, value: float, **labels):
+        if self.enabled:
+            self.get_histogram(name, **labels).observe(value)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        counters = self.counters.setdefault(name, {})
+        key = _to_labels(labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def get_histogram(self, name: str, **labels) -> Histogram:
+        histograms = self.histograms.setdefault(name, {})
+        key = _to_labels(labels)
+        histogram = histograms.get(key, None)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(self.buckets)
+        return histogram
+
+    def add_collector(self, collector: Collector):
+        """Adds gauges that are read when metrics are exported, e.g. memory of loaded models"""
+        self.collectors.append(collector)
+
+    def to_prometheus_text(self) -> str:
+        lines = []
+        for name, histograms in sorted(self.histograms.items()):
+            lines.append(f'# TYPE cheems_{name} histogram')
+            for labels, histogram in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = f'le="{_format_value(bound)}"'
+                    lines.append(f'cheems_{name}_bucket{_format_labels(labels, le)} {cumulative}')
+                lines.append(f'cheems_{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}')
+                lines.append(f'cheems_{name}_count{_format_labels(labels)} {histogram.count}')
+        for name, counters in sorted(self.counters.items()):
+            lines.append(f'# TYPE cheems_{name} counter')
+            for labels, value in sorted(counters.items()):
+                lines.append(f'cheems_{name}{_format_labels(labels)} {_format_value(value)}')
+        gauges: dict[str, list[str]] = {}
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                gauges.setdefault(name, []).append(
+                    f'cheems_{name}{_format_labels(_to_labels(labels))} {_format_value(value)}')
+        for name, gauge_lines in sorted(gauges.items()):
+            lines.append(f'# TYPE cheems_{name} gauge')
+            lines.extend(gauge_lines)
+        return '\n'.join(lines) + '\n'
+
+
+def _collect_process():
+    if resource is None:
+        return
+    # maxrss is in KiB on Linux
+    yield 'process_max_rss_bytes', {}, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MetricsExporter:
+    """Serves metrics over HTTP at /metrics, and/or writes them into a file periodically"""
+    http_server: Optional[asyncio.AbstractServer] = None
+    dump_task: Optional[asyncio.Task] = None
+
+    def __init__(self, registry: Metrics, host: str = '127.0.0.1', http_port: int = 0,
+                 dump_file: str = None, dump_period_seconds: float = 60):
+        self.registry = registry
+        self.host = host
+        self.http_port = http_port
+        self.dump_file = dump_file
+        self.dump_period_seconds = dump_period_seconds
+
+    async def start(self):
+        if self.http_port > 0:
+            self.http_server = await asyncio.start_server(self._handle_http, self.host, self.http_port)
+            logger.info(f'Serving metrics on http://{self.host}:{self.http_port}/metrics')
+        if self.dump_file:
+            self.dump_task = asyncio.get_running_loop().create_task(self._dump_periodically())
+            logger.info(f'Writing metrics into {self.dump_file} every {self.dump_period_seconds}s')
+
+    async def stop(self):
+        if self.http_server is not None:
+            self.http_server.close()
+            await self.http_server.wait_closed()
+            self.http_server = None
+        if self.dump_task is not None:
+            self.dump_task.cancel()
+            self.dump_task = None
+
+    def dump(self):
+        text = self.registry.to_prometheus_text()
+        write_file_atomically(self.dump_file, lambda f: f.write(text))
+
+    async def _dump_periodically(self):
+        while True:
+            await asyncio.sleep(self.dump_period_seconds)
+            try:
+                self.dump()
+            except OSError as e:
+                logger.warning(f'Failed to write metrics: {e}')
+
+    async def _handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            # the headers aren't needed
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.registry.to_prometheus_text().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\n'
+                         f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+# global registry
+metrics = Metrics()
+metrics.add_collector(_collect_process)
+
+
+async def start_exporter() -> Optional[MetricsExporter]:
+    """Starts exposing the global metrics as configured, if they are enabled"""
+    if not metrics.enabled:
+        return None
+    metrics_config = config.get('metrics', None) or {}
+    exporter = MetricsExporter(
+        metrics,
+        host=metrics_config.get('host', '127.0.0.1'),
+        http_port=int(metrics_config.get('http_port', 0) or 0),
+        dump_file=metrics_config.get('dump_file', None),
+        dump_period_seconds=float(metrics_config.get('dump_period_seconds', 60)),
+    )
+    await exporter.start()
+    return exporter
@@ -0,0 +1,159 @@
+import asyncio
+import io
+import logging
+import os
+import threading
+import zlib
+from queue import Queue
+from typing import Callable, Hashable, Optional, BinaryIO, TextIO
+
+logger = logging.getLogger(__name__)
+
+
+_write_buffer_size = 1024 * 1024
+
+
+class _ChecksumWriter(io.RawIOBase):
+    """Passes bytes through to the file, computing their CRC32"""
+
+    def __init__(self, f: BinaryIO):
+        self.f = f
+        self.crc = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.crc = zlib.crc32(b, self.crc)
+        return self.f.write(b)
+
+
+def write_file_atomically(path: str, write: Callable[[TextIO], None]) -> int:
+    """
+    Calls `write` with a UTF-8 text stream into a temporary file, and then replaces the target with it,
+    so that a crash never leaves a partially written file.
+    Returns the CRC32 of the written bytes.
+    """
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        checksum_writer = _ChecksumWriter(f)
+        with io.TextIOWrapper(io.BufferedWriter(checksum_writer, _write_buffer_size),
+                              encoding='utf-8', newline='\n') as text:
+            write(text)
+            text.flush()
+            f.flush()
+            os.fsync(f.fileno())
+            # closing the wrapper closes only the checksum writer, not the file
+    os.replace(tmp_path, path)
+    return checksum_writer.crc
+
+
+class WriteJob:
+    """
+    A save prepared on the caller's thread, e.g. with a snapshot of the model,
+    which is then run on the writer thread.
+    """
+
+    def run(self):
+        raise NotImplementedError
+
+    def coalesce(self, newer: 'WriteJob') -> 'WriteJob':
+        """
+        Returns a job that has the effect of both this and the newer job.
+        By default, the newer job supersedes this one, e.g. a newer snapshot of the same model.
+        """
+        return newer
+
+
+class FunctionJob(WriteJob):
+    def __init__(self, fn: Callable[[], None]):
+        self.fn = fn
+
+    def run(self):
+        self.fn()
+
+
+class ChainedJob(WriteJob):
+    """Runs two jobs one after the other, e.g. a full save followed by a smaller update"""
+
+    def __init__(self, first: WriteJob, second: WriteJob):
+        self.first = first
+        self.second = second
+
+    def run(self):
+        self.first.run()
+        self.second.run()
+
+    def coalesce(self, newer: WriteJob) -> WriteJob:
+        return ChainedJob(self.first, self.second.coalesce(newer))
+
+
+class ModelWriter:
+    """
+    Runs saves on a dedicated thread, so that writing large models doesn't stall the event loop.
+    Saves of the same model that are still waiting in the queue are coalesced into one,
+    so the queue holds at most a job per model, and `submit` never blocks the event loop.
+    Call `close` before exiting, because the thread is a daemon and pending saves would be lost.
+    """
+
+    def __init__(self, max_queue: int = 64, name: str = 'model_writer'):
+        """
+        :param max_queue: a warning is logged when more jobs than this are waiting,
+            i.e. the writer falls behind.
+        """
+        self._queue: Queue[Optional[Hashable]] = Queue()
+        self._max_queue = max_queue
+        self._pending: dict[Hashable, WriteJob] = {}
+        '''Jobs waiting in the queue, by key'''
+        self._running_key: Optional[Hashable] = None
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, key: Hashable, job: WriteJob):
+        with self._lock:
+            pending_job = self._pending.get(key, None)
+            if pending_job is not None:
+                self._pending[key] = pending_job.coalesce(job)
+                return
+            self._pending[key] = job
+            pending_count = len(self._pending)
+        self._queue.put_nowait(key)
+        if pending_count == self._max_queue + 1:
+            logger.warning(f'Model writer is behind: {pending_count} saves are waiting')
+
+    def is_pending(self, key: Hashable) -> bool:
+        """True if a save for this key is waiting or running"""
+        with self._lock:
+            return key in self._pending or key == self._running_key
+
+    def _run(self):
+        while True:
+            key = self._queue.get()
+            if key is None:
+                self._queue.task_done()
+                return
+            with self._lock:
+                job = self._pending.pop(key)
+                self._running_key = key
+            try:
+                job.run()
+            except Exception:
+                logger.exception(f'Failed to save {key}')
+            finally:
+                with self._lock:
+                    self._running_key = None
+                self._queue.task_done()
+
+    def flush(self):
+        """Blocks until all submitted saves are written"""
+        self._queue.join()
+
+    async def flush_async(self):
+        """Waits until all submitted saves are written, without blocking the event loop"""
+        await asyncio.get_running_loop().run_in_executor(None, self.flush)
+
+    def close(self):
+        """Writes the remaining saves and stops the thread"""
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,313 @@
+"""
+Trains Markov models from local chat exports instead of scraping Discord.
+Each export is a JSON lines file, with a message per line in the fields of `cheems.targets.Message`:
+
+    {"id": 1, "server": {"id": 1, "name": "My server"}, "channel": {"id": 2, "name": "general"},
+     "user": {"id": 3, "name": "Kagamin", "discriminator": 1111},
+     "created_at": "2022-05-01T12:00:00+00:00", "text": "hello world"}
+
+Exports are split into chunks, which are trained in parallel processes,
+and the partial models are merged into the models in 'markov_model_dir', following config['training'].
+With 'offline_training_max_pairs', training that doesn't fit in memory is spilled into temporary files.
+N-grams, if enabled by 'markov_ngram_order', are counted and merged into the '.ngrams' files the same way.
+Run from the project root:
+    python -m cheems.offline_trainer <export.jsonl>... [--workers N]
+"""
+import json
+import logging
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from tempfile import TemporaryDirectory
+from typing import Iterator, Optional
+
+from cheems.config import config, is_name_allowed, is_name_special, is_message_id_allowed
+from cheems.discord_helper import EPOCH
+from cheems.markov.external_merge import SortedRuns
+from cheems.markov.markov import train_model_groups, count_word_ngrams
+from cheems.markov.model import Model
+from cheems.markov.model_data import ModelData
+from cheems.markov.models_xml import MarkovStorage
+from cheems.markov.ngram_data import NGram, get_ngram_order, serialize_ngram_counts
+from cheems.targets import Server, Channel, User, Message, Target
+
+logger = logging.getLogger(__name__)
+
+default_chunk_size = 16 * 1024 * 1024
+'''Bytes of an export file that are trained by one process at a time'''
+
+
+@dataclass
+class PartialModel:
+    """Training for a target from a chunk of exports, to be merged into its model"""
+    data: ModelData = field(default_factory=ModelData)
+    ngrams: Counter[NGram] = field(default_factory=Counter)
+    '''Chains of 3+ words, if enabled by 'markov_ngram_order' for the target'''
+    from_time: Optional[datetime] = None
+    to_time: Optional[datetime] = None
+
+    def update_time(self, time: datetime, trained: bool = True):
+        """
+        :param trained: False if the message was only seen, which doesn't move 'from_time',
+            like in `CheemsTrainer`.
+        """
+        if trained and (self.from_time is None or self.from_time > time):
+            self.from_time = time
+        if self.to_time is None or self.to_time < time:
+            self.to_time = time
+
+
+def parse_message(record: dict) -> tuple[int, Message]:
+    """Returns the message id and the message from a line of the export"""
+    server = Server(int(record['server']['id']), str(record['server']['name']))
+    user = record['user']
+    channel = record['channel']
+    created_at = datetime.fromisoformat(record['created_at'])
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    msg = Message(
+        server=server,
+        user=User(int(user['id']), str(user['name']), int(user.get('discriminator', 0)), server),
+        channel=Channel(int(channel['id']), str(channel['name']), server),
+        text=str(record['text']),
+        created_at=created_at,
+    )
+    return int(record.get('id', 0)), msg
+
+
+def get_trained_targets(training_config: dict, msg_id: int, msg: Message) -> tuple[list[Target], list[Target]]:
+    """
+    Applies the same rules as `CheemsTrainer.update_models_from_channel`.
+    :return: targets whose models are trained on the message,
+        and targets whose models only have their time updated.
+    """
+    server_config = training_config.get('servers', {}).get(msg.server.name, None)
+    if server_config is None:
+        return [], []
+    channel_config = server_config.get('channels', {})
+    user_config = server_config.get('users', {})
+    if not is_name_allowed(channel_config, msg.channel.name):
+        return [], []
+    channel_is_special = is_name_special(channel_config, msg.channel.name)
+    targets: list[Target] = [msg.channel] if channel_is_special else [msg.channel, msg.server]
+    if not is_name_allowed(user_config, msg.user.name) or not is_message_id_allowed(server_config, msg_id):
+        return [], targets
+    if is_name_special(user_config, msg.user.name):
+        return [msg.user], []
+    if not channel_is_special:
+        targets.append(msg.user)
+    return targets, []
+
+
+def find_chunks(path: str, chunk_size: int = default_chunk_size) -> list[tuple[str, int, int]]:
+    """Splits the file into (path, start, end) byte ranges that end at line breaks"""
+    size = os.path.getsize(path)
+    chunks = []
+    start = 0
+    with open(path, 'rb') as f:
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            chunks.append((path, start, end))
+            start = end
+    return chunks
+
+
+def _read_chunk(path: str, start: int, end: int) -> Iterator[dict]:
+    with open(path, 'rb') as f:
+        f.seek(start)
+        for line in f.read(end - start).decode('utf-8').splitlines():
+            if line.strip():
+                yield json.loads(line)
+
+
+def train_chunk(chunk: tuple[str, int, int], training_config: dict,
+                ngram_orders: dict[str, int]) -> dict[Target, PartialModel]:
+    """
+    Trains partial models on a chunk of an export. Runs in a worker process,
+    so the training config and config 'markov_ngram_order' are passed explicitly.
+    """
+    partials: dict[Target, PartialModel] = {}
+    groups: dict[tuple[Target, ...], list[str]] = {}
+    '''Messages to train on, grouped by the targets they go into'''
+    for record in _read_chunk(*chunk):
+        msg_id, msg = parse_message(record)
+        trained, time_only = get_trained_targets(training_config, msg_id, msg)
+        for target in trained:
+            partials.setdefault(target, PartialModel()).update_time(msg.created_at)
+        for target in time_only:
+            partials.setdefault(target, PartialModel()).update_time(msg.created_at, trained=False)
+        if len(trained) > 0:
+            groups.setdefault(tuple(trained), []).append(msg.text)
+    train_model_groups([
+        ([partials[target].data for target in targets], texts)
+        for targets, texts in groups.items()
+    ])
+    for targets, texts in groups.items():
+        orders = {target: get_ngram_order(target, ngram_orders) for target in targets}
+        max_order = max(orders.values())
+        if max_order < 2:
+            continue
+        counts = count_word_ngrams(texts, max_order)
+        for target, order in orders.items():
+            if order == max_order:
+                partials[target].ngrams.update(counts)
+            elif order >= 2:
+                partials[target].ngrams.update({ngram: c for ngram, c in counts.items() if len(ngram) <= order + 1})
+    return partials
+
+
+def _pair_counts(data: ModelData) -> dict[tuple[str, str], int]:
+    return {
+        (first_word, next_word): count
+        for first_word, next_words in data.items()
+        for next_word, count in next_words.items()
+    }
+
+
+class _SpillingReducer:
+    """
+    Collects partial models in memory, and when they exceed the limit of pairs and n-grams,
+    spills them into sorted runs in the temporary directory.
+    When the models are saved, the runs and the files of the existing models are merged as sorted streams,
+    so the existing models aren't loaded.
+    """
+    storage: MarkovStorage
+    temp_dir: str
+    max_pairs: int
+    '''0 means no limit'''
+    pending: dict[Target, PartialModel]
+    pending_pair_count: int
+    '''At least the number of pairs and n-grams in pending data'''
+    runs: dict[Target, SortedRuns]
+    ngram_runs: dict[Target, SortedRuns]
+
+    def __init__(self, storage: MarkovStorage, temp_dir: str, max_pairs: int):
+        self.storage = storage
+        self.temp_dir = temp_dir
+        self.max_pairs = max_pairs
+        self.pending = {}
+        self.pending_pair_count = 0
+        self.runs = {}
+        self.ngram_runs = {}
+
+    def add(self, target: Target, partial: PartialModel):
+        total = self.pending.get(target, None)
+        if total is None:
+            self.pending[target] = partial
+        else:
+            total.data.append_pairs(_pair_counts(partial.data))
+            total.ngrams.update(partial.ngrams)
+            if partial.from_time is not None:
+                total.update_time(partial.from_time)
+            total.update_time(partial.to_time, trained=False)
+        self.pending_pair_count += partial.data.pair_count + len(partial.ngrams)
+        if 0 < self.max_pairs < self.pending_pair_count:
+            self.spill()
+
+    def spill(self):
+        for target, partial in self.pending.items():
+            if len(partial.data) > 0:
+                runs = self.runs.get(target, None)
+                if runs is None:
+                    runs = self.runs[target] = SortedRuns(self.temp_dir, str(len(self.runs)))
+                runs.spill(partial.data)
+                # times are kept until the model is saved
+                partial.data = ModelData()
+            if len(partial.ngrams) > 0:
+                ngram_runs = self.ngram_runs.get(target, None)
+                if ngram_runs is None:
+                    ngram_runs = self.ngram_runs[target] = SortedRuns(self.temp_dir, f'ngrams{len(self.ngram_runs)}')
+                ngram_runs.spill_lines(serialize_ngram_counts(partial.ngrams.items()))
+                partial.ngrams = Counter()
+        logger.info(f'Spilled {self.pending_pair_count} pairs and n-grams into sorted runs')
+        self.pending_pair_count = 0
+
+    def save_models(self):
+        for target, partial in self.pending.items():
+            runs = self.runs.get(target, None)
+            # noinspection PyProtectedMember
+            data_runs = [Model._iter_serialized_lines(partial.data)]
+            if runs is not None:
+                data_runs.append(runs.iter_merged_lines())
+            ngram_runs = self.ngram_runs.get(target, None)
+            ngram_data_runs = [serialize_ngram_counts(partial.ngrams.items())] if len(partial.ngrams) > 0 else []
+            if ngram_runs is not None:
+                ngram_data_runs.append(ngram_runs.iter_merged_lines())
+            self.storage.merge_model_lines(
+                target, data_runs, from_time=partial.from_time or EPOCH, to_time=partial.to_time,
+                ngram_runs=ngram_data_runs)
+            if runs is not None:
+                runs.remove()
+            if ngram_runs is not None:
+                ngram_runs.remove()
+
+
+def train_from_exports(
+        paths: list[str],
+        storage: MarkovStorage,
+        workers: int = None,
+        chunk_size: int = default_chunk_size,
+        max_pairs_in_memory: int = None,
+) -> list[Target]:
+    """
+    Trains models in the storage on the exports, in a pool of processes.
+    Existing models are continued, so an export should only be trained once.
+
+    :param max_pairs_in_memory: training beyond this many pairs is spilled into temporary files.
+        Defaults to config 'offline_training_max_pairs'. 0 means no limit.
+    :return: targets whose models were updated and saved.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_pairs_in_memory is None:
+        max_pairs_in_memory = int(config.get('offline_training_max_pairs', 0))
+    chunks = [chunk for path in paths for chunk in find_chunks(path, chunk_size)]
+    training_config = config.get('training', {})
+    ngram_orders = config.get('markov_ngram_order', None) or {}
+    updated: dict[Target, None] = {}
+
+    with TemporaryDirectory(prefix='cheems_runs_') as temp_dir:
+        reducer = _SpillingReducer(storage, temp_dir, max_pairs_in_memory)
+
+        def merge(partials: dict[Target, PartialModel]):
+            for target, partial in partials.items():
+                reducer.add(target, partial)
+                updated[target] = None
+
+        if workers <= 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                merge(train_chunk(chunk, training_config, ngram_orders))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for partials in executor.map(train_chunk, chunks, [training_config] * len(chunks),
+                                             [ngram_orders] * len(chunks)):
+                    merge(partials)
+
+        reducer.save_models()
+    storage.flush()
+    storage.save_manifest()
+    logger.info(f'Trained {len(updated)} models on {len(chunks)} chunks of {len(paths)} exports')
+    return list(updated.keys())
+
+
+def main(args: list[str]):
+    workers = None
+    if '--workers' in args:
+        i = args.index('--workers')
+        workers = int(args[i + 1])
+        args = args[:i] + args[i + 2:]
+    if len(args) == 0:
+        print('Usage: python -m cheems.offline_trainer <export.jsonl>... [--workers N]')
+        sys.exit(1)
+    storage = MarkovStorage(config['markov_model_dir'])
+    storage.load_models(load_data=False)
+    train_from_exports(args, storage, workers)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
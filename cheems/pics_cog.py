@@ -6,7 +6,8 @@ from discord.ext.commands import Bot, Context
 
 from cheems import pictures
 from cheems.discord_helper import extract_target, get_command_argument, remove_mention
-from cheems.targets import User, Channel, Server, Picture
+from cheems.metrics import metrics
+from cheems.targets import User, Channel, Server, Picture, Target
 
 logger = logging.getLogger(__name__)
 
@@ -42,6 +43,22 @@ async def _pic(ctx: Context, sfw: bool = None):
         sfw_str = 'NSFW '
     logger.info(f'{ctx.author.name} requested {sfw_str}pic from {target}: {prompt}')
     prompt = remove_mention(prompt, target)
+    with metrics.timer('command_seconds', command='pic', stage='total'):
+        await _send_random_pic(ctx, target, prompt, sfw)
+
+
+async def _send_random_pic(ctx: Context, target: Target, prompt: str, sfw: Optional[bool]):
+    with metrics.timer('command_seconds', command='pic', stage='query'):
+        pic = _get_target_pic(target, prompt, sfw)
+    if pic is not None:
+        url = pic.url
+        if not pic.sfw:
+            url = f'|| {url} ||'
+        with metrics.timer('command_seconds', command='pic', stage='send'):
+            await ctx.send(url)
+
+
+def _get_target_pic(target: Target, prompt: str, sfw: Optional[bool]) -> Optional[Picture]:
     if isinstance(target, User):
         pic = _get_random_pic(
             server_id=target.server_id,
@@ -64,11 +81,7 @@ async def _pic(ctx: Context, sfw: bool = None):
         )
     else:
         pic = None
-    if pic is not None:
-        url = pic.url
-        if not pic.sfw:
-            url = f'|| {url} ||'
-        await ctx.send(url)
+    return pic
 
 
 def _get_random_pic(
@@ -1,3 +1,4 @@
+import logging
 import os
 import re
 import sqlite3
@@ -8,6 +9,8 @@ from typing import Optional
 from cheems.config import config
 from cheems.targets import Picture
 
+logger = logging.getLogger(__name__)
+
 
 def _sanitize_str_for_db(s: str) -> str:
     return re.sub(r'[^\w\s/:.]', '', s)
@@ -16,19 +19,71 @@ def _sanitize_str_for_db(s: str) -> str:
 _db_dir = config['db_dir']
 _filename = _db_dir + '/pics.db'
 
-_create_tables = '''
-CREATE TABLE IF NOT EXISTS pics (
-    id INT PRIMARY KEY,
+_pic_columns = 'id, url, msg, time, uploader_id, channel_id, server_id, sfw'
+'''Columns of `Picture`, in the order of its fields'''
+
+# 'row_id' is an alias of the rowid, so unlike the implicit rowid, it doesn't change on VACUUM.
+# Pictures with the same time are still ordered as they were saved.
+_pics_schema = '''(
+    id INT UNIQUE,
     url TEXT,
     msg TEXT,
     time DATETIME,
     uploader_id INT,
     channel_id INT,
     server_id INT,
-    sfw BOOLEAN
+    sfw BOOLEAN,
+    row_id INTEGER PRIMARY KEY
+)'''
+
+_create_tables = f'''
+CREATE TABLE IF NOT EXISTS pics {_pics_schema};
+'''
+
+# A primary key can't be added to an existing table, so older databases are copied with their rowids.
+# The full-text index of the implicit rowid is dropped, and created again over 'row_id'.
+_add_row_id = f'''
+BEGIN;
+DROP TABLE IF EXISTS pics_fts;
+CREATE TABLE pics_new {_pics_schema};
+INSERT INTO pics_new (row_id, {_pic_columns}) SELECT rowid, {_pic_columns} FROM pics;
+DROP TABLE pics;
+ALTER TABLE pics_new RENAME TO pics;
+COMMIT;
+'''
+
+_schema_version = 2
+'''
+Stored in `PRAGMA user_version`. Version 1 added the full-text index of captions,
+version 2 added the 'row_id' column, which the index refers to.
+'''
+
+# Full-text index of captions, for searching by word.
+# The trigram tokenizer matches any substring of 3 or more characters, case-insensitively,
+# so it gives the same results as 'LIKE %word%' without scanning the table.
+# It's an external content table over 'row_id' of pics, kept in sync by triggers.
+_create_fts = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS pics_fts USING fts5(
+    msg,
+    content='pics',
+    content_rowid='row_id',
+    tokenize='trigram'
 );
+CREATE TRIGGER IF NOT EXISTS pics_fts_insert AFTER INSERT ON pics BEGIN
+    INSERT INTO pics_fts(rowid, msg) VALUES (new.row_id, new.msg);
+END;
+CREATE TRIGGER IF NOT EXISTS pics_fts_delete AFTER DELETE ON pics BEGIN
+    INSERT INTO pics_fts(pics_fts, rowid, msg) VALUES ('delete', old.row_id, old.msg);
+END;
+CREATE TRIGGER IF NOT EXISTS pics_fts_update AFTER UPDATE ON pics BEGIN
+    INSERT INTO pics_fts(pics_fts, rowid, msg) VALUES ('delete', old.row_id, old.msg);
+    INSERT INTO pics_fts(rowid, msg) VALUES (new.row_id, new.msg);
+END;
 '''
 
+_min_fts_word_length = 3
+'''Trigrams can't match shorter words, they are searched with LIKE'''
+
 
 def _get_db_connection() -> Connection:
     """Don't forget to close this connection after use."""
@@ -41,23 +96,49 @@ def _get_db_connection() -> Connection:
     cur.executescript(_create_tables)
     con.commit()
     cur.close()
+    _migrate(con)
     return con
 
 
+def _migrate(con: Connection):
+    """Adds 'row_id' and the full-text index to older databases, and fills the index with their pictures"""
+    global _has_fts
+    version = con.execute('PRAGMA user_version').fetchone()[0]
+    if version >= _schema_version:
+        _has_fts = True
+        return
+    if 'row_id' not in [column[1] for column in con.execute('PRAGMA table_info(pics)')]:
+        logger.info('Adding row ids to pictures...')
+        con.executescript(_add_row_id)
+    try:
+        con.executescript(_create_fts)
+    except sqlite3.OperationalError as e:
+        # SQLite before 3.34 doesn't have the trigram tokenizer, or is built without FTS5
+        logger.warning(f'Full-text search of pictures is unavailable: {e}')
+        con.rollback()
+        _has_fts = False
+        return
+    logger.info('Indexing captions of pictures...')
+    con.execute("INSERT INTO pics_fts(pics_fts) VALUES ('rebuild')")
+    con.execute(f'PRAGMA user_version = {_schema_version}')
+    con.commit()
+    _has_fts = True
+
+
 def save_pic(pic: Picture):
     """Doesn't commit the transaction, call `save_all()`"""
     cur = _con.cursor()
     msg = _sanitize_str_for_db(pic.msg)
     url = _sanitize_str_for_db(pic.url)
     cur.execute(
-        'INSERT OR IGNORE INTO pics values (?, ?, ?, ?, ?, ?, ?, ?)',
+        f'INSERT OR IGNORE INTO pics ({_pic_columns}) values (?, ?, ?, ?, ?, ?, ?, ?)',
         (pic.id, url, msg, pic.time, pic.uploader_id, pic.channel_id, pic.server_id, pic.sfw)
     )
 
 
 def get_pic_by_id(pic_id: int) -> Optional[Picture]:
     cur = _con.cursor()
-    cur.execute('SELECT * FROM pics WHERE id=:id', {'id': pic_id})
+    cur.execute(f'SELECT {_pic_columns} FROM pics WHERE id=:id', {'id': pic_id})
     results = cur.fetchone()
     if results is None:
         return None
@@ -78,8 +159,9 @@ def get_pics_where(
     :param random: use random order instead.
     """
     cur = _con.cursor()
-    script = 'SELECT * FROM pics'
+    script = f'SELECT {_pic_columns} FROM pics'
     conditions = []
+    params = []
     if uploader_id is not None:
         conditions.append(f'uploader_id={uploader_id}')
     if channel_id is not None:
@@ -88,7 +170,12 @@ def get_pics_where(
         conditions.append(f'server_id={server_id}')
     if word is not None:
         sanitized_word = _sanitize_str_for_db(word).lower()
-        conditions.append(f'lower(msg) like "%{sanitized_word}%"')
+        if _has_fts and len(sanitized_word) >= _min_fts_word_length:
+            # a quoted phrase of trigrams matches the word as a substring
+            conditions.append('row_id IN (SELECT rowid FROM pics_fts WHERE pics_fts MATCH ?)')
+            params.append(f'"{sanitized_word}"')
+        else:
+            conditions.append(f'lower(msg) like "%{sanitized_word}%"')
     if sfw is not None:
         conditions.append(f'sfw = {sfw}')
     if len(conditions) > 0:
@@ -99,7 +186,7 @@ def get_pics_where(
         script += ' ORDER BY time'
     if limit is not None:
         script += f' LIMIT {limit}'
-    cur.execute(script)
+    cur.execute(script, params)
     results = cur.fetchall()
     pics = [_pic_from_db_result(r) for r in results]
     return pics
@@ -118,4 +205,6 @@ def save_all():
     _con.commit()
 
 
+_has_fts = False
+'''Set when the database is opened, if SQLite supports the full-text index'''
 _con = _get_db_connection()
@@ -36,4 +36,4 @@ class ProactiveMarkovCog(commands.Cog):
             if count >= self.period_msgs:
                 self.messagesSinceBotByChannel[msg.channel.id] = 0
                 logger.info(f'Proactively replying to message: {msg.system_content}')
-                await reply_back(msg, use_channel=True)
+                await reply_back(msg, use_channel=True, command='proactive_reply')
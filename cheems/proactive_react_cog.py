@@ -6,6 +6,7 @@ from discord.ext.commands import Bot
 
 from cheems.config import config
 from cheems.discord_helper import map_message
+from cheems.metrics import metrics
 from cheems.reaction import reactions
 
 logger = logging.getLogger(__name__)
@@ -50,15 +51,18 @@ async def react_to(msg: Message, use_channel: bool = True):
     m = map_message(msg)
     if m.server is None:
         return  # can't reply outside of server
-    target = m.server
-    if use_channel:
-        channel_model = reactions.get_model(m.channel)
-        if channel_model is not None:
-            target = m.channel
+    with metrics.timer('command_seconds', command='proactive_react', stage='total'):
+        with metrics.timer('command_seconds', command='proactive_react', stage='load'):
+            target = m.server
+            if use_channel:
+                channel_model = reactions.get_model(m.channel)
+                if channel_model is not None:
+                    target = m.channel
 
-    model = reactions.get_model(target)
-    if model is None:
-        logger.info(f'No reaction model for target {target}')
-        return
-    reaction = model.get_random_reaction()
-    await msg.add_reaction(reaction)
+            model = reactions.get_model(target)
+        if model is None:
+            logger.info(f'No reaction model for target {target}')
+            return
+        reaction = model.get_random_reaction()
+        with metrics.timer('command_seconds', command='proactive_react', stage='send'):
+            await msg.add_reaction(reaction)
@@ -1,5 +1,7 @@
+import dataclasses
 import random
 from dataclasses import dataclass, field
+from typing import Iterator
 
 from cheems.base_xml_data_model import BaseXmlDataModel
 from cheems.config import config
@@ -36,31 +38,37 @@ class ReactionModel(BaseXmlDataModel):
         xml_model = BaseXmlDataModel.from_xml(xml_str, load_data)
         return cls.from_base_model(xml_model)
 
-    def to_xml(self, pretty_print: bool = True) -> str:
-        self.raw_data = self.serialize_data()
-        output = super().to_xml(pretty_print)
-        self.raw_data = ''  # delete the raw string to save memory
-        return output
-
     @classmethod
     def parse_data(cls, text: str) -> ReactModelData:
-        data: ReactModelData = {}
         max_weight = config.get('reaction_model_max_weight', 9999)
-        for line in text.strip().splitlines():
-            (reaction, count) = line.strip().split(' ')
-            weight = min(int(count), max_weight)  # limit weight
-            data[reaction] = weight
-        return data
+        # reaction names never contain whitespace, so the text is split at once
+        tokens = text.split()
+        if len(tokens) % 2 != 0:
+            raise ValueError("Expected lines of 'reaction count'")
+        weights = (min(int(count), max_weight) for count in tokens[1::2])  # limit weight
+        return dict(zip(tokens[0::2], weights))
 
     def load_data(self):
         super().load_data()
         self.data = ReactionModel.parse_data(self.raw_data)
 
+    def unload_data(self):
+        super().unload_data()
+        self.data = {}
+
+    def get_data_size(self) -> tuple[int, int]:
+        # roughly a dict entry with a short string key
+        return len(self.data), len(self.data) * 100
+
+    def snapshot(self) -> 'ReactionModel':
+        return dataclasses.replace(self, data=self.data.copy())
+
     def serialize_data(self) -> str:
-        lines: list[str] = []
-        for reaction, count in self.data.items():
-            lines.append(f'{reaction} {count}')
-        return '\n'.join(sorted(lines))
+        return '\n'.join(self.iter_data_lines())
+
+    def iter_data_lines(self) -> Iterator[str]:
+        for reaction in sorted(self.data.keys()):
+            yield f'{reaction} {self.data[reaction]}'
 
     def get_random_reaction(self) -> str:
         """Weighted according to data"""
@@ -3,6 +3,7 @@ from typing import Optional
 
 from cheems.base_xml_data_model import BaseXmlDataModel
 from cheems.config import config
+from cheems.metrics import metrics
 from cheems.reaction.reaction_model import ReactionModel
 from cheems.targets import Target
 from cheems.xml_data_model_storage import XmlDataModelStorage
@@ -11,12 +12,17 @@ logger = logging.getLogger(__name__)
 
 
 class ReactionStorage(XmlDataModelStorage[ReactionModel]):
-    def ensure_type(self, base: BaseXmlDataModel) -> ReactionModel:
+    max_weight_key = 'reaction_model_max_weight'
+    metrics_name = 'reaction'
+
+    @classmethod
+    def ensure_type(cls, base: BaseXmlDataModel) -> ReactionModel:
         return ReactionModel.from_base_model(base)
 
 
 reaction_storage = ReactionStorage(config['reaction_model_dir'])
 '''Global storage instance'''
+metrics.add_collector(reaction_storage.collect_metrics)
 
 
 def preload_models():
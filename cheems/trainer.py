@@ -12,8 +12,7 @@ from cheems.config import config, is_name_allowed, is_message_id_allowed, \
     is_name_special
 from cheems.discord_helper import map_channel, map_message, EPOCH
 from cheems.markov import models_xml
-from cheems.markov.markov import train_models_on_sentence
-from cheems.markov.model import Model
+from cheems.markov.markov import train_model_groups, train_ngram_groups
 from cheems.markov.model_xml import XmlModel
 from cheems.targets import Message
 
@@ -37,6 +36,8 @@ class CheemsTrainer:
     def __init__(self, bot: Bot):
         self.bot = bot
         self.loop = asyncio.get_running_loop()
+        # large models take a while to write, which would stall scraping
+        models_xml.start_writer()
 
     def begin_training(self):
         """
@@ -56,8 +57,26 @@ class CheemsTrainer:
         # the save task could have been added later:
         if self.save_models_task:
             await asyncio.wait([self.save_models_task])
+        await models_xml.flush_async()
+        models_xml.save_manifest()
         logger.info("Training complete")
 
+    async def close(self):
+        """
+        Saves the remaining models and stops the writer thread, e.g. when the process exits.
+        Otherwise, saves that are scheduled or waiting for the writer would be lost.
+        """
+        if self.save_models_task is not None:
+            self.save_models_task.cancel()
+            self.save_models_task = None
+        while len(self.unsaved_models) > 0:
+            models_xml.save_model(self.unsaved_models.pop())
+        pictures.save_all()
+        await models_xml.flush_async()
+        models_xml.stop_writer()
+        models_xml.save_manifest()
+        logger.info('Saved all models before exiting')
+
     def _add_task(self, coro: Coroutine) -> Task:
         task = self.loop.create_task(coro)
         self.tasks.append(task)
@@ -107,6 +126,8 @@ class CheemsTrainer:
         ch_model = models_xml.get_or_create_model(ch)
         server_model = models_xml.get_or_create_model(ch.server)
         count = 0
+        batch: dict[tuple[int, ...], tuple[list[XmlModel], list[Message]]] = {}
+        '''Messages to train on, grouped by the models they go into'''
         try:
             history = discord_channel.history(
                 limit=int(config['training']['message_limit']),
@@ -131,20 +152,26 @@ class CheemsTrainer:
                     elif not channel_is_special:
                         models.append(user_model)
 
-                    self.train_models(models, msg)
-                    for model in models:
-                        self.unsaved_models.add(model)
+                    group = batch.setdefault(tuple(id(m) for m in models), (models, []))
+                    group[1].append(msg)
                 else:
                     # don't train the models, but update their timestamps
                     for model in models:
                         if model.to_time < msg.created_at:
+                            if not model.is_data_loaded:
+                                # the data could have been evicted, and the model will be saved
+                                models_xml.get_model(model.target)
                             model.to_time = msg.created_at
                             model.updated_time = datetime.now(tz=timezone.utc)
+                            model.has_unsaved_changes = True
                             self.unsaved_models.add(model)
                 count += 1
         except Exception as e:
             logger.exception(f'Error parsing channel {ch}: {e}')
+            # messages fetched before the error are still used
+            self.train_models_on_batch(list(batch.values()))
             return count
+        self.train_models_on_batch(list(batch.values()))
         if count > 0:
             self.schedule_save_all_models()
             logger.info(f'Fetched {count} messages from {ch}')
@@ -155,12 +182,37 @@ class CheemsTrainer:
             self.save_model(ch_model)
         return count
 
-    def train_models(self, models: list[Model], msg: Message):
+    def train_models_on_batch(self, batch: list[tuple[list[XmlModel], list[Message]]]):
+        """
+        Updates content and time of models based on a batch of messages,
+        grouped by the models they go into. See `train_model_groups`.
+        """
+        for models, _ in batch:
+            # data could have been unloaded to save memory while waiting for history
+            for model in models:
+                if not model.is_data_loaded:
+                    models_xml.get_model(model.target)
+        train_model_groups([
+            # new pairs are also counted separately, to be appended to the journal on save
+            ([m.data for m in models] + [m.unsaved_pairs for m in models], [msg.text for msg in messages])
+            for models, messages in batch
+        ])
+        train_ngram_groups([
+            ([m.ngrams for m in models if m.ngrams is not None] +
+             [m.unsaved_ngrams for m in models if m.unsaved_ngrams is not None], [msg.text for msg in messages])
+            for models, messages in batch
+        ])
+        for models, messages in batch:
+            for msg in messages:
+                self._update_models_from_message(models, msg)
+            for model in models:
+                model.has_unsaved_changes = True
+                self.unsaved_models.add(model)
+
+    def _update_models_from_message(self, models: list[XmlModel], msg: Message):
         """
-        Update content and time of models based on the message.
+        Update time of models based on the message, and save its pictures.
         """
-        models_data = [m.data for m in models]
-        train_models_on_sentence(models_data, msg.text)
         for model in models:
             if model.from_time == EPOCH:
                 model.from_time = msg.created_at
@@ -201,6 +253,6 @@ class CheemsTrainer:
         logger.info(f'Saving model {model.file_path}')
         models_xml.save_model(model)
         self.unsaved_models.discard(model)
-        if len(self.unsaved_models) <= 0:
+        if len(self.unsaved_models) <= 0 and self.save_models_task is not None:
             self.save_models_task.cancel()
             self.save_models_task = None
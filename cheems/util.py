@@ -1,4 +1,7 @@
+import heapq
 from itertools import tee
+from operator import itemgetter
+from typing import Iterable, Iterator
 
 keep_characters = ' _'
 
@@ -12,3 +15,28 @@ def pairwise(iterable):
     a, b = tee(iterable)
     next(b, None)
     return zip(a, b)
+
+
+def _parse_counted_line(line: str) -> tuple[tuple[str, ...], int]:
+    words, _, count = line.rpartition(' ')
+    return tuple(words.split(' ')), int(count)
+
+
+def merge_sorted_lines(runs: Iterable[Iterable[str]], max_weight: int = None) -> Iterator[str]:
+    """
+    Merges runs of lines of words and a count, e.g. 'first_word next_word count',
+    sorted by the words, into one sorted run, where the counts of the same words are summed.
+    :param max_weight: limit of the summed counts.
+    """
+    parsed_runs = [map(_parse_counted_line, run) for run in runs]
+    words = None
+    count = 0
+    for w, c in heapq.merge(*parsed_runs, key=itemgetter(0)):
+        if w == words:
+            count += c
+            continue
+        if words is not None:
+            yield f'{" ".join(words)} {count if max_weight is None else min(count, max_weight)}'
+        words, count = w, c
+    if words is not None:
+        yield f'{" ".join(words)} {count if max_weight is None else min(count, max_weight)}'
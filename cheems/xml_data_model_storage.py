@@ -1,17 +1,48 @@
+import asyncio
 import logging
 import os
-from datetime import datetime, timezone
-from typing import Dict, Optional, TypeVar, Generic
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone, timedelta
+from functools import partial
+from typing import Dict, Optional, TypeVar, Generic, Callable, Type, TextIO, Iterable
 
-from cheems.base_xml_data_model import BaseXmlDataModel
+from cheems.base_xml_data_model import BaseXmlDataModel, iter_xml_data_lines
+from cheems.config import config
 from cheems.discord_helper import EPOCH
+from cheems.metrics import metrics
+from cheems.model_writer import ModelWriter, WriteJob, FunctionJob, write_file_atomically
 from cheems.targets import Target, Server, Channel, User
-from cheems.util import sanitize_filename
+from cheems.util import sanitize_filename, merge_sorted_lines
 
 logger = logging.getLogger(__name__)
 
 T = TypeVar('T', bound=BaseXmlDataModel)
 
+MANIFEST_FILENAME = '.manifest'
+'''Index of model headers in root_dir, so that preloading doesn't need to open every file'''
+
+LOST_DIRNAME = 'lost'
+'''Models without a file path are saved here, they aren't loaded'''
+
+
+@dataclass
+class ModelCacheStats:
+    """Counters of models with loaded data, for sizing the memory budget"""
+    hits: int = 0
+    '''`get_model` found data already loaded'''
+    misses: int = 0
+    '''`get_model` had to load data from file'''
+    evictions: int = 0
+    '''Data was unloaded to stay within the budget'''
+    loaded_models: int = 0
+    loaded_entries: int = 0
+    loaded_bytes: int = 0
+
 
 class XmlDataModelStorage(Generic[T]):
     """
@@ -29,18 +60,117 @@ class XmlDataModelStorage(Generic[T]):
     models_by_server_id: ModelsByServer
     models: list[T]
 
+    manifest: dict[str, ET.Element]
+    '''
+    Model headers with file size, mtime and checksum, mapped by path relative to root_dir.
+    Entries are trusted while the file's size and mtime match.
+    '''
+    manifest_save_period = timedelta(seconds=60)
+    _manifest_saved_time: Optional[datetime] = None
+    _manifest_lock: threading.RLock
+    '''The manifest is updated by the writer thread'''
+
+    max_loaded_entries: int
+    '''Memory budget for loaded data, in entries (e.g. word pairs). 0 means no limit.'''
+    max_loaded_bytes: int
+    '''Memory budget for loaded data, in approximate bytes. 0 means no limit.'''
+    _loaded: OrderedDict[tuple[int, any], tuple[T, int, int]]
+    '''Models with loaded data and their sizes, the least recently used first'''
+    cache_stats: ModelCacheStats
+
+    _loader: Optional[ThreadPoolExecutor] = None
+    '''
+    Loads data for `get_model_async`. A single thread is enough to unblock the event loop,
+    and it keeps the shared vocabulary of compact models from being updated concurrently.
+    '''
+    _loading: dict[tuple[int, any], asyncio.Future]
+    '''Ongoing loads by `get_model_async`, so that concurrent calls share them'''
+
+    writer: Optional[ModelWriter] = None
+    '''If started, models are written on its thread. See `start_writer`.'''
+
+    max_weight_key: Optional[str] = None
+    '''Config key of the maximum weight of a data entry, which limits counts when models are merged'''
+
+    metrics_name: str = 'model'
+    '''Label of this kind of storage in metrics'''
+
     def __init__(self, root_dir):
         self.root_dir = root_dir
         self.models_by_server_id = {}
         self.models = []
+        self.manifest = {}
+        self._manifest_lock = threading.RLock()
+        cache_config = config.get('model_cache', None) or {}
+        self.max_loaded_entries = int(cache_config.get('max_pairs', 0) or 0)
+        self.max_loaded_bytes = int(cache_config.get('max_bytes', 0) or 0)
+        self._loaded = OrderedDict()
+        self.cache_stats = ModelCacheStats()
+        self._loading = {}
 
     def _register_model(self, m: T):
         self.models.append(m)
         self.models_by_server_id.setdefault(m.server_id, {})
         models_by_target = self.models_by_server_id[m.server_id]
         models_by_target[m.target.key] = m
+        if m.is_data_loaded:
+            self._touch_loaded_model(m)
+
+    def _touch_loaded_model(self, m: T, update_size: bool = False):
+        """
+        Marks the model as most recently used, and evicts cold models if needed.
+        :param update_size: measure the data again, e.g. after training.
+            Otherwise, it's only measured when the model is first touched after loading.
+        """
+        key = (m.server_id, m.target.key)
+        if not update_size and key in self._loaded:
+            self._loaded.move_to_end(key)
+            return
+        old = self._loaded.pop(key, None)
+        if old is not None:
+            self.cache_stats.loaded_entries -= old[1]
+            self.cache_stats.loaded_bytes -= old[2]
+        entries, size_bytes = m.get_data_size()
+        self._loaded[key] = (m, entries, size_bytes)
+        self.cache_stats.loaded_entries += entries
+        self.cache_stats.loaded_bytes += size_bytes
+        self._evict()
+        self.cache_stats.loaded_models = len(self._loaded)
+
+    def _is_over_budget(self) -> bool:
+        return 0 < self.max_loaded_entries < self.cache_stats.loaded_entries or \
+            0 < self.max_loaded_bytes < self.cache_stats.loaded_bytes
+
+    def _evict(self):
+        """
+        Unloads data of the least recently used models until the budget is met.
+        Models with unsaved changes are kept, and so is the most recent one.
+        """
+        if not self._is_over_budget():
+            return
+        for key, (m, entries, size_bytes) in list(self._loaded.items())[:-1]:
+            if m.has_unsaved_changes or m.file_path is None:
+                continue
+            if self.writer is not None and self.writer.is_pending(key):
+                continue  # the file is outdated until the writer is done
+            self._unload_model(m)
+            self.cache_stats.evictions += 1
+            logger.info(f'Unloaded model data: {m.file_path}')
+            if not self._is_over_budget():
+                break
+
+    def _unload_model(self, m: T):
+        """Drops the model's data from memory, it will be loaded from the file when needed"""
+        entry = self._loaded.pop((m.server_id, m.target.key), None)
+        if entry is not None:
+            self.cache_stats.loaded_entries -= entry[1]
+            self.cache_stats.loaded_bytes -= entry[2]
+            self.cache_stats.loaded_models = len(self._loaded)
+        m.unload_data()
 
-    def ensure_type(self, base: BaseXmlDataModel) -> T:
+    @classmethod
+    def ensure_type(cls, base: BaseXmlDataModel) -> T:
+        """Converts the base model into T. This is a classmethod so that it can run in a loader process."""
         return base
 
     def preload_models(self):
@@ -49,47 +179,286 @@ class XmlDataModelStorage(Generic[T]):
         """
         self.load_models(load_data=False)
 
-    def load_models(self, load_data: bool = True):
+    def load_models(self, load_data: bool = True, workers: int = None):
         """
         Loads all models from the configured directory
 
         :param load_data: if true, the data will be stored in RAM.
             If false, the model will be "pre-loaded" without data, and data
             needs to be loaded again from disk.
+        :param workers: number of processes that read and parse files in parallel.
+            Defaults to 'model_load_workers' from the config, 1 reads them in this process.
         """
+        if workers is None:
+            workers = config.get('model_load_workers', 1)
+        self._read_manifest()
+        found_paths: set[str] = set()
+        paths_to_read: list[str] = []
         subdir: str
         files: list[str]
-        for subdir, _, files in os.walk(self.root_dir):
+        for subdir, dirs, files in os.walk(self.root_dir):
+            if subdir == self.root_dir and LOST_DIRNAME in dirs:
+                # duplicates of other models, which can be merged into them with `merge_model_files`
+                dirs.remove(LOST_DIRNAME)
             for file in files:
                 full_path: str = os.path.join(subdir, file)
                 filename = os.fsdecode(file)
                 if filename.endswith('.xml'):
+                    found_paths.add(self._get_manifest_path(full_path))
                     try:
-                        m = BaseXmlDataModel.from_xml_file(full_path, load_data)
-                        typed_m = self.ensure_type(m)
-                        self._register_model(typed_m)
+                        m = None if load_data else self._get_model_from_manifest(full_path)
+                        if m is None:
+                            paths_to_read.append(full_path)
+                        else:
+                            self._register_model(self.ensure_type(m))
                     except Exception:
                         logger.exception(f'Failed to load model {filename}')
+
+        if workers > 1 and len(paths_to_read) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(_read_model_file, type(self), full_path, load_data)
+                    for full_path in paths_to_read
+                ]
+                for full_path, future in zip(paths_to_read, futures):
+                    self._add_read_model(full_path, future.result)
+        else:
+            for full_path in paths_to_read:
+                self._add_read_model(full_path, partial(_read_model_file, type(self), full_path, load_data))
+
+        # forget deleted files:
+        with self._manifest_lock:
+            for path in list(self.manifest.keys()):
+                if path not in found_paths:
+                    del self.manifest[path]
+        self.save_manifest()
         if load_data:
             logger.info(f'Loaded {len(self.models)} XMl models from {self.root_dir}')
         else:
             logger.info(f'Preloaded {len(self.models)} XMl models from {self.root_dir}')
 
+    def _get_model_from_manifest(self, full_path: str) -> Optional[BaseXmlDataModel]:
+        """Returns the model header from the manifest, or None if the file has changed"""
+        entry = self.manifest.get(self._get_manifest_path(full_path), None)
+        if entry is None or not _is_manifest_entry_fresh(entry, os.stat(full_path)):
+            return None
+        # noinspection PyProtectedMember
+        m = BaseXmlDataModel._from_xml_element(entry, load_data=False)
+        m.file_path = full_path
+        return m
+
+    def _add_read_model(self, full_path: str, read: Callable[[], tuple[T, os.stat_result]]):
+        """Registers the result of `_read_model_file` and updates its manifest entry"""
+        try:
+            m, stat = read()
+            entry = self.manifest.get(self._get_manifest_path(full_path), None)
+            is_fresh = entry is not None and _is_manifest_entry_fresh(entry, stat)
+            checksum = entry.get('checksum', '') if is_fresh else ''
+            self._update_manifest(m.file_path, m.header_to_xml(), stat, checksum)
+            self._register_model(m)
+        except Exception:
+            logger.exception(f'Failed to load model {os.path.basename(full_path)}')
+
+    def start_writer(self, max_queue: int = 64):
+        """From now on, models are written on a separate thread. Call `flush` to wait for them."""
+        if self.writer is None:
+            self.writer = ModelWriter(max_queue, name=f'{type(self).__name__}_writer')
+
+    def stop_writer(self):
+        """Writes the remaining saves and stops the writer thread. Models are then written right away."""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def flush(self):
+        """Blocks until all models submitted to the writer are saved"""
+        if self.writer is not None:
+            self.writer.flush()
+
+    async def flush_async(self):
+        """Waits until all models submitted to the writer are saved"""
+        if self.writer is not None:
+            await self.writer.flush_async()
+
     def save_model(self, xml_model: T):
         """
         Saves model into the xml file, as written in attr 'file_path'
         """
+        self._ensure_file_path(xml_model)
+        file_path = xml_model.file_path
+        # the model is serialized on the writer thread, while training continues
+        snapshot = xml_model.snapshot()
+        header = xml_model.header_to_xml()
+        self._submit_write(xml_model, FunctionJob(
+            lambda: self._write_model_file(file_path, header, snapshot.write_xml)
+        ))
+
+    def save_model_lines(self, xml_model: T, lines: Iterable[str]):
+        """
+        Rewrites the model with these sorted data lines instead of its data,
+        e.g. merged from files, so that the whole data is never in memory.
+        The file is written right away, and then the model's data is unloaded, to be read from the new file.
+        """
+        self._ensure_file_path(xml_model)
+        # earlier saves of this model must not overwrite the new file
+        self.flush()
+        self._write_model_file(xml_model.file_path, xml_model.header_to_xml(),
+                               lambda f: xml_model.write_xml(f, lines=lines))
+        xml_model.has_unsaved_changes = False
+        self._unload_model(xml_model)
+
+    def merge_model_files(self, file_paths: list[str], target: Target = None) -> T:
+        """
+        Merges model files of this storage's kind into the model of the target, with its existing data, and saves it.
+        Sorted data lines are streamed from the files, so none of them is loaded entirely:
+        the counts of the same entries are summed and limited by the max weight,
+        and the time range covers all the files. The files themselves are left as they are.
+
+        :param target: defaults to the target of the first file.
+        """
+        headers: list[BaseXmlDataModel] = []
+        runs: list[Iterable[str]] = []
+        for path in file_paths:
+            header, file_runs = self._open_model_file(path)
+            headers.append(header)
+            runs.extend(file_runs)
+        if target is None:
+            target = headers[0].target
+        model = self._find_model(target)
+        if model is None:
+            model = self.create_model(target)
+        elif model.has_unsaved_changes:
+            self.save_model(model)
+        self.flush()
+        if os.path.exists(model.file_path) and \
+                not any(os.path.exists(p) and os.path.samefile(model.file_path, p) for p in file_paths):
+            header, file_runs = self._open_model_file(model.file_path)
+            headers.append(header)
+            runs.extend(file_runs)
+
+        from_times = [h.from_time for h in headers if h.from_time != EPOCH]
+        model.from_time = min(from_times, default=EPOCH)
+        model.to_time = max(h.to_time for h in headers)
+        model.updated_time = datetime.now(tz=timezone.utc)
+        max_weight = int(config.get(self.max_weight_key, 9999)) if self.max_weight_key is not None else None
+        self.save_model_lines(model, merge_sorted_lines(runs, max_weight))
+        logger.info(f'Merged {len(file_paths)} files into {model.file_path}')
+        return model
+
+    def merge_model_lines(self, target: Target, runs: list[Iterable[str]],
+                          from_time: datetime = EPOCH, to_time: datetime = EPOCH) -> T:
+        """
+        Merges sorted runs of data lines, e.g. spilled from training, into the model of the target, and saves it.
+        Like in `merge_model_files`, the existing data is streamed from the model's file as one more run,
+        so it's never loaded, and the model's data is unloaded after the save.
+
+        :param from_time: extends the time range of the model, unless it's EPOCH.
+        """
+        model = self._find_model(target)
+        if model is None:
+            model = self.create_model(target)
+        elif model.has_unsaved_changes:
+            self.save_model(model)
+        self.flush()
+        runs = list(runs)
+        if model.file_path is not None and os.path.exists(model.file_path):
+            runs.extend(self._open_model_file(model.file_path)[1])
+        if from_time != EPOCH and (model.from_time == EPOCH or model.from_time > from_time):
+            model.from_time = from_time
+        if model.to_time < to_time:
+            model.to_time = to_time
+        model.updated_time = datetime.now(tz=timezone.utc)
+        max_weight = int(config.get(self.max_weight_key, 9999)) if self.max_weight_key is not None else None
+        self.save_model_lines(model, merge_sorted_lines(runs, max_weight))
+        return model
+
+    def _open_model_file(self, file_path: str) -> tuple[BaseXmlDataModel, list[Iterable[str]]]:
+        """
+        Reads the header of the model file, without data.
+        :return: the header, and sorted runs of its data lines.
+        """
+        # noinspection PyProtectedMember
+        header = BaseXmlDataModel._read_xml_file(file_path, load_data=False)
+        return header, [iter_xml_data_lines(file_path)]
+
+    def _submit_write(self, xml_model: T, job: WriteJob):
+        """
+        Runs the job on the writer thread if it's started, otherwise right away.
+        The job must only use data prepared on this thread, because the model can change meanwhile.
+        """
+        self._on_model_saved(xml_model)
+        if self.writer is None:
+            job.run()
+        else:
+            self.writer.submit((xml_model.server_id, xml_model.target.key), job)
+
+    def _write_model_file(self, file_path: str, header: ET.Element, write: Callable[[TextIO], None]):
+        """Writes the file via `write_file_atomically` and updates its manifest entry"""
+        crc = write_file_atomically(file_path, write)
+        self._update_manifest(file_path, header, os.stat(file_path), f'{crc:08x}')
+        with self._manifest_lock:
+            if self._manifest_saved_time is None or \
+                    datetime.now(tz=timezone.utc) - self._manifest_saved_time >= self.manifest_save_period:
+                self.save_manifest()
+
+    def _on_model_saved(self, xml_model: T):
+        xml_model.has_unsaved_changes = False
+        if xml_model.is_data_loaded:
+            # training could have changed its size
+            self._touch_loaded_model(xml_model, update_size=True)
+
+    def _get_manifest_path(self, full_path: str) -> str:
+        return os.path.relpath(full_path, self.root_dir)
+
+    def _update_manifest(self, file_path: str, header: ET.Element, stat: os.stat_result, checksum: str):
+        """
+        :param header: result of `header_to_xml`.
+        :param checksum: CRC32 of the file's content. It is only known after saving,
+            files that were changed by someone else have an empty checksum.
+        """
+        header.attrib.update({
+            'path': self._get_manifest_path(file_path),
+            'size': str(stat.st_size),
+            'mtime_ns': str(stat.st_mtime_ns),
+            'checksum': checksum,
+        })
+        with self._manifest_lock:
+            self.manifest[header.attrib['path']] = header
+
+    def _read_manifest(self):
+        manifest_path = os.path.join(self.root_dir, MANIFEST_FILENAME)
+        if not os.path.exists(manifest_path):
+            return
+        try:
+            root = ET.parse(manifest_path).getroot()
+            for entry in root:
+                self.manifest[entry.attrib['path']] = entry
+        except Exception:
+            logger.exception(f'Failed to read manifest {manifest_path}, will rescan all models')
+
+    def save_manifest(self):
+        """Writes the manifest file. It is also saved periodically when saving models."""
+        if not os.path.isdir(self.root_dir):
+            return
+        with self._manifest_lock:
+            root = ET.Element('manifest')
+            root.extend(self.manifest.values())
+            manifest_path = os.path.join(self.root_dir, MANIFEST_FILENAME)
+            tmp_path = f'{manifest_path}.tmp'
+            ET.ElementTree(root).write(tmp_path, encoding='utf-8', xml_declaration=True)
+            os.replace(tmp_path, manifest_path)
+            self._manifest_saved_time = datetime.now(tz=timezone.utc)
+
+    def _ensure_file_path(self, xml_model: T):
         if xml_model.file_path is None:
             # this shouldn't happen, so we'll save it in a special folder 'lost'
             dir_name = f'{xml_model.server_id}'
-            subdir = os.path.join(self.root_dir, 'lost', dir_name)
+            subdir = os.path.join(self.root_dir, LOST_DIRNAME, dir_name)
             if not os.path.exists(subdir):
                 os.makedirs(subdir)
             filename = f'{str(datetime.now())}.xml'
             file_path = os.path.join(subdir, filename)
             xml_model.file_path = file_path
-        with open(xml_model.file_path, 'w', encoding='utf-8') as f:
-            f.write(xml_model.to_xml())
 
     def create_model(self, target: Target) -> T:
         """
@@ -121,6 +490,8 @@ class XmlDataModelStorage(Generic[T]):
         filename = f'{target.id} {sanitize_filename(target.name)}.xml'
         file_path: str = os.path.join(subdir, filename)
         xml_model.file_path = file_path
+        # the file doesn't exist yet, so the data can't be unloaded
+        xml_model.has_unsaved_changes = True
 
         typed_model = self.ensure_type(xml_model)
 
@@ -137,16 +508,87 @@ class XmlDataModelStorage(Generic[T]):
             model = self.create_model(target)
         return model
 
+    def _find_model(self, target: Target) -> Optional[T]:
+        models_by_target = self.models_by_server_id.get(target.server_id, {})
+        return models_by_target.get(target.key, None)
+
     def get_model(self, target: Target) -> Optional[T]:
         """
         Finds an existing model for this target, does not create new model.
         """
-        if target.server_id not in self.models_by_server_id:
+        m = self._find_model(target)
+        if m is None:
             return None
-        models_by_target = self.models_by_server_id[target.server_id]
-        if target.key not in models_by_target:
+        if m.is_data_loaded:
+            self.cache_stats.hits += 1
+        else:
+            self.cache_stats.misses += 1
+            with metrics.timer('model_load_seconds', storage=self.metrics_name):
+                m.load_data()
+        self._touch_loaded_model(m)
+        return m
+
+    async def get_model_async(self, target: Target) -> Optional[T]:
+        """
+        Same as `get_model`, but the data is loaded in a worker thread, so that the event loop keeps running.
+        Concurrent calls for the same target wait for the same load.
+        """
+        m = self._find_model(target)
+        if m is None:
             return None
-        m = models_by_target[target.key]
+        if m.is_data_loaded:
+            self.cache_stats.hits += 1
+            self._touch_loaded_model(m)
+            return m
+        key = (m.server_id, m.target.key)
+        future = self._loading.get(key, None)
+        if future is None:
+            self.cache_stats.misses += 1
+            if self._loader is None:
+                self._loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='model_loader')
+            future = asyncio.get_running_loop().run_in_executor(
+                self._loader, _read_model_file, type(self), m.file_path, True
+            )
+            self._loading[key] = future
+            start = time.perf_counter()
+
+            def on_loaded(_):
+                self._loading.pop(key, None)
+                metrics.observe('model_load_seconds', time.perf_counter() - start, storage=self.metrics_name)
+
+            future.add_done_callback(on_loaded)
+        # shielded, so that a cancelled caller doesn't cancel the load for the others
+        loaded, _ = await asyncio.shield(future)
         if not m.is_data_loaded:
-            m.load_data()
+            # the rest is done on the event loop, so that other coroutines never see a half-loaded model
+            m.__dict__ = loaded.__dict__.copy()
+            logger.info(f'Loaded model from file: {m.file_path}')
+        self._touch_loaded_model(m)
         return m
+
+    def collect_metrics(self) -> Iterable[tuple[str, dict[str, object], float]]:
+        """Gauges of the cache and of the memory each loaded model takes, see `Metrics.add_collector`"""
+        labels = {'storage': self.metrics_name}
+        yield 'loaded_models', labels, self.cache_stats.loaded_models
+        yield 'loaded_entries', labels, self.cache_stats.loaded_entries
+        yield 'loaded_bytes', labels, self.cache_stats.loaded_bytes
+        yield 'model_cache_hits', labels, self.cache_stats.hits
+        yield 'model_cache_misses', labels, self.cache_stats.misses
+        yield 'model_cache_evictions', labels, self.cache_stats.evictions
+        for m, _, size_bytes in self._loaded.values():
+            yield 'loaded_model_bytes', {**labels, 'target': m.target}, size_bytes
+
+
+def _is_manifest_entry_fresh(entry: ET.Element, stat: os.stat_result) -> bool:
+    return entry.attrib.get('size') == str(stat.st_size) and \
+        entry.attrib.get('mtime_ns') == str(stat.st_mtime_ns)
+
+
+def _read_model_file(
+        storage_cls: Type[XmlDataModelStorage[T]], full_path: str, load_data: bool
+) -> tuple[T, os.stat_result]:
+    """Reads and converts the model. Runs in a loader process when loading in parallel."""
+    stat = os.stat(full_path)
+    # noinspection PyProtectedMember
+    m = BaseXmlDataModel._read_xml_file(full_path, load_data)
+    return storage_cls.ensure_type(m), stat
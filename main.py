@@ -11,6 +11,7 @@ from discord.ext import commands
 from cheems.help_cog import HelpCog
 from cheems.markov import models_xml
 from cheems.markov_cog import MarkovCog
+from cheems.metrics import start_exporter
 from cheems.proactive_markov_cog import ProactiveMarkovCog
 from cheems.proactive_react_cog import ProactiveReactCog
 from cheems.reaction import reactions
@@ -46,6 +47,7 @@ async def main():
         await bot.add_cog(ProactiveReactCog(bot))
         await bot.add_cog(HelpCog(bot))
         await bot.add_cog(PicsCog(bot))
+        await start_exporter()
         await bot.start(config['discord_token'])
 
 
@@ -0,0 +1,190 @@
+import pickle
+import random
+from unittest import TestCase
+from unittest.mock import patch
+
+from cheems.config import config
+# noinspection PyProtectedMember
+from cheems.markov.markov import markov_chain, train_model_on_sentence, _pick_first_word
+from cheems.markov.compact_model_data import CompactModelData, Vocabulary, shared_vocabulary
+from cheems.markov.model import Model
+from tests import override_test_config
+
+test_data_str = '''
+. hello 2
+hello ,my 1
+hello darkness 2
+my world 3
+world . 1
+'''
+
+
+class TestCompactModelData(TestCase):
+    def setUp(self) -> None:
+        self.vocab = Vocabulary()
+
+    def test_parse_same_as_dict(self):
+        data = CompactModelData.parse(test_data_str, 9999, self.vocab)
+        self.assertEqual({
+            '.': {'hello': 2},
+            'hello': {',my': 1, 'darkness': 2},
+            'my': {'world': 3},
+            'world': {'.': 1},
+        }, data)
+        self.assertEqual(5, data.pair_count)
+        self.assertEqual(test_data_str.strip(), Model._serialize_data(data))
+
+    def test_parse_unsorted_with_duplicates(self):
+        data = CompactModelData.parse('''
+        world . 1
+        hello world 1
+        world . 2
+        hello world 3
+        ''', 9999, self.vocab)
+        self.assertEqual({'hello': {'world': 4}, 'world': {'.': 3}}, data)
+
+    def test_parse_max_weight(self):
+        data = CompactModelData.parse('''
+        hello world 1
+        wow! amazing 3
+        ''', 2, self.vocab)
+        self.assertEqual({'hello': {'world': 1}, 'wow!': {'amazing': 2}}, data)
+
+    def test_shared_vocabulary(self):
+        data1 = CompactModelData.parse('hello world 1', 9999, self.vocab)
+        data2 = CompactModelData.parse('world hello 1', 9999, self.vocab)
+        self.assertEqual(2, len(self.vocab))
+        self.assertEqual({'world': {'hello': 1}}, data2)
+        self.assertNotEqual(data1, data2)
+
+    def test_pickle_into_shared_vocabulary(self):
+        data = CompactModelData.parse(test_data_str, 9999, self.vocab)
+        data.append('my', 'dude')
+        restored = pickle.loads(pickle.dumps(data))
+        self.assertIs(shared_vocabulary, restored.vocab)
+        self.assertEqual(data, restored)
+        self.assertEqual(Model._serialize_data(data), Model._serialize_data(restored))
+
+    def test_append_pairs(self):
+        data = CompactModelData.parse(test_data_str, 9999, self.vocab)
+        dict_data = Model.parse_data(test_data_str)
+        counts = {('hello', 'darkness'): 1, ('hello', 'friend'): 2, ('friend', '.'): 1}
+        data.append_pairs(counts)
+        dict_data.append_pairs(counts)
+        self.assertEqual(dict_data, data)
+        self.assertEqual(3, data['hello']['darkness'])
+
+    def test_append_and_compact(self):
+        data = CompactModelData.parse(test_data_str, 9999, self.vocab)
+        data.append('hello', 'darkness')
+        data.append('hello', 'friend', 2)
+        data.append('friend', '.')
+        self.assertEqual(3, data._overflow_pairs)
+        expected = {
+            '.': {'hello': 2},
+            'hello': {',my': 1, 'darkness': 3, 'friend': 2},
+            'my': {'world': 3},
+            'world': {'.': 1},
+            'friend': {'.': 1},
+        }
+        self.assertEqual(expected, data)
+        self.assertEqual(5, len(data))
+        data.compact()
+        self.assertEqual(0, data._overflow_pairs)
+        self.assertEqual(expected, data)
+        self.assertEqual(7, data.pair_count)
+
+    def test_compacts_periodically(self):
+        data = CompactModelData(vocab=self.vocab)
+        data.compact_min_pairs = 10
+        for i in range(11):
+            data.append('hello', f'world{i}')
+        self.assertEqual(0, data._overflow_pairs)
+        self.assertEqual(11, len(data['hello']))
+
+    def test_weighted_next_word(self):
+        data = CompactModelData.parse('''
+        hello world 1
+        hello darkness 10
+        ''', 9999, self.vocab)
+        count_world = 0
+        count_darkness = 0
+        for x in range(100):
+            random.seed(x)
+            s = data.get_random_next_word('hello')
+            if s == 'world':
+                count_world += 1
+            elif s == 'darkness':
+                count_darkness += 1
+        self.assertEqual(100, count_world + count_darkness)
+        self.assertGreater(count_darkness, count_world * 5)
+        self.assertIsNone(data.get_random_next_word('world'))
+        self.assertIsNone(data.get_random_next_word('nothing'))
+
+    def test_same_random_choices_as_dict(self):
+        compact = CompactModelData.parse(test_data_str, 9999, self.vocab)
+        data = Model.parse_data(test_data_str)
+        for x in range(20):
+            random.seed(x)
+            expected = data.get_random_next_word('hello')
+            random.seed(x)
+            self.assertEqual(expected, compact.get_random_next_word('hello'))
+
+    def test_markov_chain(self):
+        data = CompactModelData.parse('''
+        hello ,my 1
+        my world 1
+        world . 1
+        ''', 9999, self.vocab)
+        self.assertEqual('hello, my world', markov_chain(data, 'hello'))
+        random.seed(1)
+        self.assertEqual('hello, my world', markov_chain(data))
+
+    def test_pick_first_word(self):
+        data = CompactModelData(vocab=self.vocab)
+        self.assertEqual('.', _pick_first_word(data))
+        Model._append_word_pair(data, 'first', '.')
+        self.assertEqual('first', _pick_first_word(data))
+        Model._append_word_pair(data, 'second', 'word')
+        for x in range(10):
+            random.seed(x)
+            self.assertEqual('second', _pick_first_word(data))
+        train_model_on_sentence(data, 'third word')
+        # the start of 'first' is unknown, like in older models, so it's picked from any word
+        picks = []
+        for x in range(100):
+            random.seed(x)
+            picks.append(_pick_first_word(data))
+        self.assertEqual({'second', 'third'}, set(picks))
+        self.assertGreater(picks.count('third'), picks.count('second'))
+
+    def test_non_terminal_words(self):
+        data = CompactModelData.parse(test_data_str, 9999, self.vocab)
+        self.assertEqual(True, data.is_non_terminal('hello'))
+        self.assertEqual(False, data.is_non_terminal('world'))
+        self.assertEqual(False, data.is_non_terminal('nothing'))
+        data.append('world', 'again')
+        self.assertEqual(True, data.is_non_terminal('world'))
+
+    def test_indexes_built_on_parse(self):
+        text = test_data_str + 'darkness . 2\ndarkness ! 1\nworld ? 4\n'
+        data = CompactModelData.parse(text, 9999, self.vocab)
+        expected = Model.parse_data(text)
+        # noinspection PyProtectedMember
+        self.assertEqual(expected._end_count, data._end_count)
+        self.assertEqual(8, data._end_count)
+        with patch.object(CompactModelData, 'build_indexes', side_effect=AssertionError):
+            for word in ['hello', 'my', 'world', 'darkness', '.']:
+                self.assertEqual(expected.is_non_terminal(word), data.is_non_terminal(word))
+            data.get_random_first_word()
+
+    def test_config_backend(self):
+        backend = config.get('markov_model_backend', 'dict')
+        override_test_config('markov_model_backend: compact')
+        try:
+            self.assertIsInstance(Model.parse_data(test_data_str), CompactModelData)
+            model = Model(None, None, None, None, '', data={'hello': {'world': 1}})
+            self.assertIsInstance(model.data, CompactModelData)
+            self.assertEqual({'hello': {'world': 1}}, model.data)
+        finally:
+            override_test_config(f'markov_model_backend: {backend}')
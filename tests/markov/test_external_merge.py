@@ -0,0 +1,56 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from cheems.markov.external_merge import SortedRuns
+from cheems.markov.model import Model
+from cheems.markov.model_data import ModelData
+from cheems.markov.models_xml import MarkovStorage
+from cheems.targets import Server, User
+
+server1 = Server(100, 'London')
+user1 = User(123, 'Kagamin', 1111, server1)
+
+
+def _make_data(*pairs: tuple[str, str, int]) -> ModelData:
+    data = ModelData()
+    for first_word, next_word, count in pairs:
+        data.append(first_word, next_word, count)
+    return data
+
+
+class TestExternalMerge(TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_spill_and_merge(self):
+        runs = SortedRuns(self.temp_dir.name, 'model')
+        runs.spill(_make_data(('hello', 'world', 1), ('world', '.', 1)))
+        runs.spill(_make_data(('hello', 'world', 2), ('.', 'hello', 1)))
+        self.assertEqual(2, len(runs.paths))
+        in_memory = _make_data(('hello', 'baby', 1))
+        # noinspection PyProtectedMember
+        merged = runs.iter_merged_lines(Model._iter_serialized_lines(in_memory))
+        self.assertEqual(['. hello 1', 'hello baby 1', 'hello world 3', 'world . 1'], list(merged))
+        runs.remove()
+        self.assertEqual([], os.listdir(self.temp_dir.name))
+
+    def test_save_model_lines(self):
+        storage = MarkovStorage(os.path.join(self.temp_dir.name, 'models'))
+        m = storage.create_model(user1)
+        m.append_word_pair('hello', 'world')
+        storage.save_model(m)
+        # the journal is dropped with the new file
+        m.append_word_pair('hello', 'world')
+        storage.save_model(m)
+
+        storage.save_model_lines(m, iter(['. hello 1', 'hello world 5']))
+        self.assertFalse(m.is_data_loaded)
+        self.assertEqual({'.': {'hello': 1}, 'hello': {'world': 5}}, storage.get_model(user1).data)
+
+        storage = MarkovStorage(os.path.join(self.temp_dir.name, 'models'))
+        storage.load_models()
+        self.assertEqual({'.': {'hello': 1}, 'hello': {'world': 5}}, storage.get_model(user1).data)
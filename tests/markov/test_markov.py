@@ -3,7 +3,8 @@ from unittest import TestCase
 
 # noinspection PyProtectedMember
 from cheems.markov.markov import markov_chain, _pick_first_word,\
-    _break_into_words, train_model_on_sentence, get_last_word
+    _break_into_words, train_model_on_sentence, get_last_word, canonical_form, train_models_on_messages, \
+    count_word_pairs, train_model_groups
 from cheems.markov.model import Model
 
 
@@ -49,6 +50,37 @@ hello darkness 10
                 count_darkness += 1
         self.assertGreater(count_darkness, count_world * 5)
 
+    def test_prompt_continues_past_end(self):
+        data = Model.parse_data('''
+hello . 1000
+hello world 1
+world ! 1
+        ''')
+        for x in range(20):
+            random.seed(x)
+            self.assertEqual('hello world!', markov_chain(data, 'hello'))
+        # without a prompt, the chain can end right away
+        data = Model.parse_data('''
+. hello 1
+hello . 1000
+hello world 1
+        ''')
+        random.seed(1)
+        self.assertEqual('hello', markov_chain(data))
+
+    def test_prompt_at_dead_end(self):
+        data = Model.parse_data('''
+hello world 1
+world ! 1
+        ''')
+        self.assertEqual(False, data.is_non_terminal('world'))
+        self.assertEqual(False, data.is_non_terminal('unknown'))
+        self.assertEqual('world!', markov_chain(data, 'world'))
+        self.assertEqual('unknown', markov_chain(data, 'unknown'))
+        data.append('world', 'again')
+        self.assertEqual(True, data.is_non_terminal('world'))
+        self.assertEqual('world again', markov_chain(data, 'world'))
+
     def test_limit(self):
         data = Model.parse_data('''
 hello hello 1
@@ -180,10 +212,31 @@ second . 1
         words = _break_into_words('wow ! hello , world ?')
         self.assertEqual(['wow', '!', 'hello', ',world', '?'], words)
 
+    def test_collapse_punctuation_runs(self):
+        words = _break_into_words('hi!!! what?! ok...')
+        self.assertEqual(['hi', '!', 'what', '?', 'ok.'], words)
+
+    def test_bad_punctuation_keeps_separate_comma(self):
+        words = _break_into_words('a , (b')
+        self.assertEqual(['a', ',', 'b'], words)
+
+    def test_remove_zero_width_space(self):
+        words = _break_into_words('a\u200bb ,c')
+        self.assertEqual(['ab', ',c'], words)
+
+    def test_canonical_form(self):
+        self.assertEqual('hello', canonical_form('...Hello!'))
+        self.assertEqual('.roll', canonical_form('.roll'))
+        self.assertEqual('?', canonical_form('?'))
+        self.assertEqual('.', canonical_form(',,'))
+        # cached words give the same result:
+        self.assertEqual('hello', canonical_form('...Hello!'))
+
     def test_train_model_with_command_at_start(self):
         data = Model.parse_data('')
         train_model_on_sentence(data, '.roll d20')
         self.assertEqual('''
+. .roll 1
 .roll d20 1
 d20 . 1
 '''.strip(), Model._serialize_data(data))
@@ -196,6 +249,7 @@ world . 1
         ''')
         train_model_on_sentence(data, 'Hello MY world, dude')
         self.assertEqual('''
+. hello 1
 dude . 1
 hello ,my 1
 hello my 1
@@ -204,10 +258,37 @@ world ,dude 1
 world . 1
 '''.strip(), Model._serialize_data(data))
 
+    def test_train_models_on_messages(self):
+        messages = ['Hello world!', 'hello, world. Hello again', '', 'who?']
+        data1 = Model.parse_data('')
+        data2 = Model.parse_data('')
+        for message in messages:
+            train_model_on_sentence(data1, message)
+        train_models_on_messages([data2], messages)
+        self.assertEqual(data1, data2)
+        self.assertEqual(3, data2['.']['hello'])
+
+    def test_train_model_groups(self):
+        channel = Model.parse_data('')
+        user1 = Model.parse_data('')
+        user2 = Model.parse_data('')
+        train_model_groups([
+            ([channel, user1], ['hello world', 'hello']),
+            ([channel, user2], ['hello world']),
+        ])
+        self.assertEqual({'.': {'hello': 3}, 'hello': {'world': 2, '.': 1}, 'world': {'.': 2}}, channel)
+        self.assertEqual({'.': {'hello': 2}, 'hello': {'world': 1, '.': 1}, 'world': {'.': 1}}, user1)
+        self.assertEqual({'.': {'hello': 1}, 'hello': {'world': 1}, 'world': {'.': 1}}, user2)
+
+    def test_count_word_pairs(self):
+        counts = count_word_pairs(['Hello World', 'hello world'])
+        self.assertEqual({('.', 'hello'): 2, ('hello', 'world'): 2, ('world', '.'): 2}, counts)
+
     def test_train_empty_model(self):
         data = Model.parse_data('')
         train_model_on_sentence(data, 'hello, my dude')
         self.assertEqual('''
+. hello 1
 dude . 1
 hello ,my 1
 my dude 1
@@ -222,6 +303,7 @@ my dude 1
         data = Model.parse_data('')
         train_model_on_sentence(data, 'hello')
         self.assertEqual('''
+. hello 1
 hello . 1
 '''.strip(), Model._serialize_data(data))
 
@@ -233,6 +315,7 @@ world . 1
         ''')
         train_model_on_sentence(data, 'my friends! my world')
         self.assertEqual('''
+. my 2
 friends ! 1
 hello ,my 1
 my friends 1
@@ -244,11 +327,67 @@ world . 2
         data = Model.parse_data('')
         train_model_on_sentence(data, 'wow ! hello , world ?')
         self.assertEqual('''
+. hello 1
+. wow 1
 hello ,world 1
 world ? 1
 wow ! 1
 '''.strip(), Model._serialize_data(data))
 
+    def test_pick_first_word_from_sentence_starts(self):
+        data = Model.parse_data('''
+. hello 1
+hello ,my 1
+my world 1
+world . 1
+        ''')
+        for x in range(10):
+            random.seed(x)
+            self.assertEqual('hello', _pick_first_word(data))
+
+    def test_pick_first_word_weighted_by_starts(self):
+        data = Model.parse_data('')
+        for x in range(10):
+            train_model_on_sentence(data, 'my world')
+        train_model_on_sentence(data, 'hello world')
+        count_my = 0
+        count_hello = 0
+        for x in range(100):
+            random.seed(x)
+            w = _pick_first_word(data)
+            if w == 'my':
+                count_my += 1
+            elif w == 'hello':
+                count_hello += 1
+        self.assertEqual(100, count_my + count_hello)
+        self.assertGreater(count_my, count_hello * 5)
+
+    def test_pick_first_word_keeps_older_starts(self):
+        # trained before sentence starts were stored
+        data = Model.parse_data('''
+hello world 9
+world . 9
+        ''')
+        train_model_on_sentence(data, 'bye')
+        count_hello = 0
+        for x in range(100):
+            random.seed(x)
+            if _pick_first_word(data) == 'hello':
+                count_hello += 1
+        # 1 of 10 sentences has a known start
+        self.assertGreater(count_hello, 70)
+
+    def test_train_model_updates_non_terminal_words(self):
+        data = Model.parse_data('''
+first . 1
+        ''')
+        random.seed(1)
+        self.assertEqual('first', _pick_first_word(data))
+        Model._append_word_pair(data, 'second', 'word')
+        for x in range(10):
+            random.seed(x)
+            self.assertEqual('second', _pick_first_word(data))
+
     def test_last_word(self):
         self.assertEqual('wow', get_last_word('wow! ?'))
 
@@ -1,7 +1,11 @@
+import random
 from datetime import datetime, timedelta, timezone
-from unittest import TestCase
+from unittest import TestCase, mock
 
+from cheems.config import config
+from cheems.markov.compact_model_data import CompactModelData, Vocabulary
 from cheems.markov.model import Model
+from cheems.markov.model_data import ModelData
 from cheems.targets import Target, Server
 from tests import override_test_config
 
@@ -65,12 +69,95 @@ world . 1
 '''.strip(), data_str)
 
     def test_max_weight(self):
+        max_weight_before = config.get('markov_model_max_weight', 9999)
         override_test_config('markov_model_max_weight: 2')
-        data = Model.parse_data('''
-        hello world 1
-        wow! amazing 3
-        ''')
+        try:
+            data = Model.parse_data('''
+            hello world 1
+            wow! amazing 3
+            ''')
+        finally:
+            override_test_config(f'markov_model_max_weight: {max_weight_before}')
         self.assertEqual({
             'hello': {'world': 1},
             'wow!': {'amazing': 2},
         }, data)
+
+    def test_sampling_table_is_cached(self):
+        data = Model.parse_data('''
+        hello world 1
+        hello darkness 2
+        ''')
+        self.assertIsNone(data.get_sampling_table('world'))
+        table = data.get_sampling_table('hello')
+        self.assertEqual((['world', 'darkness'], [1, 3]), table)
+        self.assertIs(table, data.get_sampling_table('hello'))
+
+    def test_sampling_table_invalidated_on_append(self):
+        data = Model.parse_data('''
+        hello world 1
+        ''')
+        self.assertEqual((['world'], [1]), data.get_sampling_table('hello'))
+        Model._append_word_pair(data, 'Hello', 'Darkness', 2)
+        self.assertEqual((['world', 'darkness'], [1, 3]), data.get_sampling_table('hello'))
+
+    def test_snapshot_copied_on_write(self):
+        data = ModelData({'hello': {'world': 1}, 'world': {'.': 1}})
+        snapshot = data.snapshot()
+        data.append('hello', 'darkness')
+        data.append_pairs({('world', 'peace'): 1, ('my', 'friend'): 1})
+        self.assertEqual({'hello': {'world': 1}, 'world': {'.': 1}}, snapshot)
+        self.assertEqual({'world': 1, 'darkness': 1}, data['hello'])
+        self.assertEqual({'.': 1, 'peace': 1}, data['world'])
+        self.assertIs(snapshot['hello'], snapshot.snapshot()['hello'])
+
+    def test_model_data_from_dict(self):
+        model = create_test_model()
+        model = Model(model.from_time, model.to_time, model.updated_time, model.target,
+                      model.description, data={'hello': {'world': 1}})
+        self.assertEqual('world', model.data.get_random_next_word('hello'))
+
+
+def _parse_line_by_line(text: str, max_weight: int) -> dict[str, dict[str, int]]:
+    """The original parser, as a reference"""
+    data = {}
+    for line in text.strip().splitlines():
+        (first_word, next_word, count) = line.strip().split(' ')
+        weight = min(int(count), max_weight)
+        data.setdefault(first_word, {})
+        next_words = data[first_word]
+        next_words.setdefault(next_word, 0)
+        next_words[next_word] += weight
+    return data
+
+
+class TestParseData(TestCase):
+    def _make_text(self, sort: bool) -> str:
+        rng = random.Random(0)
+        words = ['hello', 'hello!', 'world', '.', ',my', 'привет', '<@123>', 'a', 'aa']
+        lines = [
+            f'{rng.choice(words)} {rng.choice(words)} {rng.randint(1, 20)}'
+            for _ in range(500)
+        ]
+        if sort:
+            lines.sort()
+        return '\n'.join(lines)
+
+    def test_same_as_line_parser(self):
+        for sort in [True, False]:
+            text = self._make_text(sort)
+            for max_weight in [9999, 5]:
+                with self.subTest(sort=sort, max_weight=max_weight):
+                    expected = _parse_line_by_line(text, max_weight)
+                    self.assertEqual(expected, ModelData.parse(text, max_weight))
+                    self.assertEqual(expected, CompactModelData.parse(text, max_weight, Vocabulary()))
+
+    def test_rows_split_between_chunks(self):
+        text = self._make_text(sort=True)
+        with mock.patch('cheems.markov.model_data._parse_chunk_size', 100):
+            self.assertEqual(_parse_line_by_line(text, 5), ModelData.parse(text, 5))
+            self.assertEqual(_parse_line_by_line(text, 5), CompactModelData.parse(text, 5, Vocabulary()))
+
+    def test_invalid_line(self):
+        with self.assertRaises(ValueError):
+            ModelData.parse('hello world 1\nworld 2', 9999)
@@ -0,0 +1,157 @@
+import os
+import pickle
+import random
+import sys
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+
+from cheems.config import config
+from cheems.markov import model_bin
+from cheems.markov.convert_models import convert_to_bin, convert_to_xml
+from cheems.markov.markov import markov_chain
+from cheems.markov.model import Model
+from cheems.markov.model_bin import MmapModelData, write_model_bin, get_bin_path
+from cheems.markov.model_xml import XmlModel
+from cheems.markov.models_xml import MarkovStorage
+from cheems.targets import Server, User
+from tests import override_test_config
+
+test_data_str = '''
+. hello 2
+. привет 1
+hello ,my 1
+hello darkness 2
+my world 2
+world . 1
+привет мир 2
+'''
+
+server1 = Server(100, 'London')
+user1 = User(123, 'Kagamin', 1111, server1)
+
+
+class TestModelBin(TestCase):
+    temp_dir: TemporaryDirectory
+
+    def setUp(self) -> None:
+        self.temp_dir = TemporaryDirectory()
+        self.bin_path = os.path.join(self.temp_dir.name, 'model.bin')
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_write_and_open(self):
+        data = Model.parse_data(test_data_str)
+        write_model_bin(data, self.bin_path)
+        mapped = MmapModelData.open(self.bin_path)
+        self.assertEqual(data, mapped)
+        self.assertEqual(test_data_str.strip(), Model._serialize_data(mapped))
+        self.assertEqual({'мир': 2}, mapped['привет'])
+        self.assertNotIn('мир', mapped)
+        self.assertIsNone(mapped.vocab.get_id('nothing'))
+
+    def test_pickle_maps_file_again(self):
+        write_model_bin(Model.parse_data(test_data_str), self.bin_path)
+        mapped = MmapModelData.open(self.bin_path)
+        restored = pickle.loads(pickle.dumps(mapped))
+        self.assertIsInstance(restored, MmapModelData)
+        self.assertEqual(mapped, restored)
+        # with fresh training the data is pickled by value:
+        mapped.append('my', 'dude')
+        mapped.compact()
+        restored = pickle.loads(pickle.dumps(mapped))
+        self.assertNotIsInstance(restored, MmapModelData)
+        self.assertEqual(mapped, restored)
+
+    def test_open_builds_indexes_without_decoding(self):
+        write_model_bin(Model.parse_data(test_data_str), self.bin_path)
+        with patch.object(model_bin.MmapVocabulary, 'get_word', side_effect=AssertionError):
+            mapped = MmapModelData.open(self.bin_path)
+            self.assertEqual(True, mapped.is_non_terminal('hello'))
+            self.assertEqual(False, mapped.is_non_terminal('world'))
+        # noinspection PyProtectedMember
+        self.assertEqual(1, mapped._end_count)
+
+    def test_other_byte_order(self):
+        # swapping both when writing and reading takes the path of a machine of the other byte order
+        other_order = 'big' if sys.byteorder == 'little' else 'little'
+        with patch.object(model_bin, 'sys', SimpleNamespace(byteorder=other_order)):
+            write_model_bin(Model.parse_data(test_data_str), self.bin_path)
+            mapped = MmapModelData.open(self.bin_path)
+            restored = pickle.loads(pickle.dumps(mapped))
+        self.assertEqual(test_data_str.strip(), Model._serialize_data(mapped))
+        self.assertIsInstance(restored, MmapModelData)
+        self.assertEqual(mapped, restored)
+
+    def test_empty_data(self):
+        write_model_bin(Model.parse_data(''), self.bin_path)
+        mapped = MmapModelData.open(self.bin_path)
+        self.assertEqual({}, mapped)
+        self.assertEqual('', markov_chain(mapped))
+
+    def test_same_random_choices_as_dict(self):
+        data = Model.parse_data(test_data_str)
+        write_model_bin(data, self.bin_path)
+        mapped = MmapModelData.open(self.bin_path)
+        for x in range(20):
+            random.seed(x)
+            expected = markov_chain(data, 'hello')
+            random.seed(x)
+            self.assertEqual(expected, markov_chain(mapped, 'hello'))
+
+    def test_train_mapped_data(self):
+        data = Model.parse_data(test_data_str)
+        write_model_bin(data, self.bin_path)
+        mapped = MmapModelData.open(self.bin_path)
+        mapped.append('hello', 'darkness')
+        mapped.append('new', 'word')
+        self.assertEqual({',my': 1, 'darkness': 3}, mapped['hello'])
+        self.assertEqual({'word': 1}, mapped['new'])
+        mapped.compact()
+        self.assertEqual({',my': 1, 'darkness': 3}, mapped['hello'])
+        self.assertEqual({'word': 1}, mapped['new'])
+        self.assertEqual(8, mapped.pair_count)
+
+    def test_storage_saves_bin(self):
+        format_before = config.get('markov_model_format', 'xml')
+        override_test_config('markov_model_format: bin')
+        try:
+            storage = MarkovStorage(self.temp_dir.name)
+            m = storage.create_model(user1)
+            m.append_word_pair('hello', 'world')
+            storage.save_model(m)
+            self.assertTrue(os.path.exists(m.bin_file_path))
+            self.assertEqual({}, XmlModel.from_xml_file(m.file_path, load_data=False).data)
+
+            storage = MarkovStorage(self.temp_dir.name)
+            storage.preload_models()
+            m2 = storage.get_model(user1)
+            self.assertIsInstance(m2.data, MmapModelData)
+            self.assertEqual({'hello': {'world': 1}}, m2.data)
+        finally:
+            override_test_config(f'markov_model_format: {format_before}')
+
+        # saving as xml removes the '.bin' file
+        storage.save_model(m2)
+        self.assertFalse(os.path.exists(m2.bin_file_path))
+        self.assertEqual({'hello': {'world': 1}}, XmlModel.from_xml_file(m2.file_path).data)
+
+    def test_convert_directory(self):
+        storage = MarkovStorage(self.temp_dir.name)
+        m = storage.create_model(user1)
+        m.data = Model.parse_data(test_data_str)
+        storage.save_model(m)
+        xml_size = os.path.getsize(m.file_path)
+
+        convert_to_bin(self.temp_dir.name)
+        bin_path = get_bin_path(m.file_path)
+        self.assertTrue(os.path.exists(bin_path))
+        self.assertLess(os.path.getsize(m.file_path), xml_size)
+        self.assertEqual(m, XmlModel.from_xml_file(m.file_path))
+
+        convert_to_xml(self.temp_dir.name)
+        self.assertFalse(os.path.exists(bin_path))
+        self.assertEqual(xml_size, os.path.getsize(m.file_path))
+        self.assertEqual(m, XmlModel.from_xml_file(m.file_path))
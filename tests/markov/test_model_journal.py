@@ -0,0 +1,114 @@
+import os
+from datetime import datetime, timezone
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from cheems.config import config
+
+from cheems.markov.model_journal import get_journal_path
+from cheems.markov.model_xml import XmlModel
+from cheems.markov.models_xml import MarkovStorage
+from cheems.targets import Server, User
+from tests import override_test_config
+
+server1 = Server(100, 'London')
+user1 = User(123, 'Kagamin', 1111, server1)
+new_time = datetime(2023, 1, 2, tzinfo=timezone.utc)
+
+
+class TestModelJournal(TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = TemporaryDirectory()
+        self.storage = MarkovStorage(self.temp_dir.name)
+        self.m = self.storage.create_model(user1)
+        self.m.append_word_pair('hello', 'world')
+        self.storage.save_model(self.m)
+        self.journal_path = get_journal_path(self.m.file_path)
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def _train_and_save(self, storage: MarkovStorage, m: XmlModel):
+        m.append_word_pair('hello', 'world')
+        m.append_word_pair('world', '.')
+        m.to_time = new_time
+        storage.save_model(m)
+
+    def test_append_and_replay(self):
+        with open(self.m.file_path, encoding='utf-8') as f:
+            xml_before = f.read()
+        self._train_and_save(self.storage, self.m)
+        self.assertTrue(os.path.exists(self.journal_path))
+        with open(self.m.file_path, encoding='utf-8') as f:
+            self.assertEqual(xml_before, f.read())
+        self.assertEqual({}, self.m.unsaved_pairs)
+        self.assertEqual(False, self.m.has_unsaved_changes)
+
+        m2 = XmlModel.from_xml_file(self.m.file_path)
+        self.assertEqual({'hello': {'world': 2}, 'world': {'.': 1}}, m2.data)
+        self.assertEqual(new_time, m2.to_time)
+        self.assertEqual(self.m, m2)
+
+        # the reloaded model continues the same journal:
+        storage = MarkovStorage(self.temp_dir.name)
+        storage.load_models()
+        m3 = storage.get_model(user1)
+        self._train_and_save(storage, m3)
+        self.assertEqual({'hello': {'world': 3}, 'world': {'.': 2}},
+                         XmlModel.from_xml_file(self.m.file_path).data)
+
+    def test_replay_after_preload(self):
+        self._train_and_save(self.storage, self.m)
+        storage = MarkovStorage(self.temp_dir.name)
+        storage.preload_models()
+        m2 = storage.get_model(user1)
+        self.assertEqual({'hello': {'world': 2}, 'world': {'.': 1}}, m2.data)
+        self.assertEqual(new_time, m2.to_time)
+
+    def test_compaction(self):
+        self.storage.journal_compact_ratio = 0.01
+        self._train_and_save(self.storage, self.m)
+        self.assertTrue(os.path.exists(self.journal_path))
+        # the journal is now too large, so the next save rewrites the model
+        self._train_and_save(self.storage, self.m)
+        self.assertFalse(os.path.exists(self.journal_path))
+        m2 = XmlModel.from_xml_file(self.m.file_path)
+        self.assertEqual({'hello': {'world': 3}, 'world': {'.': 2}}, m2.data)
+        self.assertEqual(new_time, m2.to_time)
+
+    def test_incomplete_save_is_ignored(self):
+        self._train_and_save(self.storage, self.m)
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write('+ hello darkness 5\n@ 2023-01-03')
+        m2 = XmlModel.from_xml_file(self.m.file_path)
+        self.assertEqual({'hello': {'world': 2}, 'world': {'.': 1}}, m2.data)
+        self.assertEqual(new_time, m2.to_time)
+
+    def test_journal_of_old_file_is_ignored(self):
+        self._train_and_save(self.storage, self.m)
+        # the model is rewritten, but the process stopped before removing the journal
+        with open(self.journal_path, encoding='utf-8') as f:
+            journal = f.read()
+        self.storage.save_model(self.m, compact=True)
+        with open(self.journal_path, 'w', encoding='utf-8') as f:
+            f.write(journal)
+        m2 = XmlModel.from_xml_file(self.m.file_path)
+        self.assertEqual({'hello': {'world': 2}, 'world': {'.': 1}}, m2.data)
+
+    def test_journal_of_old_bin_file_is_ignored(self):
+        format_before = config.get('markov_model_format', 'xml')
+        override_test_config('markov_model_format: bin')
+        try:
+            self.storage.save_model(self.m, compact=True)
+            self._train_and_save(self.storage, self.m)
+            self.assertTrue(os.path.exists(self.journal_path))
+            # the process stops after writing the '.bin' file, before the xml file and removing the journal
+            with patch.object(self.storage, '_write_model_file', side_effect=OSError('crash')):
+                with self.assertRaises(OSError):
+                    self.storage.save_model(self.m, compact=True)
+            self.assertTrue(os.path.exists(self.journal_path))
+            m2 = XmlModel.from_xml_file(self.m.file_path)
+            self.assertEqual({'hello': {'world': 2}, 'world': {'.': 1}}, m2.data)
+        finally:
+            override_test_config(f'markov_model_format: {format_before}')
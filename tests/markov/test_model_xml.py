@@ -2,6 +2,7 @@ import dataclasses
 import unittest
 from datetime import datetime, timezone
 
+from cheems.base_xml_data_model import iter_xml_data_lines
 from cheems.markov.model_xml import XmlModel
 from cheems.targets import User, Server, Channel, Topic
 
@@ -27,6 +28,10 @@ class TestMarkovXmlModel(unittest.TestCase):
         m = XmlModel.from_xml(xml_str)
         self.assertEqual(test_model, m)
 
+    def test_iter_xml_data_lines(self):
+        lines = list(iter_xml_data_lines('./tests/markov/test_model.xml'))
+        self.assertEqual(['hello ,my 1', 'my world 2', 'world . 1'], lines)
+
     def test_user_model_to_xml_file(self):
         model = test_model
         serialized = model.to_xml()
@@ -56,3 +61,38 @@ class TestMarkovXmlModel(unittest.TestCase):
         serialized = model.to_xml()
         model_restored = XmlModel.from_xml(serialized)
         self.assertEqual(model, model_restored)
+
+    def test_to_xml_format(self):
+        self.assertEqual('''<?xml version="1.0" encoding="utf-8"?>
+<model format_version="1" from_time="2022-04-01 00:00:00+00:00" to_time="2022-05-15 00:00:00+00:00" updated_time="2022-05-15 00:00:00+00:00">
+\t<target type="User">
+\t\t<id>9999</id>
+\t\t<discriminator>8888</discriminator>
+\t\t<name>Hunternif</name>
+\t\t<server>
+\t\t\t<id>12345</id>
+\t\t\t<name>Test server</name>
+\t\t</server>
+\t</target>
+\t<description>Hunternif's test data</description>
+\t<data><![CDATA[
+hello ,my 1
+my world 2
+world . 1
+]]></data>
+</model>
+''', test_model.to_xml())
+
+    def test_header_is_escaped(self):
+        model = dataclasses.replace(
+            test_model,
+            target=Server(1, 'Tom & Jerry <3'),
+            description='__data__ & <data>',
+        )
+        model_restored = XmlModel.from_xml(model.to_xml())
+        self.assertEqual(model, model_restored)
+
+    def test_write_xml_without_data(self):
+        model_restored = XmlModel.from_xml(test_model.to_xml(include_data=False))
+        self.assertEqual({}, model_restored.data)
+        self.assertEqual(test_model.target, model_restored.target)
@@ -1,11 +1,16 @@
 import os
+from datetime import timedelta
 from importlib import reload
+import asyncio
 from tempfile import TemporaryDirectory
-from unittest import TestCase
+from unittest import TestCase, IsolatedAsyncioTestCase, mock
 
 from cheems.markov import models_xml
 from cheems.markov.model_xml import XmlModel
-from cheems.targets import User, Server, Channel
+from cheems.markov.models_xml import MarkovStorage
+from cheems.targets import User, Server, Channel, Target
+from cheems import xml_data_model_storage
+from cheems.xml_data_model_storage import ModelCacheStats
 
 # test data
 from tests import override_test_config
@@ -112,3 +117,199 @@ class TestMarkovModelsXml(TestCase):
         self.assertEqual('hello world 1', m2.raw_data)
         self.assertEqual(True, m2.is_data_loaded)
         self.assertEqual({'hello': {'world': 1}}, m2.data)
+
+    def test_preload_reads_only_header(self):
+        m = models_xml.create_model(user1)
+        m.append_word_pair('hello', 'world')
+        models_xml.save_model(m)
+        # break everything after <data>, so that parsing the full file would fail
+        with open(m.file_path, encoding='utf-8') as f:
+            xml_str = f.read()
+        with open(m.file_path, 'w', encoding='utf-8') as f:
+            f.write(xml_str[:xml_str.index('<![CDATA[')] + '<<< not xml')
+
+        reload(models_xml)
+        models_xml.preload_models()
+        m2 = models_xml.markov_storage.models_by_server_id[server1.id][user1.key]
+        self.assertEqual(user1, m2.target)
+        self.assertEqual(m.description, m2.description)
+        self.assertEqual(m.to_time, m2.to_time)
+        self.assertEqual(False, m2.is_data_loaded)
+        os.remove(m.file_path)
+
+    def test_preload_trusts_manifest(self):
+        m = models_xml.create_model(user1)
+        models_xml.save_model(m)
+        models_xml.save_manifest()
+        # change the description only in the manifest, the file stays the same
+        storage = models_xml.markov_storage
+        entry = storage.manifest[os.path.relpath(m.file_path, storage.root_dir)]
+        entry.find('description').text = 'From manifest'
+        storage.save_manifest()
+
+        reload(models_xml)
+        models_xml.preload_models()
+        m2 = models_xml.markov_storage.models_by_server_id[server1.id][user1.key]
+        self.assertEqual('From manifest', m2.description)
+        self.assertEqual(m.to_time, m2.to_time)
+        self.assertEqual(m.file_path, m2.file_path)
+        # data is still loaded from the file
+        self.assertEqual(m.data, models_xml.get_model(user1).data)
+        os.remove(m.file_path)
+
+    def test_preload_rescans_changed_files(self):
+        m = models_xml.create_model(user1)
+        models_xml.save_model(m)
+        models_xml.save_manifest()
+        # the file is changed outside of storage:
+        m.description = 'Changed'
+        with open(m.file_path, 'w', encoding='utf-8') as f:
+            f.write(m.to_xml())
+        stat = os.stat(m.file_path)
+        os.utime(m.file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+
+        reload(models_xml)
+        models_xml.preload_models()
+        m2 = models_xml.markov_storage.models_by_server_id[server1.id][user1.key]
+        self.assertEqual('Changed', m2.description)
+
+        # deleted files are dropped from the manifest:
+        os.remove(m.file_path)
+        reload(models_xml)
+        models_xml.preload_models()
+        self.assertNotIn(
+            os.path.relpath(m.file_path, models_xml.markov_storage.root_dir),
+            models_xml.markov_storage.manifest,
+        )
+
+    def test_load_models_in_parallel(self):
+        models = [models_xml.create_model(target) for target in (server2, user1, user2)]
+        for i, m in enumerate(models):
+            m.append_word_pair('hello', f'world{i}', i % 2 + 1)
+            models_xml.save_model(m)
+
+        reload(models_xml)
+        models_xml.load_models(workers=2)
+        for m in models:
+            loaded_m = models_xml.get_model(m.target)
+            self.assertEqual(m, loaded_m)
+            self.assertEqual(True, loaded_m.is_data_loaded)
+
+    def test_evict_least_recently_used(self):
+        with TemporaryDirectory() as root_dir:
+            storage = _make_storage_with_budget(root_dir, [server2, user1, user2], max_pairs=4)
+            m1 = storage.get_model(server2)
+            m2 = storage.get_model(user1)
+            self.assertEqual(0, storage.cache_stats.evictions)
+            storage.get_model(server2)  # now user1 is the least recently used
+            m3 = storage.get_model(user2)
+            self.assertEqual(True, m1.is_data_loaded)
+            self.assertEqual(False, m2.is_data_loaded)
+            self.assertEqual(True, m3.is_data_loaded)
+            self.assertEqual({}, m2.data)
+            self.assertEqual(ModelCacheStats(
+                hits=1, misses=3, evictions=1, loaded_models=2, loaded_entries=4, loaded_bytes=4 * 80,
+            ), storage.cache_stats)
+            # data is loaded again:
+            self.assertEqual({'hello': {'world': 1}, 'world': {'.': 1}}, storage.get_model(user1).data)
+
+    def test_never_evict_unsaved_changes(self):
+        with TemporaryDirectory() as root_dir:
+            storage = _make_storage_with_budget(root_dir, [server2, user1, user2], max_pairs=4)
+            m1 = storage.get_model(server2)
+            m1.append_word_pair('hello', 'darkness')
+            m1.has_unsaved_changes = True
+            m2 = storage.get_model(user1)
+            m3 = storage.get_model(user2)
+            self.assertEqual(True, m1.is_data_loaded)
+            self.assertEqual(False, m2.is_data_loaded)
+            # after saving, the new size is counted:
+            storage.save_model(m1)
+            self.assertEqual(False, m3.is_data_loaded)
+            self.assertEqual(3, storage.cache_stats.loaded_entries)
+            # and the model can be evicted:
+            storage.get_model(user1)
+            self.assertEqual(False, m1.is_data_loaded)
+            self.assertEqual(3, storage.cache_stats.evictions)
+            self.assertEqual(3, storage.get_model(server2).data.pair_count)
+
+    def test_save_evicted_model(self):
+        with TemporaryDirectory() as root_dir:
+            storage = _make_storage_with_budget(root_dir, [server2, user1], max_pairs=2)
+            m1 = storage.get_model(server2)
+            storage.get_model(user1)
+            self.assertEqual(False, m1.is_data_loaded)
+            # only the time has changed, e.g. after messages that aren't trained on
+            new_time = m1.to_time + timedelta(days=1)
+            m1.to_time = new_time
+            storage.save_model(m1)
+            storage.save_model(m1, compact=True)
+
+            storage = MarkovStorage(root_dir)
+            storage.load_models()
+            m1 = storage.get_model(server2)
+            self.assertEqual(2, m1.data.pair_count)
+            self.assertEqual(new_time, m1.to_time)
+
+
+class TestGetModelAsync(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.temp_dir = TemporaryDirectory()
+        storage = MarkovStorage(self.temp_dir.name)
+        m = storage.create_model(user1)
+        for i in range(100000):
+            m.append_word_pair(f'w{i}', f'w{i + 1}')
+        storage.save_model(m)
+        self.storage = MarkovStorage(self.temp_dir.name)
+        self.storage.preload_models()
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    async def test_event_loop_keeps_running_while_loading(self):
+        ticks = 0
+        loaded = False
+
+        async def tick():
+            nonlocal ticks
+            while not loaded:
+                ticks += 1
+                await asyncio.sleep(0)
+
+        ticker = asyncio.create_task(tick())
+        m = await self.storage.get_model_async(user1)
+        loaded = True
+        await ticker
+        self.assertEqual(True, m.is_data_loaded)
+        self.assertEqual(100000, m.data.pair_count)
+        self.assertGreater(ticks, 1)
+
+    async def test_concurrent_loads_are_shared(self):
+        with mock.patch('cheems.xml_data_model_storage._read_model_file',
+                        wraps=xml_data_model_storage._read_model_file) as read_mock:
+            m1, m2 = await asyncio.gather(
+                self.storage.get_model_async(user1),
+                self.storage.get_model_async(user1),
+            )
+            m3 = await self.storage.get_model_async(user1)
+        read_mock.assert_called_once()
+        self.assertIs(m1, m2)
+        self.assertIs(m1, m3)
+        self.assertEqual(True, m1.is_data_loaded)
+        self.assertEqual(1, self.storage.cache_stats.misses)
+        self.assertEqual({}, self.storage._loading)
+        self.assertIsNone(await self.storage.get_model_async(user2))
+
+
+def _make_storage_with_budget(root_dir: str, targets: list[Target], max_pairs: int) -> MarkovStorage:
+    """Saves models with 2 pairs each, and preloads them into a storage with the given budget"""
+    storage = MarkovStorage(root_dir)
+    for target in targets:
+        m = storage.create_model(target)
+        m.append_word_pair('hello', 'world')
+        m.append_word_pair('world', '.')
+        storage.save_model(m)
+    storage = MarkovStorage(root_dir)
+    storage.max_loaded_entries = max_pairs
+    storage.preload_models()
+    return storage
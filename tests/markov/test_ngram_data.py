@@ -0,0 +1,171 @@
+import os
+import pickle
+import random
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from cheems.markov.markov import count_word_ngrams, markov_chain, train_ngram_groups
+from cheems.markov.model import Model
+from cheems.markov.models_xml import MarkovStorage
+from cheems.markov.model_journal import get_journal_path
+from cheems.markov.model_xml import XmlModel
+from cheems.markov.ngram_data import NGramData, get_ngrams_path, get_ngram_order
+from cheems.targets import Server, User
+from tests import override_test_config
+
+server1 = Server(100, 'London')
+user1 = User(123, 'Kagamin', 1111, server1)
+
+
+class TestNGramData(TestCase):
+    def test_append_and_back_off(self):
+        ngrams = NGramData(3)
+        ngrams.append(('hello', 'my', 'world'))
+        ngrams.append(('oh', 'hello', 'my', 'baby'))
+        self.assertEqual(2, len(ngrams))
+        self.assertEqual('world', ngrams.get_random_next_word(['hello', 'my']))
+        self.assertEqual('baby', ngrams.get_random_next_word(['oh', 'hello', 'my']))
+        # 'bye hello my' isn't known, so it backs off to 'hello my'
+        self.assertEqual('world', ngrams.get_random_next_word(['bye', 'hello', 'my']))
+        # single words are left to word pairs
+        self.assertIsNone(ngrams.get_random_next_word(['my']))
+        self.assertIsNone(ngrams.get_random_next_word(['unknown', 'my']))
+
+    def test_compact_keeps_counts(self):
+        ngrams = NGramData(3)
+        ngrams.append_ngrams({('a', 'b', 'c'): 2, ('a', 'b', 'd'): 1, ('x', 'a', 'b', 'c'): 1})
+        before = dict(ngrams.items())
+        ngrams.compact()
+        self.assertEqual(before, dict(ngrams.items()))
+        # fresh training on top of the arrays:
+        ngrams.append(('a', 'b', 'c'), 3)
+        self.assertEqual(5, dict(ngrams.items())[('a', 'b', 'c')])
+        ngrams.compact()
+        self.assertEqual(5, dict(ngrams.items())[('a', 'b', 'c')])
+        self.assertEqual(3, len(ngrams))
+
+    def test_weighted_pick(self):
+        random.seed(1)
+        ngrams = NGramData(2)
+        ngrams.append_ngrams({('a', 'b', 'rare'): 1, ('a', 'b', 'common'): 99})
+        ngrams.compact()
+        picks = [ngrams.get_random_next_word(['a', 'b']) for _ in range(100)]
+        self.assertGreater(picks.count('common'), 80)
+
+    def test_parse_and_serialize(self):
+        text = '''
+. hello my 1
+hello my world 2
+oh hello my baby 1
+        '''
+        ngrams = NGramData.parse(text, 3, max_weight=1)
+        self.assertEqual(['. hello my 1', 'hello my world 1', 'oh hello my baby 1'],
+                         list(ngrams.iter_serialized_lines()))
+        # longer contexts are skipped for a lower order:
+        self.assertEqual(['. hello my 1', 'hello my world 2'],
+                         list(NGramData.parse(text, 2, max_weight=10).iter_serialized_lines()))
+        # only the order limits what is appended, too:
+        ngrams = NGramData(2)
+        ngrams.append(('oh', 'hello', 'my', 'baby'))
+        self.assertEqual(0, len(ngrams))
+
+    def test_pickle(self):
+        ngrams = NGramData(3)
+        ngrams.append_ngrams({('a', 'b', 'c'): 2, ('x', 'a', 'b', 'c'): 1})
+        self.assertEqual(ngrams, pickle.loads(pickle.dumps(ngrams)))
+
+    def test_count_word_ngrams(self):
+        counts = count_word_ngrams(['Hello, my World. Bye'], 3)
+        self.assertEqual({
+            ('.', 'hello', ',my'): 1,
+            ('.', 'hello', 'my', 'world'): 1,
+            ('hello', 'my', 'world'): 1,
+            ('my', 'world', '.'): 1,
+            ('hello', 'my', 'world', '.'): 1,
+            ('.', 'bye', '.'): 1,
+        }, counts)
+
+    def test_chain_follows_longer_context(self):
+        # after 'my', word pairs alone could go to either world
+        data = Model.parse_data('''
+hello my 1
+bye my 1
+my world 1
+my dude 1
+world . 1
+dude . 1
+        ''')
+        ngrams = NGramData(2)
+        train_ngram_groups([([ngrams], ['hello my world', 'bye my dude'])])
+        for _ in range(20):
+            self.assertEqual('hello my world', markov_chain(data, 'hello', ngrams=ngrams))
+            self.assertEqual('bye my dude', markov_chain(data, 'bye', ngrams=ngrams))
+
+
+class TestNGramStorage(TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = TemporaryDirectory()
+        override_test_config('''
+markov_ngram_order:
+  user: 3
+        ''')
+
+    def tearDown(self) -> None:
+        override_test_config('markov_ngram_order: null')
+        self.temp_dir.cleanup()
+
+    def test_order_per_target_kind(self):
+        self.assertEqual(3, get_ngram_order(user1))
+        self.assertEqual(1, get_ngram_order(server1))
+        storage = MarkovStorage(self.temp_dir.name)
+        self.assertIsNone(storage.create_model(server1).ngrams)
+        self.assertEqual(3, storage.create_model(user1).ngrams.order)
+
+    def _train(self, storage: MarkovStorage, m: XmlModel, sentence: str):
+        train_ngram_groups([([m.ngrams, m.unsaved_ngrams], [sentence])])
+        storage.save_model(m)
+
+    def test_save_and_replay_journal(self):
+        storage = MarkovStorage(self.temp_dir.name)
+        m = storage.create_model(user1)
+        m.append_word_pair('hello', 'world')
+        self._train(storage, m, 'hello my world')
+        ngrams_path = get_ngrams_path(m.file_path)
+        self.assertTrue(os.path.exists(ngrams_path))
+        self.assertEqual(0, len(m.unsaved_ngrams))
+
+        # the next save goes into the journal
+        self._train(storage, m, 'hello my dude')
+        self.assertTrue(os.path.exists(get_journal_path(m.file_path)))
+        m2 = XmlModel.from_xml_file(m.file_path)
+        self.assertEqual(m.ngrams, m2.ngrams)
+        self.assertEqual(1, dict(m2.ngrams.items())[('hello', 'my', 'dude')])
+
+        # compaction writes the journal into the '.ngrams' file
+        storage.save_model(m2, compact=True)
+        self.assertFalse(os.path.exists(get_journal_path(m.file_path)))
+        self.assertEqual(m.ngrams, XmlModel.from_xml_file(m.file_path).ngrams)
+
+    def test_merge_model_files(self):
+        storage = MarkovStorage(os.path.join(self.temp_dir.name, 'models'))
+        m = storage.create_model(user1)
+        self._train(storage, m, 'hello my world')
+        # the next save goes into the journal
+        self._train(storage, m, 'hello my dude')
+        merged_storage = MarkovStorage(os.path.join(self.temp_dir.name, 'merged'))
+        for _ in range(2):
+            merged = merged_storage.merge_model_files([m.file_path])
+        merged.load_data()
+        self.assertEqual(2, dict(merged.ngrams.items())[('hello', 'my', 'world')])
+        self.assertEqual(2, dict(merged.ngrams.items())[('hello', 'my', 'dude')])
+
+    def test_unload(self):
+        storage = MarkovStorage(self.temp_dir.name)
+        m = storage.create_model(user1)
+        self._train(storage, m, 'hello my world')
+        size_with_ngrams = m.get_data_size()[1]
+        m.unload_data()
+        self.assertIsNone(m.ngrams)
+        m.load_data()
+        self.assertEqual(size_with_ngrams, m.get_data_size()[1])
+        self.assertEqual('world', m.ngrams.get_random_next_word(['hello', 'my']))
@@ -0,0 +1,99 @@
+import asyncio
+from datetime import datetime, timezone
+from tempfile import TemporaryDirectory
+from unittest import IsolatedAsyncioTestCase
+
+from cheems.markov.model import Model
+from cheems.markov.models_xml import MarkovStorage
+from cheems.markov.response_pool import ResponsePool
+from cheems.targets import Server, User
+
+server1 = Server(100, 'London')
+user1 = User(123, 'Kagamin', 1111, server1)
+user2 = User(456, 'Tsukasa', 2222, server1)
+
+
+class TestResponsePool(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.temp_dir = TemporaryDirectory()
+        self.storage = MarkovStorage(self.temp_dir.name)
+        self.model = self.storage.create_model(user1)
+        self.model.data = Model.parse_data('''
+. hello 1
+hello world 1
+world . 1
+        ''')
+        self.generated = 0
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def _generate(self, model: Model) -> str:
+        self.generated += 1
+        return f'{model.target.name} {self.generated}'
+
+    async def _wait_for_refills(self, pool: ResponsePool):
+        # noinspection PyProtectedMember
+        tasks = [p.refill_task for p in pool._pools.values() if p.refill_task is not None]
+        await asyncio.gather(*tasks)
+
+    async def test_pop_and_refill(self):
+        pool = ResponsePool(size=3, max_targets=10, generate=self._generate)
+        self.assertIsNone(pool.pop(self.model))
+        await self._wait_for_refills(pool)
+        self.assertEqual(3, self.generated)
+        self.assertEqual('Kagamin 1', pool.pop(self.model))
+        self.assertEqual('Kagamin 2', pool.pop(self.model))
+        await self._wait_for_refills(pool)
+        self.assertEqual(5, self.generated)
+        self.assertEqual(2, pool.stats.hits)
+        self.assertEqual(1, pool.stats.misses)
+        self.assertAlmostEqual(2 / 3, pool.stats.hit_rate)
+        self.assertEqual(2, pool.stats.refills)
+
+    async def test_refill_yields_to_event_loop(self):
+        pool = ResponsePool(size=50, max_targets=10, generate=self._generate)
+        pool.pop(self.model)
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        self.assertLess(self.generated, 50)
+        await self._wait_for_refills(pool)
+        self.assertEqual(50, self.generated)
+
+    async def test_invalidate_on_training(self):
+        pool = ResponsePool(size=2, max_targets=10, generate=self._generate)
+        pool.pop(self.model)
+        await self._wait_for_refills(pool)
+        self.model.append_word_pair('hello', 'there')
+        self.model.updated_time = datetime.now(tz=timezone.utc)
+        self.assertIsNone(pool.pop(self.model))
+        await self._wait_for_refills(pool)
+        self.assertEqual('Kagamin 3', pool.pop(self.model))
+        self.assertEqual(1, pool.stats.invalidations)
+
+    async def test_invalidate_on_reload(self):
+        pool = ResponsePool(size=2, max_targets=10, generate=self._generate)
+        pool.pop(self.model)
+        await self._wait_for_refills(pool)
+        self.model.data = Model.parse_data('hello world 1')
+        self.assertIsNone(pool.pop(self.model))
+        self.assertEqual(1, pool.stats.invalidations)
+
+    async def test_only_recent_targets(self):
+        pool = ResponsePool(size=1, max_targets=1, generate=self._generate)
+        other = self.storage.create_model(user2)
+        pool.pop(self.model)
+        pool.pop(other)
+        await self._wait_for_refills(pool)
+        self.assertIsNone(pool.pop(self.model))
+
+    async def test_disabled(self):
+        pool = ResponsePool(size=0, max_targets=10, generate=self._generate)
+        self.assertIsNone(pool.pop(self.model))
+        self.assertEqual(0, self.generated)
+
+    async def test_generate_from_model(self):
+        pool = ResponsePool(size=2, max_targets=10)
+        pool.pop(self.model)
+        await self._wait_for_refills(pool)
+        self.assertEqual('hello world', pool.pop(self.model))
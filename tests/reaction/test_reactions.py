@@ -1,8 +1,10 @@
 import random
 from datetime import datetime, timezone
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 
 from cheems.reaction import reactions
+from cheems.reaction.reactions import ReactionStorage
 from cheems.reaction.reaction_model import ReactionModel
 
 from cheems.targets import Server, User
@@ -33,12 +35,31 @@ class TestReactions(TestCase):
             '<:cheems:1140041467432271952>': 3,
         }, data)
 
+    def test_parse_data_max_weight(self):
+        data = ReactionModel.parse_data('''
+        👍 1
+        🤔 9999
+        ''')
+        self.assertEqual({'👍': 1, '🤔': 50}, data)
+
     def test_from_xml(self):
         with open('./tests/reaction/test_react_model.xml') as f:
             xml_str = f.read()
         m = ReactionModel.from_xml(xml_str)
         self.assertEqual(Server(), m)
 
+    def test_save_model_on_writer(self):
+        with TemporaryDirectory() as temp_dir:
+            storage = ReactionStorage(temp_dir)
+            storage.start_writer()
+            model = storage.create_model(test_server)
+            model.data = {'👍': 1, '🤔': 2}
+            storage.save_model(model)
+            # the writer saves the model as it was when submitted
+            model.data['👍'] = 3
+            storage.stop_writer()
+            self.assertEqual({'👍': 1, '🤔': 2}, ReactionModel.from_xml_file(model.file_path).data)
+
     def test_weighted_random_reaction(self):
         model = reactions.create_model(test_server)
         model.data = {'one': 1, 'two': 10, }
@@ -0,0 +1,104 @@
+import os
+from datetime import datetime, timezone
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from cheems.base_xml_data_model import BaseXmlDataModel
+from cheems.config import config
+from cheems.markov.model_bin import write_model_bin
+from cheems.markov.models_xml import MarkovStorage
+from cheems.model_writer import write_file_atomically
+from cheems.reaction.reactions import ReactionStorage
+from cheems.targets import Server, User
+from tests import override_test_config
+
+server1 = Server(100, 'London')
+user1 = User(123, 'Kagamin', 1111, server1)
+renamed_user1 = User(123, 'Kagami', 1111, server1)
+day1 = datetime(2022, 5, 1, tzinfo=timezone.utc)
+day2 = datetime(2022, 5, 2, tzinfo=timezone.utc)
+day3 = datetime(2022, 5, 3, tzinfo=timezone.utc)
+
+
+class TestMergeModels(TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = TemporaryDirectory()
+        self.root_dir = os.path.join(self.temp_dir.name, 'models')
+        self.max_weight_before = config.get('markov_model_max_weight', 9999)
+        override_test_config('markov_model_max_weight: 5')
+
+    def tearDown(self) -> None:
+        override_test_config(f'markov_model_max_weight: {self.max_weight_before}')
+        self.temp_dir.cleanup()
+
+    def _save_markov_model(self, storage: MarkovStorage, target: User, from_time: datetime, to_time: datetime,
+                           pairs: list[tuple[str, str, int]]):
+        m = storage.create_model(target)
+        m.from_time = from_time
+        m.to_time = to_time
+        for first_word, next_word, count in pairs:
+            m.append_word_pair(first_word, next_word, count)
+        storage.save_model(m)
+        return m
+
+    def test_merge_markov_models(self):
+        storage = MarkovStorage(self.root_dir)
+        existing = self._save_markov_model(storage, user1, day2, day2, [('hello', 'world', 1)])
+        # training saved into the journal
+        existing.append_word_pair('world', '.')
+        storage.save_model(existing)
+
+        # a duplicate of the same user, in the binary format
+        other_storage = MarkovStorage(os.path.join(self.temp_dir.name, 'other'))
+        duplicate = self._save_markov_model(other_storage, renamed_user1, day1, day1,
+                                            [('hello', 'world', 3), ('.', 'hello', 1)])
+        write_model_bin(duplicate.data, duplicate.bin_file_path)
+        write_file_atomically(duplicate.file_path, lambda f: duplicate.write_xml(f, include_data=False))
+
+        # a model saved into 'lost'
+        lost = storage.ensure_type(BaseXmlDataModel(day3, day3, day3, user1, 'lost'))
+        lost.append_word_pair('hello', 'world', 2)
+        lost.append_word_pair('hello', 'baby')
+        storage.save_model(lost)
+        self.assertIn('lost', lost.file_path)
+
+        storage = MarkovStorage(self.root_dir)
+        storage.load_models(load_data=False)
+        with mock.patch.object(BaseXmlDataModel, 'from_xml', side_effect=AssertionError('fully loaded')):
+            merged = storage.merge_model_files([duplicate.file_path, lost.file_path])
+        self.assertEqual(existing.file_path, merged.file_path)
+        self.assertFalse(merged.is_data_loaded)
+
+        storage = MarkovStorage(self.root_dir)
+        storage.load_models()
+        merged = storage.get_model(user1)
+        self.assertEqual({
+            '.': {'hello': 1},
+            'hello': {'world': 5, 'baby': 1},  # 6 is limited by the max weight
+            'world': {'.': 1},
+        }, merged.data)
+        self.assertEqual((day1, day3), (merged.from_time, merged.to_time))
+        self.assertFalse(os.path.exists(merged.bin_file_path))
+        # the sources are left as they are
+        self.assertTrue(os.path.exists(duplicate.bin_file_path))
+        self.assertTrue(os.path.exists(lost.file_path))
+
+    def test_merge_into_new_model(self):
+        other_storage = MarkovStorage(os.path.join(self.temp_dir.name, 'other'))
+        source = self._save_markov_model(other_storage, user1, day1, day2, [('hello', 'world', 1)])
+        storage = MarkovStorage(self.root_dir)
+        merged = storage.merge_model_files([source.file_path])
+        self.assertEqual({'hello': {'world': 1}}, storage.get_model(user1).data)
+        self.assertEqual((day1, day2), (merged.from_time, merged.to_time))
+
+    def test_merge_reaction_models(self):
+        storage = ReactionStorage(self.root_dir)
+        paths = []
+        for i, data in enumerate([{'🤔': 40, '👍': 1}, {'🤔': 30, '😂': 2}]):
+            m = storage.create_model(User(i, f'user{i}', 1111, server1))
+            m.to_time = day1
+            m.data = data
+            storage.save_model(m)
+            paths.append(m.file_path)
+        storage.merge_model_files(paths, target=user1)
+        self.assertEqual({'🤔': 50, '👍': 1, '😂': 2}, storage.get_model(user1).data)
@@ -0,0 +1,101 @@
+import asyncio
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase, IsolatedAsyncioTestCase
+
+from cheems.markov.model import Model
+from cheems.markov.models_xml import MarkovStorage
+from cheems.metrics import Histogram, Metrics, MetricsExporter
+from cheems.targets import Server, User
+
+server1 = Server(100, 'London')
+user1 = User(123, 'Kagamin', 1111, server1)
+
+
+class TestMetrics(TestCase):
+    def test_histogram_quantile(self):
+        histogram = Histogram((0.01, 0.1, 1.0))
+        for value in [0.005] * 98 + [0.05, 5.0]:
+            histogram.observe(value)
+        self.assertEqual(0.01, histogram.get_quantile(0.5))
+        self.assertEqual(0.1, histogram.get_quantile(0.99))
+        self.assertEqual(float('inf'), histogram.get_quantile(1.0))
+        self.assertEqual(0.0, Histogram().get_quantile(0.5))
+
+    def test_prometheus_text(self):
+        registry = Metrics(enabled=True, buckets=(0.1, 1.0))
+        registry.observe('command_seconds', 0.05, command='che', stage='total')
+        registry.increment('markov_retries_total', 2)
+        registry.add_collector(lambda: [('loaded_models', {'storage': 'markov'}, 3)])
+        text = registry.to_prometheus_text()
+        self.assertIn('# TYPE cheems_command_seconds histogram', text)
+        self.assertIn('cheems_command_seconds_bucket{command="che",stage="total",le="0.1"} 1', text)
+        self.assertIn('cheems_command_seconds_bucket{command="che",stage="total",le="+Inf"} 1', text)
+        self.assertIn('cheems_command_seconds_count{command="che",stage="total"} 1', text)
+        self.assertIn('# TYPE cheems_markov_retries_total counter\ncheems_markov_retries_total 2', text)
+        self.assertIn('# TYPE cheems_loaded_models gauge\ncheems_loaded_models{storage="markov"} 3', text)
+
+    def test_disabled(self):
+        registry = Metrics(enabled=False)
+        with registry.timer('command_seconds', command='che'):
+            pass
+        registry.observe('model_load_seconds', 1.0)
+        registry.increment('markov_retries_total')
+        self.assertEqual({}, registry.histograms)
+        self.assertEqual({}, registry.counters)
+
+    def test_timer(self):
+        registry = Metrics(enabled=True)
+        with registry.timer('command_seconds', command='che'):
+            pass
+        self.assertEqual(1, registry.get_histogram('command_seconds', command='che').count)
+
+    def test_storage_gauges(self):
+        with TemporaryDirectory() as temp_dir:
+            storage = MarkovStorage(temp_dir)
+            m = storage.create_model(user1)
+            m.data = Model.parse_data('hello world 1')
+            storage.save_model(m)
+            storage.flush()
+            storage = MarkovStorage(temp_dir)
+            storage.load_models()
+            storage.get_model(user1)
+            gauges = {(name, labels.get('target', None)): value for name, labels, value in storage.collect_metrics()}
+            self.assertEqual(1, gauges[('loaded_models', None)])
+            self.assertEqual(1, gauges[('model_cache_hits', None)] + gauges[('model_cache_misses', None)])
+            self.assertGreater(gauges[('loaded_model_bytes', user1)], 0)
+
+
+class TestMetricsExporter(IsolatedAsyncioTestCase):
+    async def test_http(self):
+        registry = Metrics(enabled=True)
+        registry.increment('markov_retries_total')
+        exporter = MetricsExporter(registry)
+        # on a free port
+        # noinspection PyProtectedMember
+        exporter.http_server = await asyncio.start_server(exporter._handle_http, '127.0.0.1', 0)
+        port = exporter.http_server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            response = (await reader.read()).decode()
+            writer.close()
+            self.assertTrue(response.startswith('HTTP/1.1 200 OK'))
+            self.assertIn('cheems_markov_retries_total 1', response)
+        finally:
+            await exporter.stop()
+
+    async def test_dump_file(self):
+        registry = Metrics(enabled=True)
+        registry.increment('markov_retries_total')
+        with TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'metrics.prom')
+            exporter = MetricsExporter(registry, dump_file=path, dump_period_seconds=0.01)
+            await exporter.start()
+            for _ in range(100):
+                await asyncio.sleep(0.01)
+                if os.path.exists(path):
+                    break
+            await exporter.stop()
+            with open(path, encoding='utf-8') as f:
+                self.assertIn('cheems_markov_retries_total 1', f.read())
@@ -0,0 +1,120 @@
+import multiprocessing
+import os
+import threading
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from cheems.markov.model_xml import XmlModel
+from cheems.markov.models_xml import MarkovStorage
+from cheems.model_writer import ModelWriter, FunctionJob, WriteJob
+from cheems.targets import Server, User
+
+server1 = Server(100, 'London')
+user1 = User(123, 'Kagamin', 1111, server1)
+
+
+class _AppendJob(WriteJob):
+    def __init__(self, log: list, value: str):
+        self.log = log
+        self.values = [value]
+
+    def run(self):
+        self.log.append(self.values)
+
+    def coalesce(self, newer: WriteJob) -> WriteJob:
+        self.values.extend(newer.values)
+        return self
+
+
+def _save_and_crash(root_dir: str):
+    """Saves a changed model, but the process dies before the new file is complete"""
+    storage = MarkovStorage(root_dir)
+    storage.load_models()
+    m = storage.get_model(user1)
+    m.append_word_pair('hello', 'darkness')
+    with mock.patch('os.fsync', side_effect=lambda fd: os._exit(1)):
+        storage.save_model(m, compact=True)
+
+
+class TestModelWriter(TestCase):
+    def test_coalesce_pending_jobs(self):
+        writer = ModelWriter()
+        log = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        writer.submit('other', FunctionJob(block))
+        started.wait()
+        writer.submit('a', _AppendJob(log, '1'))
+        writer.submit('a', _AppendJob(log, '2'))
+        writer.submit('b', _AppendJob(log, '3'))
+        self.assertTrue(writer.is_pending('a'))
+        release.set()
+        writer.flush()
+        self.assertEqual([['1', '2'], ['3']], log)
+        self.assertFalse(writer.is_pending('a'))
+        writer.close()
+
+    def test_submit_doesnt_block_when_behind(self):
+        writer = ModelWriter(max_queue=2)
+        log = []
+        release = threading.Event()
+        writer.submit('other', FunctionJob(release.wait))
+        with self.assertLogs('cheems.model_writer', 'WARNING'):
+            for key in 'abcd':
+                writer.submit(key, _AppendJob(log, key))
+        release.set()
+        writer.close()
+        self.assertEqual([['a'], ['b'], ['c'], ['d']], log)
+
+    def test_failed_job_doesnt_stop_writer(self):
+        writer = ModelWriter()
+        log = []
+        with self.assertLogs('cheems.model_writer', 'ERROR'):
+            writer.submit('a', FunctionJob(lambda: 1 / 0))
+            writer.submit('b', _AppendJob(log, '1'))
+            writer.flush()
+        self.assertEqual([['1']], log)
+        writer.close()
+
+
+class TestStorageWriter(TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = TemporaryDirectory()
+        self.storage = MarkovStorage(self.temp_dir.name)
+        self.m = self.storage.create_model(user1)
+        self.m.append_word_pair('hello', 'world')
+        self.storage.save_model(self.m)
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_save_snapshot_on_writer(self):
+        self.storage.start_writer()
+        self.m.append_word_pair('hello', 'there')
+        self.storage.save_model(self.m, compact=True)
+        # training continues while the model is being written
+        self.m.append_word_pair('hello', 'again')
+        self.storage.save_model(self.m)
+        self.m.append_word_pair('hello', 'again')
+        self.storage.save_model(self.m)
+        self.assertEqual(False, self.m.has_unsaved_changes)
+        self.storage.stop_writer()
+        m2 = XmlModel.from_xml_file(self.m.file_path)
+        self.assertEqual({'hello': {'world': 1, 'there': 1, 'again': 2}}, m2.data)
+
+    def test_crash_while_saving_keeps_old_file(self):
+        process = multiprocessing.get_context('fork').Process(target=_save_and_crash, args=(self.temp_dir.name,))
+        process.start()
+        process.join()
+        self.assertEqual(1, process.exitcode)
+        self.assertTrue(os.path.exists(f'{self.m.file_path}.tmp'))
+
+        storage = MarkovStorage(self.temp_dir.name)
+        storage.load_models()
+        self.assertEqual(1, len(storage.models))
+        self.assertEqual({'hello': {'world': 1}}, storage.get_model(user1).data)
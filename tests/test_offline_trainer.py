@@ -0,0 +1,193 @@
+import json
+import os
+from datetime import datetime, timezone
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from cheems.markov.model import Model
+from cheems.markov.models_xml import MarkovStorage
+from cheems import offline_trainer
+from cheems.offline_trainer import train_from_exports, find_chunks, parse_message
+from cheems.targets import Server, Channel, User
+from tests import override_test_config
+
+my_server = Server(789, 'My server')
+lucky_channel = Channel(200, 'lucky_channel', my_server)
+special_channel = Channel(201, 'deer-gacha', my_server)
+blocked_channel = Channel(202, 'bot_testing', my_server)
+kagamin = User(123, 'Kagamin', 1111, my_server)
+my_bot = User(125, 'my_bot', 1113, my_server)
+other_server = Server(791, 'Unknown server')
+other_channel = Channel(203, 'general', other_server)
+
+
+def _record(channel: Channel, user: User, text: str, day: int, msg_id: int = 1) -> dict:
+    return {
+        'id': msg_id,
+        'server': {'id': channel.server.id, 'name': channel.server.name},
+        'channel': {'id': channel.id, 'name': channel.name},
+        'user': {'id': user.id, 'name': user.name, 'discriminator': user.discriminator},
+        'created_at': datetime(2022, 5, day, 12, tzinfo=timezone.utc).isoformat(),
+        'text': text,
+    }
+
+
+class TestOfflineTrainer(TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        override_test_config('''
+training:
+  servers:
+    My server:
+      channels:
+        blocklist:
+          - bot_testing
+        special:
+          - deer-gacha
+      users:
+        special:
+          - my_bot
+      bad_msg:
+        - 666
+        ''')
+
+    def setUp(self) -> None:
+        self.temp_dir = TemporaryDirectory()
+        self.export_path = os.path.join(self.temp_dir.name, 'export.jsonl')
+        records = [
+            _record(lucky_channel, kagamin, 'hello world', 2),
+            _record(lucky_channel, kagamin, 'hello baby', 3),
+            _record(lucky_channel, kagamin, 'bad message', 4, msg_id=666),
+            _record(lucky_channel, my_bot, 'beep boop', 1),
+            _record(special_channel, kagamin, 'gacha roll', 5),
+            _record(blocked_channel, kagamin, 'testing', 6),
+            _record(other_channel, kagamin, 'elsewhere', 7),
+        ]
+        with open(self.export_path, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def _train(self, model_dir: str, workers: int, chunk_size: int, max_pairs: int = 0) -> MarkovStorage:
+        storage = MarkovStorage(os.path.join(self.temp_dir.name, model_dir))
+        storage.load_models(load_data=False)
+        train_from_exports([self.export_path], storage, workers, chunk_size, max_pairs)
+        # existing models are merged from their files, and nothing stays loaded
+        self.assertEqual([], [m.target for m in storage.models if m.is_data_loaded])
+        # read the saved models back
+        storage = MarkovStorage(os.path.join(self.temp_dir.name, model_dir))
+        storage.load_models()
+        return storage
+
+    def test_training_rules(self):
+        storage = self._train('models', 1, 1024)
+
+        def serialized(target) -> str:
+            # noinspection PyProtectedMember
+            return Model._serialize_data(storage.get_model(target).data)
+
+        self.assertEqual('''
+. hello 2
+baby . 1
+hello baby 1
+hello world 1
+world . 1
+'''.strip(), serialized(lucky_channel))
+        self.assertEqual(serialized(lucky_channel), serialized(my_server))
+        self.assertEqual(serialized(lucky_channel), serialized(kagamin))
+        self.assertEqual('''
+. gacha 1
+gacha roll 1
+roll . 1
+'''.strip(), serialized(special_channel))
+        self.assertEqual('''
+. beep 1
+beep boop 1
+boop . 1
+'''.strip(), serialized(my_bot))
+        self.assertIsNone(storage.get_model(blocked_channel))
+        self.assertIsNone(storage.get_model(other_channel))
+        self.assertIsNone(storage.get_model(other_server))
+
+        # the channel has seen the bad message and the special user, but wasn't trained on them
+        channel_model = storage.get_model(lucky_channel)
+        self.assertEqual(datetime(2022, 5, 2, 12, tzinfo=timezone.utc), channel_model.from_time)
+        self.assertEqual(datetime(2022, 5, 4, 12, tzinfo=timezone.utc), channel_model.to_time)
+        user_model = storage.get_model(kagamin)
+        self.assertEqual(datetime(2022, 5, 2, 12, tzinfo=timezone.utc), user_model.from_time)
+        self.assertEqual(datetime(2022, 5, 3, 12, tzinfo=timezone.utc), user_model.to_time)
+
+    def test_parallel_training(self):
+        self.assertGreater(len(find_chunks(self.export_path, 100)), 3)
+        sequential = self._train('sequential', 1, 1024)
+        parallel = self._train('parallel', 2, 100)
+        self.assertEqual(len(sequential.models), len(parallel.models))
+        for model in sequential.models:
+            other = parallel.get_model(model.target)
+            self.assertEqual(model.data, other.data)
+            self.assertEqual((model.from_time, model.to_time), (other.from_time, other.to_time))
+
+    def test_continue_training(self):
+        self._train('models', 1, 1024)
+        storage = self._train('models', 1, 1024)
+        self.assertEqual(4, storage.get_model(lucky_channel).data['.']['hello'])
+
+    def test_spill_to_disk(self):
+        self._train('in_memory', 1, 1024)
+        in_memory = self._train('in_memory', 1, 1024)
+        pending_counts = []
+        # noinspection PyProtectedMember
+        spill = offline_trainer._SpillingReducer.spill
+
+        def spy(reducer):
+            pending_counts.append(sum(p.data.pair_count for p in reducer.pending.values()))
+            spill(reducer)
+
+        with patch.object(offline_trainer._SpillingReducer, 'spill', spy):
+            # continues the models from the first run
+            self._train('spilled', 1, 1024)
+            spilled = self._train('spilled', 1, 100, max_pairs=3)
+        self.assertGreater(len(pending_counts), 2)
+        # one chunk of a message trains at most 3 models on 4 pairs
+        self.assertLessEqual(max(pending_counts), 3 + 3 * 4)
+        self.assertEqual(len(in_memory.models), len(spilled.models))
+        for model in in_memory.models:
+            other = spilled.get_model(model.target)
+            self.assertEqual(model.data, other.data)
+            self.assertEqual((model.from_time, model.to_time), (other.from_time, other.to_time))
+
+    def test_ngrams(self):
+        override_test_config('''
+markov_ngram_order:
+  user: 3
+        ''')
+        self.addCleanup(override_test_config, 'markov_ngram_order: null')
+        in_memory = self._train('in_memory', 1, 1024)
+        spilled = self._train('spilled', 2, 100, max_pairs=3)
+        ngrams = in_memory.get_model(kagamin).ngrams
+        self.assertEqual(1, dict(ngrams.items())[('.', 'hello', 'world', '.')])
+        self.assertEqual(ngrams, spilled.get_model(kagamin).ngrams)
+        self.assertIsNone(in_memory.get_model(lucky_channel).ngrams)
+
+        # the '.ngrams' file is continued like the model
+        continued = self._train('in_memory', 1, 1024)
+        self.assertEqual(2, dict(continued.get_model(kagamin).ngrams.items())[('.', 'hello', 'world', '.')])
+
+    def test_chunks_end_at_lines(self):
+        with open(self.export_path, 'rb') as f:
+            content = f.read()
+        chunks = find_chunks(self.export_path, 10)
+        self.assertEqual(content, b''.join(content[start:end] for _, start, end in chunks))
+        for _, _, end in chunks:
+            self.assertEqual(b'\n'[0], content[end - 1])
+
+    def test_naive_time_is_utc(self):
+        record = _record(lucky_channel, kagamin, 'hello', 2)
+        record['created_at'] = '2022-05-02T12:00:00'
+        msg_id, msg = parse_message(record)
+        self.assertEqual(1, msg_id)
+        self.assertEqual(datetime(2022, 5, 2, 12, tzinfo=timezone.utc), msg.created_at)
+        self.assertEqual(kagamin, msg.user)
@@ -1,5 +1,6 @@
 import dataclasses
 import os
+import sqlite3
 from datetime import datetime, timedelta, timezone
 from importlib import reload
 from tempfile import TemporaryDirectory
@@ -19,6 +20,26 @@ pic1 = Picture(
     sfw=True
 )
 
+_old_create_tables = '''
+CREATE TABLE IF NOT EXISTS pics (
+    id INT PRIMARY KEY,
+    url TEXT,
+    msg TEXT,
+    time DATETIME,
+    uploader_id INT,
+    channel_id INT,
+    server_id INT,
+    sfw BOOLEAN
+);
+'''
+
+_old_create_fts = '''
+CREATE VIRTUAL TABLE pics_fts USING fts5(msg, content='pics', content_rowid='rowid', tokenize='trigram');
+CREATE TRIGGER pics_fts_insert AFTER INSERT ON pics BEGIN
+    INSERT INTO pics_fts(rowid, msg) VALUES (new.rowid, new.msg);
+END;
+'''
+
 
 class TestPicsDb(TestCase):
     temp_dir: TemporaryDirectory
@@ -69,3 +90,47 @@ class TestPicsDb(TestCase):
         self.assertEqual([pic1], pictures.get_pics_where(word='THIS'))
         self.assertEqual([pic1, pic2], pictures.get_pics_where(sfw=True))
         self.assertEqual([pic3], pictures.get_pics_where(sfw=False))
+
+    def test_query_short_words(self):
+        pic2 = dataclasses.replace(pic1, id=123, msg='ok go')
+        pictures.save_pic(pic1)
+        pictures.save_pic(pic2)
+        # shorter than a trigram
+        self.assertEqual([pic2], pictures.get_pics_where(word='go'))
+        self.assertEqual([pic1, pic2], pictures.get_pics_where(word='o'))
+        self.assertEqual([pic1], pictures.get_pics_where(word='is out'))
+        self.assertEqual([], pictures.get_pics_where(word='this in'))
+
+    def test_index_existing_database(self):
+        # databases from before the full-text index, and from before 'row_id'
+        for version, script in [(0, _old_create_tables), (1, _old_create_tables + _old_create_fts)]:
+            with self.subTest(version=version):
+                pictures._con.close()
+                os.remove(self.db_filename)
+                con = sqlite3.connect(self.db_filename)
+                con.executescript(script)
+                con.execute(
+                    'INSERT INTO pics values (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (pic1.id, pic1.url, pic1.msg, pic1.time, pic1.uploader_id, pic1.channel_id, pic1.server_id,
+                     pic1.sfw)
+                )
+                con.execute(f'PRAGMA user_version = {version}')
+                con.commit()
+                con.close()
+
+                pictures._con = pictures._get_db_connection()
+                self.assertEqual([pic1], pictures.get_pics_where(word='this'))
+                pic2 = dataclasses.replace(pic1, id=123, msg='this too')
+                pictures.save_pic(pic2)
+                self.assertEqual([pic1, pic2], pictures.get_pics_where(word='this'))
+                self.assertEqual(pic1, pictures.get_pic_by_id(pic1.id))
+
+    def test_search_after_vacuum(self):
+        pic2 = dataclasses.replace(pic1, id=123, msg='this too')
+        pictures.save_pic(pic1)
+        pictures.save_pic(pic2)
+        pictures._con.execute('DELETE FROM pics WHERE id = ?', (pic1.id,))
+        pictures.save_all()
+        # VACUUM can renumber implicit rowids, but not 'row_id'
+        pictures._con.execute('VACUUM')
+        self.assertEqual([pic2], pictures.get_pics_where(word='this'))
@@ -52,7 +52,7 @@ proactive_reply:
 
         msg = _make_msg()
         await cog.on_message(msg)
-        reply_mock_fn.assert_called_with(msg, use_channel=True)
+        reply_mock_fn.assert_called_with(msg, use_channel=True, command='proactive_reply')
 
         reply_mock_fn.reset_mock()
         await cog.on_message(_make_msg())
@@ -74,12 +74,12 @@ proactive_reply:
         msg = _make_msg()
         await cog.on_message(msg)
         await reply_back(msg)
-        reply_mock_fn.assert_called_with(msg, use_channel=True)
+        reply_mock_fn.assert_called_with(msg, use_channel=True, command='proactive_reply')
 
         reply_mock_fn.reset_mock()
         await cog.on_message(msg)
         await reply_back(msg)
-        reply_mock_fn.assert_called_with(msg, use_channel=True)
+        reply_mock_fn.assert_called_with(msg, use_channel=True, command='proactive_reply')
 
     @mock.patch('cheems.proactive_markov_cog.reply_back')
     async def test_reply_blocked_server(self, reply_mock_fn: AsyncMock) -> None:
@@ -1,12 +1,15 @@
+import asyncio
 from datetime import datetime, timezone, timedelta
 from importlib import reload
 from tempfile import TemporaryDirectory
 from unittest import IsolatedAsyncioTestCase
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
+from cheems import pictures
 from cheems.config import config
 from cheems.discord_helper import map_channel
 from cheems.markov import models_xml
+from cheems.markov.model_xml import XmlModel
 from cheems.trainer import CheemsTrainer
 
 # test data: Discord objects
@@ -123,6 +126,7 @@ training:
         await trainer.wait_for_completion()
 
         self.assertEqual('''
+. hello 3
 baby . 1
 hello baby 1
 hello world 2
@@ -130,6 +134,28 @@ world . 2
         '''.strip(), get_model_data(d_lucky_channel))
         self.assertIsNone(models_xml.get_model(d_general_channel))
 
+    async def test_close_saves_models(self):
+        set_messages([_make_msg(content='hello world')])
+        trainer = CheemsTrainer(d_bot)
+        # these class attributes still hold tasks and models of earlier tests
+        trainer.tasks = []
+        trainer.unsaved_models = set()
+        # the scheduled save wouldn't run before exiting
+        trainer.save_period = timedelta(hours=1)
+        trainer.begin_training()
+        await asyncio.wait([task for task in trainer.tasks if task is not trainer.save_models_task])
+        # the pictures database could be closed by other tests
+        with patch.object(pictures, 'save_all'):
+            await trainer.close()
+
+        self.assertIsNone(models_xml.markov_storage.writer)
+        model = models_xml.get_model(map_channel(d_lucky_channel))
+        self.assertEqual('''
+. hello 1
+hello world 1
+world . 1
+        '''.strip(), XmlModel.from_xml_file(model.file_path).serialize_data())
+
     async def test_training_multiple_servers(self):
         set_messages([
             _make_msg(content='hello world', channel=d_lucky_channel),
@@ -142,12 +168,14 @@ world . 2
         await trainer.update_models_from_channel(d_general_channel, yesterday)
 
         self.assertEqual('''
+. hello 2
 baby . 1
 hello baby 1
 hello world 1
 world . 1
         '''.strip(), get_model_data(d_lucky_channel))
         self.assertEqual('''
+. hello 1
 general . 1
 hello general 1
         '''.strip(), get_model_data(d_general_channel))
@@ -1,6 +1,6 @@
 from unittest import TestCase
 
-from cheems.util import sanitize_filename, pairwise
+from cheems.util import sanitize_filename, pairwise, merge_sorted_lines
 
 
 class TestUtil(TestCase):
@@ -18,3 +18,21 @@ class TestUtil(TestCase):
         for a, b in pairwise([1]):
             out.append((a, b))
         self.assertEqual([], out)
+
+    def test_merge_sorted_lines(self):
+        merged = merge_sorted_lines([
+            ['. hello 1', 'hello world 2', 'world . 1'],
+            [],
+            ['. hello 3', 'a b 1', 'hello baby 1', 'hello world 1'],
+        ])
+        self.assertEqual(['. hello 4', 'a b 1', 'hello baby 1', 'hello world 3', 'world . 1'], list(merged))
+        self.assertEqual([], list(merge_sorted_lines([])))
+
+    def test_words_with_prefixes(self):
+        # pairs are ordered by the first word, then by the next word
+        merged = merge_sorted_lines([['a b 1', 'ab c 1'], ['a b 2', 'a! b 1']])
+        self.assertEqual(['a b 3', 'a! b 1', 'ab c 1'], list(merged))
+
+    def test_merge_with_max_weight(self):
+        merged = merge_sorted_lines([['😂 1', '🤔 40'], ['🤔 20']], max_weight=50)
+        self.assertEqual(['😂 1', '🤔 50'], list(merged))
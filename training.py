@@ -27,8 +27,12 @@ async def on_ready():
 async def main():
     bot.remove_command('help')
     load_config('config.yaml')
-    async with bot:
-        await bot.start(config['discord_token'])
+    try:
+        async with bot:
+            await bot.start(config['discord_token'])
+    finally:
+        # the writer thread would drop pending saves on exit
+        await trainer.close()
 
 
 if __name__ == '__main__':